@@ -1,21 +1,132 @@
 #!/usr/bin/env python3
+# Hit map of one or more runs: the hit log is streamed in chunks and binned on the DAC grid
+# (weighted by the hits column), so long multi-repetition runs fit in memory and render quickly.
+#
+# usage examples:
+# $ ./plot_hit_map.py run_042/hit_log.csv
+# $ ./plot_hit_map.py run_042/hit_log.csv --per-repetition --latch-ups -o run_042.png
+# $ ./plot_hit_map.py run_0*/hit_log.csv --combine --bins 64
 import argparse
+import concurrent.futures
+import os
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-parser = argparse.ArgumentParser()
-parser.add_argument("filename", type=str, help="Name of the file to read from")
-args = parser.parse_args()
 
-data = pd.read_csv(args.filename)
+def accumulate_hit_log(filename, chunksize=1_000_000, per_repetition=False):
+    """Hits per DAC position (and repetition), latch-up positions; reads the log chunk by chunk
 
-plt.plot(data["x_lsb"], data["y_lsb"], 'k.', alpha=0.1, )
-plt.xlabel("X position (LSB)")
-plt.ylabel("Y position (LSB)")
-plt.grid(visible=True, which='major', linestyle='-', color="black", linewidth='0.8')
-plt.grid(visible=True, which='minor', linestyle='-', linewidth='.5')
+    Repetitions are looked up in scan_plan.csv next to the hit log by the step column.
+    Returns (hits: Series indexed by repetition, x_lsb, y_lsb; latch-ups: DataFrame of x_lsb, y_lsb).
+    """
+    repetitions = None
+    plan_file = os.path.join(os.path.dirname(filename), "scan_plan.csv")
+    if per_repetition:
+        if os.path.exists(plan_file):
+            repetitions = pd.read_csv(plan_file, usecols=["repetition"])["repetition"].to_numpy()
+        else:
+            print(f"{filename}: no scan_plan.csv, repetitions are not separated")
 
-plt.minorticks_on()
+    hits = None
+    latch_ups = []
+    wanted = {"x_lsb", "y_lsb", "hits", "latch_up", "step"}
+    for chunk in pd.read_csv(filename, usecols=lambda c: c in wanted, dtype={"latch_up": str}, chunksize=chunksize):
+        if repetitions is not None and "step" in chunk:
+            chunk["repetition"] = repetitions[np.clip(chunk["step"].to_numpy(), 0, len(repetitions) - 1)]
+        else:
+            chunk["repetition"] = 0
+        chunk_hits = chunk.groupby(["repetition", "x_lsb", "y_lsb"])["hits"].sum()
+        hits = chunk_hits if hits is None else hits.add(chunk_hits, fill_value=0)
+        latch_ups.append(chunk.loc[chunk["latch_up"] != "-", ["repetition", "x_lsb", "y_lsb", "latch_up"]])
 
-plt.show()
+    if hits is None:
+        hits = pd.Series(dtype=float, index=pd.MultiIndex.from_tuples([], names=["repetition", "x_lsb", "y_lsb"]))
+    # all hits of a latch-up step carry its latch-up number
+    latch_ups = pd.concat(latch_ups).drop_duplicates("latch_up") if latch_ups else pd.DataFrame(columns=["repetition", "x_lsb", "y_lsb"])
+    return hits, latch_ups
+
+
+def hit_map(hits, bins=None):
+    """2D histogram of hits per position: exact DAC grid, or `bins` equal bins per axis"""
+    x = hits.index.get_level_values("x_lsb").to_numpy()
+    y = hits.index.get_level_values("y_lsb").to_numpy()
+    if bins is None:
+        x_vals, ix = np.unique(x, return_inverse=True)
+        y_vals, iy = np.unique(y, return_inverse=True)
+        counts = np.zeros((len(y_vals), len(x_vals)))
+        np.add.at(counts, (iy.ravel(), ix.ravel()), hits.to_numpy())
+        return counts, _edges(x_vals), _edges(y_vals)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, weights=hits.to_numpy())
+    return counts.T, x_edges, y_edges
+
+
+def _edges(vals):
+    """Bin edges centered on the (possibly irregular) grid values"""
+    if len(vals) == 1:
+        return np.array([vals[0] - 0.5, vals[0] + 0.5])
+    mid = (vals[1:] + vals[:-1]) / 2
+    return np.concatenate([[2 * vals[0] - mid[0]], mid, [2 * vals[-1] - mid[-1]]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", type=str, nargs="+", help="hit_log.csv file(s) to read from")
+    parser.add_argument("--per-repetition", action="store_true", help="one hit map per scan repetition")
+    parser.add_argument("--latch-ups", action="store_true", help="mark latch-up positions")
+    parser.add_argument("--combine", action="store_true", help="sum all files into one hit map")
+    parser.add_argument("--bins", type=int, default=None, help="bins per axis (default: exact DAC grid)")
+    parser.add_argument("--chunksize", type=int, default=1_000_000, help="hit log rows per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="parallel processes for several files")
+    parser.add_argument("-o", "--output", type=str, default=None, help="save the figure instead of showing it")
+    args = parser.parse_args()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(
+            accumulate_hit_log, args.filenames,
+            [args.chunksize] * len(args.filenames), [args.per_repetition] * len(args.filenames),
+        ))
+
+    # one panel per file (or all files combined) and repetition
+    panels = []
+    if args.combine:
+        hits = pd.concat([r[0] for r in results]).groupby(level=[0, 1, 2]).sum()
+        latch_ups = pd.concat([r[1] for r in results])
+        results = [(hits, latch_ups)]
+        names = [f"{len(args.filenames)} runs"]
+    else:
+        names = args.filenames
+    for name, (hits, latch_ups) in zip(names, results):
+        for repetition in hits.index.get_level_values("repetition").unique():
+            title = name if not args.per_repetition else f"{name}, repetition {repetition}"
+            panels.append((title, hits.xs(repetition, level="repetition", drop_level=False),
+                           latch_ups[latch_ups["repetition"] == repetition]))
+
+    n_cols = int(np.ceil(np.sqrt(len(panels))))
+    n_rows = int(np.ceil(len(panels) / n_cols))
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(6 * n_cols, 5 * n_rows), squeeze=False)
+    for ax in axes.ravel()[len(panels):]:
+        ax.set_visible(False)
+    for ax, (title, hits, latch_ups) in zip(axes.ravel(), panels):
+        counts, x_edges, y_edges = hit_map(hits, bins=args.bins)
+        mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts, 0), cmap="viridis")
+        fig.colorbar(mesh, ax=ax, label="hits")
+        if args.latch_ups and len(latch_ups) > 0:
+            ax.plot(latch_ups["x_lsb"], latch_ups["y_lsb"], "rx", label="latch-up")
+            ax.legend(loc="upper right")
+        ax.set_title(title)
+        ax.set_xlabel("X position (LSB)")
+        ax.set_ylabel("Y position (LSB)")
+        ax.grid(visible=True, which='major', linestyle='-', color="black", linewidth='0.8')
+        ax.minorticks_on()
+    fig.tight_layout()
+
+    if args.output is not None:
+        fig.savefig(args.output)
+    else:
+        plt.show()
+
+
+if __name__ == "__main__":
+    main()
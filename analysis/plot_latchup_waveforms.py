@@ -1,36 +1,77 @@
 #!/usr/bin/env python3
-# %%
-import pandas as pd
-import matplotlib.pyplot as plt
+# Latch-up waveform browser: events are read one by one from a cache next to latch_data.pkl
+# (built on first use), overviews are min/max decimated and the feature table
+# (peak, step height, rise time) is computed for all events at once.
+#
+# usage examples:
+# $ ./plot_latchup_waveforms.py run_042/latch_data.pkl                 # decimated overview of all events
+# $ ./plot_latchup_waveforms.py run_042/latch_data.pkl --list          # feature table
+# $ ./plot_latchup_waveforms.py run_042/latch_data.pkl --index 0 5 7   # full resolution events
+# $ ./plot_latchup_waveforms.py run_042/latch_data.pkl --position 120 -40 --tolerance 2
 import argparse
+import os
+import sys
 
-filename = None
+import numpy as np
+import matplotlib.pyplot as plt
 
-parser = argparse.ArgumentParser()
-parser.add_argument("filename", type=str, help="Name of the file to read from")
-args = parser.parse_args()
-filename = args.filename
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from microbeam.microbeam_waveforms import LatchWaveformStore, minmax_decimate  # noqa: E402
 
-#filename = "../run_081/latch_data.pkl"
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", type=str, help="latch_data.pkl file to read from")
+    parser.add_argument("--index", type=int, nargs="+", default=None, help="events to plot at full resolution")
+    parser.add_argument("--position", type=int, nargs=2, default=None, metavar=("X", "Y"), help="plot all events at this DAC position (LSB)")
+    parser.add_argument("--tolerance", type=int, default=0, help="position tolerance (LSB)")
+    parser.add_argument("--list", action="store_true", help="print the feature table instead of plotting")
+    parser.add_argument("--csv", type=str, default=None, help="save the feature table as CSV")
+    parser.add_argument("--points", type=int, default=2000, help="min/max bins per event in the overview")
+    parser.add_argument("--max-legend", type=int, default=20, help="legend only up to this many events")
+    parser.add_argument("--sample-rate", type=float, default=20000.0, help="checker sample rate (Hz)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="save the figure instead of showing it")
+    args = parser.parse_args()
 
-#%%
+    store = LatchWaveformStore(args.filename)
+    print(f"{args.filename}: {len(store)} latch-ups")
 
-#filename = "../run_109/latch_data.pkl"
+    if args.list or args.csv:
+        features = store.features(sample_rate=args.sample_rate)
+        if args.csv:
+            features.to_csv(args.csv, index_label="event")
+        if args.list:
+            print(features.to_string(float_format=lambda v: f"{v:.4g}"))
+        return
 
-df = pd.read_pickle(filename)
-#plt.plot(df)
-offset = 0
-for column in df.columns:
-    plt.plot(df.index, df[column] + offset, label=column)
-    offset += 0  # Increase the offset for the next column
+    if args.index is not None:
+        events, decimate = args.index, False
+    elif args.position is not None:
+        events, decimate = store.at_position(*args.position, tolerance=args.tolerance), False
+        print(f"{len(events)} latch-ups at {args.position[0]}, {args.position[1]} ± {args.tolerance} LSB")
+    else:
+        events, decimate = range(len(store)), True
 
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for event in events:
+        y = store.waveform(event)
+        x, y = minmax_decimate(y, args.points) if decimate else (np.arange(len(y)), y)
+        ax.plot(x / args.sample_rate * 1e3, y, label=store.index["key"][event], linewidth=0.8)
+    if 0 < len(events) <= args.max_legend:
+        # Put a legend to the right of the current axis
+        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    ax.set_title(f"Run data {args.filename}, {len(events)} / {len(store)} latch-ups"
+                 + (f" (min/max of {args.points} bins)" if decimate else ""))
+    ax.set_xlabel("time (ms)")
+    ax.set_ylabel("signal (V)")
+    ax.grid(visible=True)
+    fig.tight_layout()
 
-# Put a legend to the right of the current axis
-plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-plt.title(f"Run data {args.filename}, {len(df.columns)} latch-ups observed")
-plt.show()
+    if args.output is not None:
+        fig.savefig(args.output)
+    else:
+        plt.show()
 
-print(df.to_string())
 
-# %%
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,25 @@
 #!/usr/bin/env python3
 import picologging as logging
 from microbeam.microbeam_web import MicrobeamWebInterface
+from microbeam.microbeam_web_process import start_web_process
 from microbeam.microbeam_run_controller import MicrobeamRunController
-from microbeam.microbeam_interface_rpi import MicrobeamInterfaceRpi
+from microbeam.microbeam_interface import INTERFACE_BACKENDS, make_interface
+from microbeam.microbeam_logging import setup_queue_logging
 
-import asyncio, os, signal
+import argparse, asyncio, json, os, signal
 import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 # quick notes: (FIXME: create README.md)
 # 1. run this script with Python 3.9 or higher
 # 2. important dependencies: asyncpio, aiohttp, uvloop, pip install git+https://github.com/spthm/asyncpio.git
-# 3. there's a simulation mode (see below), a RPi with GPIOs is not mandatory (but async_p_io must be still installed!)
+# 3. there's a simulation mode (--mode simulate), a RPi with GPIOs and asyncpio are not needed for it
+#    recorded runs can be replayed as live data: --mode replay --replay run_042 [--replay-speed 10, 0 = max.]
+# 4. startup time is checked with benchmarks/bench_startup.py (pandas etc. are only imported when needed)
 
 # for GPIO access on a Raspberry Pi, pigpiod must be running with 1 µs sample rate:
 # sudo pigpiod -s 1
-# for testing or when not running on RPi, use simulate=True in MicrobeamInterfaceRpi()
+# for testing or when not running on RPi, use --mode simulate
 # random hits with Gaussian distribution will be generated in this case
 
 # multiple TCP clients may connect to port 8188 and get run_start & run id, run_stop and x/y position messages
@@ -38,29 +42,96 @@ asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 # ack
 # stop_run
 
+# pipelined acks (ack_pipeline_depth=N > 0, see below): the beam may advance up to N steps ahead of the readout.
+# position messages carry a sequence id, "done <seq>" marks the end of a step. The main TCP client reads out
+# that step and replies "ack <seq>" (plain "ack" = oldest step), anything else (e.g. "nack <seq>") flags the step
+# (run_ctrl.nack_repeat = True => flagged points are scanned again)
+# $ nc localhost 8188
+# start_run 12
+# pos -99 -93 0
+# done 0
+# pos -50 -93 1
+# ack 0
+# done 1
+# ...
+
+parser = argparse.ArgumentParser(description="Microbeam scan control: run controller, TCP subscribers and web GUI")
+parser.add_argument("--config", default=None, help='JSON file with defaults for the options below, e.g. {"mode": "simulate", "web_port": 8089}')
+parser.add_argument("--mode", choices=sorted(INTERFACE_BACKENDS), default="rpi", help="beam interface backend (default: rpi)")
+parser.add_argument("--pigpio-host", default="192.168.0.200", help="host running pigpiod (default: 192.168.0.200)")
+parser.add_argument("--tcp-port", type=int, default=8188, help="TCP subscriber port (default: 8188)")
+parser.add_argument("--web-port", type=int, default=8088, help="web GUI port (default: 8088)")
+parser.add_argument("--fifo", default="/tmp/latch_fifo", help="latch-up FIFO of the checker, empty for none (default: /tmp/latch_fifo)")
+parser.add_argument("--run-dir", default=os.getcwd(), help="directory of run.id, cal.json and the run data (default: working directory)")
+parser.add_argument("--log-file", default=os.path.join(os.getcwd(), "beam_control_log.txt"), help="log file (default: ./beam_control_log.txt)")
+parser.add_argument("--replay", default=None, help="recorded run directory (hit_log.csv, latch_data.pkl) replayed with --mode replay")
+parser.add_argument("--replay-speed", type=float, default=1.0, help="replay speed factor, 0 = as fast as possible (default: 1)")
+parser.add_argument("--replay-wait", type=float, default=0.0, help="start the replay after this time (s), e.g. to connect subscribers and GUI first (default: 0)")
+parser.add_argument("--web-process", action="store_true", help="serve the web GUI from a separate process, the scan loop keeps this one to itself")
+# config file values replace the defaults, command line options still take precedence
+config_file = parser.parse_known_args()[0].config
+if config_file is not None:
+    with open(config_file) as fd:
+        config = json.load(fd)
+    unknown = set(config) - set(vars(parser.parse_args([])))
+    if unknown:
+        parser.error(f"unknown options in {config_file}: {', '.join(sorted(unknown))}")
+    parser.set_defaults(**config)
+args = parser.parse_args()
+if args.mode == "replay" and args.replay is None:
+    parser.error("--mode replay needs --replay RUN_DIR")
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG) # use .DEBUG only for testing, it will destroy timing!
-# start logging to file
-#log_formatter = logging.Formatter("%(asctime)s [%(levelname)s]  %(message)s") # bug in picologging with asctime
-log_formatter = logging.Formatter("%(created)f [%(levelname)s]  %(message)s")
-log_file_handler = logging.FileHandler(os.path.join(os.getcwd(), "beam_control_log.txt"))
-log_file_handler.setFormatter(log_formatter)
-logging.getLogger().addHandler(log_file_handler)
-
-iface = MicrobeamInterfaceRpi(logger,simulate=False) # simulate=True => testing on a regular computer (no pigpiod)
+# console and file logging (incl. per-run logs) are formatted and written by a background thread,
+# so verbose logging doesn't block the event loop. For very long runs, per-step messages can be
+# thinned out with rate_limit=<records/s per message> or sample_every=<n>
+#log_format = "%(asctime)s [%(levelname)s]  %(message)s" # bug in picologging with asctime
+log_listener = setup_queue_logging(
+    level=logging.DEBUG,
+    log_file=args.log_file,
+    log_format="%(created)f [%(levelname)s]  %(message)s",
+)
+
+# rpi: GPIOs and DAC through pigpiod, simulate: testing on a regular computer, replay: a recorded run as live data
+iface = make_interface(args.mode, logger, **({"run_path": args.replay, "speed": args.replay_speed} if args.mode == "replay" else {}))
     
-run_ctrl = MicrobeamRunController(logger, iface, wait_for_client_ack = False, fifo_file='/tmp/latch_fifo') # if True, the main TCP client must reply with a new line character (any message) before advancing the ion beam to the next step
+run_ctrl = MicrobeamRunController(logger, iface, wait_for_client_ack = False, fifo_file=args.fifo or None, run_dir=args.run_dir, # if True, the main TCP client must reply with a new line character (any message) before advancing the ion beam to the next step
+                                  ack_pipeline_depth = 0) # N > 0 => pipelined acks with up to N steps in flight
+run_ctrl.subscriber_socket.tcp_server_port = args.tcp_port
+# several DAQ readers: the first ack_clients connected TCP clients (0 = all) take part in acks, ack_quorum of them
+# (0 = all) must acknowledge each step, awaited concurrently, ack_timeout in s (0 = none); disconnected clients are dropped
+run_ctrl.subscriber_socket.ack_clients = 1
+run_ctrl.subscriber_socket.ack_quorum = 0
+run_ctrl.subscriber_socket.ack_timeout = 0
+run_ctrl.metrics.enabled = False # True => per-step phase timing on http://<host>:8088/metrics and summary in run_log.txt
+run_ctrl.step_current.ring_name = "latchup_ring" # sample ring of the latch-up checker => step_current.csv per run, None => off
+
+web_process = publisher = None # --web-process
 
 async def main():
+    global web_process, publisher
 
-    await iface.init_hw(pigpio_host="192.168.0.200")
+    await iface.init_hw(pigpio_host=args.pigpio_host)
     
     await run_ctrl.start()
+    loop_lag_task = asyncio.create_task(run_ctrl.loop_lag.run()) # scan loop lag on /metrics
+
+    logger.info("Listening to TCP clients on port %d.", run_ctrl.subscriber_socket.tcp_server_port)
 
-    logger.info(f"Listening to TCP clients on port {run_ctrl.subscriber_socket.tcp_server_port}.")
+    if args.mode == "replay":
+        # load test / regression harness: the recorded run goes through controller, subscribers and GUI
+        from microbeam.microbeam_replay import start_replay
+        replay_task = asyncio.create_task(start_replay(run_ctrl, iface, delay=args.replay_wait))
 
-    web_if = MicrobeamWebInterface(logger, run_ctrl)
-    await web_if.serve()
+    if args.web_process:
+        # GUI requests, JSON encoding and plotting data don't delay scan steps: the web process
+        # reads state snapshots from shared memory, its commands are executed on this loop
+        web_process, publisher = start_web_process(logger, run_ctrl, args.web_port, args.log_file)
+        await publisher.run()
+    else:
+        web_if = MicrobeamWebInterface(logger, run_ctrl)
+        web_if.port = args.web_port
+        await web_if.serve()
 
     await iface.close_hw()
 
@@ -71,4 +142,10 @@ except KeyboardInterrupt:
     asyncio.run(run_ctrl.stop_run())
     asyncio.run(iface.close_hw())
     logger.info("Exiting.")
+finally:
+    if web_process is not None:
+        web_process.terminate()
+        web_process.wait()
+        publisher.close()
+    log_listener.stop() # flush all queued log records
 
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""End-to-end scan throughput benchmark
+
+Runs the real run controller, the simulated interface (real time, Poisson hits),
+the TCP subscriber server and the web server in one event loop, like beam_control.py,
+and loads them with TCP subscribers and polling GUI tabs. Every case of the parameter
+sweep runs in a fresh process. Results are written as JSON for regression comparison.
+
+NOTE: uses the default ports 8188 (subscribers) and 8088 (web), don't run it next to beam_control.py
+
+usage example:
+$ ./benchmarks/bench_scan_throughput.py --grid 5 10 --hits-per-step 1 10 --subscribers 0 4 --gui-tabs 0 2 -o bench_results.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values)
+    return {
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+async def _loop_lag_probe(lags, interval=0.005):
+    """Measures how late the event loop wakes up a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - t - interval)
+
+
+async def _memory_probe(samples, interval=0.5):
+    while True:
+        samples.append(_rss_bytes())
+        await asyncio.sleep(interval)
+
+
+async def _subscriber(port, recv_times):
+    loop = asyncio.get_running_loop()
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = line.decode("utf8").split()
+            if msg and msg[0] == "pos":
+                recv_times.append(loop.time())
+            elif msg and msg[0] == "stop_run":
+                break
+    finally:
+        writer.close()
+
+
+async def _gui_tab(url, poll_period, counters):
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url) as ws:
+            while True:
+                t = time.perf_counter()
+                await ws.send_str(json.dumps({"action": "poll"}))
+                await ws.receive()
+                counters["polls"] += 1
+                counters["poll_time"].append(time.perf_counter() - t)
+                await asyncio.sleep(poll_period)
+
+
+async def _wait_for_port(port, timeout=10.0):
+    t_end = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("localhost", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > t_end:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def _run_case(case):
+    import picologging as logging
+    from microbeam.microbeam_run_controller import MicrobeamRunController
+    from microbeam.microbeam_simulation import BeamModel, MicrobeamInterfaceSim
+    from microbeam.microbeam_web import MicrobeamWebInterface
+    from microbeam.microbeam_logging import setup_queue_logging
+
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(getattr(logging, case["log_level"]))
+    log_listener = None
+
+    loop = asyncio.get_running_loop()
+    background = []
+    lags = []
+    memory = [_rss_bytes()]
+    recv_times = [[] for _ in range(case["subscribers"])]
+    gui_counters = {"polls": 0, "poll_time": []}
+
+    with tempfile.TemporaryDirectory(prefix="microbeam_bench_") as run_dir:
+        # main log file like beam_control.py, written in the loop or by the queue listener thread
+        if case["queue_logging"]:
+            log_listener = setup_queue_logging(level=getattr(logging, case["log_level"]),
+                                               log_file=os.path.join(run_dir, "beam_control_log.txt"), console=False)
+        else:
+            log_file_handler = logging.FileHandler(os.path.join(run_dir, "beam_control_log.txt"))
+            log_file_handler.setFormatter(logging.Formatter("%(created)f [%(levelname)s]  %(message)s"))
+            logging.getLogger().addHandler(log_file_handler)
+
+        iface = MicrobeamInterfaceSim(logger, BeamModel(hit_rate=case["hit_rate"], dac_latency=0), seed=case["seed"])
+        run_ctrl = MicrobeamRunController(logger, iface, run_dir=run_dir, enable_metrics=case["metrics"])
+        await iface.init_hw()
+        await run_ctrl.start()
+
+        web_if = MicrobeamWebInterface(logger, run_ctrl)
+        background.append(asyncio.create_task(web_if.serve()))
+        await _wait_for_port(8088)
+
+        for i in range(case["subscribers"]):
+            background.append(asyncio.create_task(_subscriber(run_ctrl.subscriber_socket.tcp_server_port, recv_times[i])))
+        while len(run_ctrl.subscriber_socket._write_clients) < case["subscribers"]:
+            await asyncio.sleep(0.01)
+        for _ in range(case["gui_tabs"]):
+            background.append(asyncio.create_task(_gui_tab("http://localhost:8088/ws", case["gui_poll_period"], gui_counters)))
+
+        background.append(asyncio.create_task(_loop_lag_probe(lags)))
+        background.append(asyncio.create_task(_memory_probe(memory)))
+
+        t_start = loop.time()
+        await run_ctrl.start_run(
+            start_x=-1000,
+            start_y=-1000,
+            stop_x=1000,
+            stop_y=1000,
+            points_x=case["grid"],
+            points_y=case["grid"],
+            hits_per_step=case["hits_per_step"],
+            step_timeout=case["step_timeout"],
+            repeat_count=1,
+            units="lsb",
+        )
+        await run_ctrl._scan_task
+        duration = loop.time() - t_start
+        memory.append(_rss_bytes())
+
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if log_listener is not None:
+            log_listener.stop()
+
+    # the last DAC write parks the beam and closes the final step
+    dac_times = np.asarray(iface.dac_write_times)
+    step_times = np.diff(dac_times)
+    # per subscriber: delay between DAC write and reception of the "pos" message
+    delivery = []
+    for times in recv_times:
+        n = min(len(times), len(dac_times))
+        delivery.extend(np.asarray(times[:n]) - dac_times[:n])
+
+    return {
+        "params": case,
+        "duration_s": duration,
+        "scan_points_done": run_ctrl.scan_points_done,
+        "points_per_s": run_ctrl.scan_points_done / duration,
+        "hit_count": run_ctrl.hit_count,
+        "hits_per_s": run_ctrl.hit_count / duration,
+        "timeouts": run_ctrl.timeout_counter,
+        "step_latency_s": _percentiles(step_times),
+        "subscriber_delivery_s": _percentiles(delivery),
+        "loop_lag_s": _percentiles(lags),
+        "gui_polls": gui_counters["polls"],
+        "gui_poll_time_s": _percentiles(gui_counters["poll_time"]),
+        "rss_start_bytes": memory[0],
+        "rss_end_bytes": memory[-1],
+        "rss_growth_bytes": memory[-1] - memory[0],
+        "rss_peak_bytes": max(memory),
+        "step_phases_s": {
+            phase: {"count": hist.count, "mean": hist.sum / hist.count, "p99": hist.quantile(0.99), "max": hist.max}
+            for phase, hist in run_ctrl.metrics.phases.items()
+        },
+    }
+
+
+def run_case(case):
+    """Entry point of a benchmark worker process"""
+    if case["uvloop"]:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(_run_case(case))
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end scan throughput benchmark")
+    parser.add_argument("--grid", type=int, nargs="+", default=[10], help="scan grid sizes (points per axis)")
+    parser.add_argument("--hits-per-step", type=int, nargs="+", default=[1, 10], help="hits per step values")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[0, 4], help="numbers of TCP subscribers")
+    parser.add_argument("--gui-tabs", type=int, nargs="+", default=[0, 4], help="numbers of open GUI tabs (WebSocket pollers)")
+    parser.add_argument("--gui-poll-period", type=float, default=1.0, help="GUI poll period (s), 1 s like header.html")
+    parser.add_argument("--hit-rate", type=float, default=1000.0, help="simulated beam hit rate (hits/s)")
+    parser.add_argument("--step-timeout", type=float, default=1.0, help="step timeout (s)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"], help="controller log level")
+    parser.add_argument("--metrics", action="store_true", help="record per-step phase timing of the run controller")
+    parser.add_argument("--queue-logging", action="store_true", help="log through the background logging thread")
+    parser.add_argument("--no-uvloop", action="store_true", help="use the default asyncio event loop")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON result file")
+    args = parser.parse_args()
+
+    cases = [
+        {
+            "grid": grid,
+            "hits_per_step": hits_per_step,
+            "subscribers": subscribers,
+            "gui_tabs": gui_tabs,
+            "gui_poll_period": args.gui_poll_period,
+            "hit_rate": args.hit_rate,
+            "step_timeout": args.step_timeout,
+            "log_level": args.log_level,
+            "metrics": args.metrics,
+            "queue_logging": args.queue_logging,
+            "uvloop": not args.no_uvloop,
+            "seed": args.seed,
+        }
+        for grid, hits_per_step, subscribers, gui_tabs
+        in itertools.product(args.grid, args.hits_per_step, args.subscribers, args.gui_tabs)
+    ]
+
+    results = []
+    for case in cases:
+        # fresh process per case: clean ports, clean memory baseline
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_case, case).result()
+        results.append(result)
+        print(
+            f"grid={case['grid']:>4} hits/step={case['hits_per_step']:>4} subs={case['subscribers']:>2} tabs={case['gui_tabs']:>2}: "
+            f"{result['points_per_s']:8.1f} points/s {result['hits_per_s']:8.1f} hits/s "
+            f"step p50={result['step_latency_s'].get('p50', 0)*1e3:.1f} ms p99={result['step_latency_s'].get('p99', 0)*1e3:.1f} ms "
+            f"lag p99={result['loop_lag_s'].get('p99', 0)*1e3:.2f} ms rss +{result['rss_growth_bytes']/1024:.0f} kiB"
+        )
+
+    with open(args.output, "w") as fd:
+        json.dump(
+            {
+                "benchmark": "scan_throughput",
+                "timestamp": time.time(),
+                "git_revision": _git_revision(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "results": results,
+            },
+            fd,
+            indent=4,
+        )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Startup time budget of beam_control.py
+
+Measures the import time of the modules beam_control.py loads (each in a fresh interpreter),
+checks that heavy optional modules (pandas, Pi libraries, plotting) are not imported on the way,
+and times complete restarts in simulate mode: process start until the TCP subscriber and web
+ports accept connections, and shutdown after SIGINT. Exits with status 1 if the median time to
+ready exceeds the budget or a heavy module was imported.
+
+usage example:
+$ ./benchmarks/bench_startup.py --budget 1.0 --repeat 5 -o startup_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# imported by beam_control.py, in this order
+STARTUP_MODULES = [
+    "uvloop",
+    "aiohttp",
+    "microbeam.microbeam_run_controller",
+    "microbeam.microbeam_web",
+    "microbeam.microbeam_interface_rpi",
+]
+# must not be imported before a run needs them
+HEAVY_MODULES = ["pandas", "asyncpio", "matplotlib", "scipy"]
+
+
+def _import_time(module):
+    """Import time (s) of module in a fresh interpreter, and the heavy modules it pulled in"""
+    code = (
+        "import json, sys, time\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "t = time.perf_counter() - t\n"
+        f"print(json.dumps([t, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _port_open(port):
+    try:
+        with socket.create_connection(("localhost", port), timeout=0.1):
+            return True
+    except OSError:
+        return False
+
+
+def _restart_time(timeout):
+    """Seconds until both ports accept connections and until exit after SIGINT"""
+    tcp_port, web_port = _free_port(), _free_port()
+    with tempfile.TemporaryDirectory(prefix="microbeam_startup_") as run_dir:
+        t = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, "beam_control.py"), "--mode", "simulate", "--fifo", "",
+             "--run-dir", run_dir, "--log-file", os.path.join(run_dir, "beam_control_log.txt"),
+             "--tcp-port", str(tcp_port), "--web-port", str(web_port)],
+            cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while not (_port_open(tcp_port) and _port_open(web_port)):
+                if process.poll() is not None:
+                    raise RuntimeError(f"beam_control.py exited with status {process.returncode}")
+                if time.perf_counter() - t > timeout:
+                    raise RuntimeError(f"beam_control.py not ready after {timeout} s")
+                time.sleep(0.005)
+            ready = time.perf_counter() - t
+            t = time.perf_counter()
+            process.send_signal(signal.SIGINT)
+            process.wait(timeout)
+            return ready, time.perf_counter() - t
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time budget of beam_control.py")
+    parser.add_argument("--budget", type=float, default=1.0, help="max. median time to ready (s)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of restarts")
+    parser.add_argument("--timeout", type=float, default=30.0, help="max. time to ready and to exit (s)")
+    parser.add_argument("-o", "--output", default=None, help="JSON result file")
+    args = parser.parse_args()
+
+    interpreter = _import_time("sys")[0]
+    imports = {}
+    heavy = set()
+    for module in STARTUP_MODULES:
+        seconds, pulled_in = _import_time(module)
+        imports[module] = seconds
+        heavy.update(pulled_in)
+        print(f"import {module:<40} {seconds * 1e3:7.1f} ms" + (f"  (imports {', '.join(pulled_in)})" if pulled_in else ""))
+
+    restarts = [_restart_time(args.timeout) for _ in range(args.repeat)]
+    ready = float(np.median([r[0] for r in restarts]))
+    shutdown = float(np.median([r[1] for r in restarts]))
+    print(f"ready after {ready * 1e3:.0f} ms (median of {args.repeat}, budget {args.budget * 1e3:.0f} ms), "
+          f"shutdown {shutdown * 1e3:.0f} ms")
+
+    if args.output is not None:
+        with open(args.output, "w") as fd:
+            json.dump(
+                {
+                    "benchmark": "startup",
+                    "timestamp": time.time(),
+                    "python": sys.version,
+                    "platform": platform.platform(),
+                    "interpreter_s": interpreter,
+                    "import_s": imports,
+                    "heavy_modules": sorted(heavy),
+                    "ready_s": [r[0] for r in restarts],
+                    "shutdown_s": [r[1] for r in restarts],
+                    "budget_s": args.budget,
+                },
+                fd,
+                indent=4,
+            )
+        print(f"Results written to {args.output}")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(sorted(heavy))}")
+        failed = True
+    if ready > args.budget:
+        print(f"FAIL: startup over budget by {(ready - args.budget) * 1e3:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
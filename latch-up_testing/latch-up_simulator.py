@@ -1,12 +1,17 @@
 #! /usr/bin/env python3
 
 import os
+import sys
 import time
 import random
 import numpy as np
 import errno
 import fcntl
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from microbeam.microbeam_shm_ring import ShmRing, RingDecimator, CHECKER_RING  # noqa: E402
+from microbeam.microbeam_waveforms import pack_latch_message  # noqa: E402
+
 num_samples = 17000 # actually 16xxx ... something
 
 pipe = None
@@ -15,6 +20,12 @@ pipe = None
 F_SETPIPE_SZ = 1031  # Linux 2.6.35+
 F_GETPIPE_SZ = 1032  # Linux 2.6.35+
 
+num_channels = 2
+
+# simulated supply current in the checker's sample ring (20 kHz, decimated by 20)
+sample_rate = 20000
+ring_decimation = 20
+
 def open_pipe(pipe):
     while True:
         try:
@@ -34,28 +45,48 @@ def open_pipe(pipe):
     print("Modified pipe size:", fcntl.fcntl(pipe, F_GETPIPE_SZ))
     return pipe
 
+
+def stream_current(decimator, seconds):
+    """Publishes noisy supply current samples for the given time"""
+    baseline = np.array([0.05, 0.08])[:num_channels, None]
+    for _ in range(int(seconds * 10)):
+        decimator.push(baseline + np.random.normal(0, 0.002, (num_channels, sample_rate // 10)))
+        time.sleep(0.1)
+
+ring = ShmRing.create(CHECKER_RING, num_channels, 60 * sample_rate // ring_decimation,
+                      sample_rate / ring_decimation, ring_decimation)
+decimator = RingDecimator(ring, ring_decimation)
+
 print("Waiting for FIFO pipe to open by reader...")
 
 pipe = open_pipe(pipe)
 
-while True:
-    #latch_waveform = 5 * np.random.random_sample(num_samples) # scale to 0.0 .. +5.0
+try:
+    while True:
+        #latch_waveform = 5 * np.random.random_sample(num_samples) # scale to 0.0 .. +5.0
+
+        steps = np.random.normal(0, 0.1, num_samples)
 
-    steps = np.random.normal(0, 0.1, num_samples)
+        # Generate the y values as a cumulative sum of the steps, like a random walk
+        latch_waveform = np.cumsum(steps)
 
-    # Generate the y values as a cumulative sum of the steps, like a random walk
-    latch_waveform = np.cumsum(steps)
 
+        channel = random.randrange(num_channels)
 
-    time.sleep(random.randint(1,5))
-    try:
-        os.write(pipe,latch_waveform.tobytes())
-    except Exception as exception:
-        if exception.errno == errno.EAGAIN:
-            print("Waiting for pipe reader to consume data...")
-            time.sleep(0.5)
-        else:
-            print("Pipe closed, waiting on re-opening...")
-            pipe = open_pipe(pipe) # wait until pipe is open again
-    else:
-        print("Random latch waveform sent")    
\ No newline at end of file
+        stream_current(decimator, random.randint(1,5))
+        message = pack_latch_message(channel, latch_waveform)
+        written = 0
+        while written < len(message):
+            # non-blocking writes may be partial, a new reader gets the whole message again
+            try:
+                written += os.write(pipe, message[written:])
+            except BlockingIOError:
+                print("Waiting for pipe reader to consume data...")
+                time.sleep(0.05)
+            except OSError:
+                print("Pipe closed, waiting on re-opening...")
+                pipe = open_pipe(pipe) # wait until pipe is open again
+                written = 0
+        print(f"Random latch waveform sent (channel {channel})")
+finally:
+    ring.close()
@@ -3,8 +3,6 @@
 import argparse
 import errno
 import fcntl
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 from pydwf import (DwfLibrary,
@@ -15,42 +13,50 @@ from pydwf import (DwfLibrary,
                    DwfAnalogInFilter,
                    PyDwfError)
 from pydwf.utilities import openDwfDevice
+import signal
 import socket
 import sys
+import threading
 import time
 from trbnet import TrbNet
 
+from latchup_detectors import make_detectors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from microbeam.microbeam_shm_ring import ShmRing, RingDecimator, CHECKER_RING  # noqa: E402
+from microbeam.microbeam_waveforms import pack_latch_message  # noqa: E402
+
 
 F_SETPIPE_SZ = 1031  # Linux 2.6.35+
 F_GETPIPE_SZ = 1032  # Linux 2.6.35+
 
+# set by SIGINT / SIGTERM, the checker finishes the current block and exits
+stop_requested = threading.Event()
+
 
-# def mypause(interval):
-#     backend = plt.rcParams['backend']
-#     if backend in matplotlib.rcsetup.interactive_bk:
-#         figManager = matplotlib._pylab_helpers.Gcf.get_active()
-#         if figManager is not None:
-#             canvas = figManager.canvas
-#             if canvas.figure.stale:
-#                 canvas.draw()
-#             canvas.start_event_loop(interval)
-#             return
+def request_stop(signum, frame):
+    if stop_requested.is_set():
+        raise KeyboardInterrupt  # second Ctrl-C: abort immediately
+    print(f"{signal.Signals(signum).name} received, stopping...")
+    stop_requested.set()
 
 
 def open_pipe(pipe):
-    while True:
+    while not stop_requested.is_set():
         try:
             pipe = os.open('/tmp/latch_fifo', os.O_WRONLY | os.O_NONBLOCK)
         except OSError as ex:
             # reader has not opened the FIFO pipe yet
             if ex.errno == errno.ENXIO:
-                time.sleep(1)
+                stop_requested.wait(1)
             else:
                 print("Error opening FIFO pipe:", ex)
                 break
         else:
             print("FIFO pipe opened successfully")
             break
+    else:
+        return pipe
 
     print("Original pipe size:", fcntl.fcntl(pipe, F_GETPIPE_SZ))
     fcntl.fcntl(pipe, F_SETPIPE_SZ, 1000000)
@@ -63,19 +69,118 @@ maskV = 0x3
 maskO = 0x4
 
 
+def write_latch_waveform(pipe, channel, waveform):
+    """Sends the whole waveform tagged with its channel to the run controller, returns the (re-opened) pipe
+
+    Non-blocking writes may be partial, the rest follows once the reader consumed data.
+    A new reader (after the pipe was closed) gets the whole message again.
+    """
+    message = pack_latch_message(channel, waveform)
+    written = 0
+    while written < len(message) and not stop_requested.is_set():
+        try:
+            written += os.write(pipe, message[written:])
+        except BlockingIOError:
+            print("Waiting for pipe reader to consume data...")
+            time.sleep(0.05)
+        except OSError:
+            print("Pipe closed, waiting on re-opening...")
+            pipe = open_pipe(pipe) # wait until pipe is open again
+            written = 0
+    return pipe
+
+
+def supply_off(s):
+    s.send(b"INST OUTP1\r\nOUTP:SEL OFF\r\nOUTP?\r\n")
+    while int(s.recv(4096)) != 0:
+        s.send(b"OUTP:SEL OFF\r\nOUTP?\r\n")
+
+
+def supply_on(s):
+    s.send(b"INST OUTP1\r\nOUTP:SEL ON\r\nOUTP?\r\n")
+    while int(s.recv(4096)) != 1:
+        s.send(b"OUTP:SEL ON\r\nOUTP?\r\n")
+
+
+def release_overrides(digitalIO):
+    """Presses the override buttons until both supplies report OK again"""
+    x=digitalIO.inputStatus()
+    while x & 0b11000 != 0b11000:
+        # digitalIO.outputSet(0b011) # all released
+        # time.sleep(0.1)
+        digitalIO.outputSet(0b111) # override pressed
+        time.sleep(0.1)
+        digitalIO.outputSet(0b101) # override together with analog
+        time.sleep(0.1)
+        digitalIO.outputSet(0b111) # ovverride pressed
+        time.sleep(0.1)
+        digitalIO.outputSet(0b110) # override with digital
+        time.sleep(0.1)
+        digitalIO.outputSet(0b111) # ovverride pressed
+        time.sleep(0.1)
+        digitalIO.outputSet(0b011) # all released
+        time.sleep(1)
+        x=digitalIO.inputStatus()
+
+
+def handle_latch_up(digitalIO, s, pipe, channel_index, waveform, level, description):
+    """Power cycles the DUT and sends the waveform, returns the (re-opened) pipe
+
+    Level detectors (over-current) press the override buttons before the supply is turned off.
+    """
+    if level: #latchup condition!
+
+        digitalIO.outputSet(0b111) # override pressed
+        time.sleep(0.1)
+
+        # Turn supply OFF
+        supply_off(s)
+
+        pipe = write_latch_waveform(pipe, channel_index, waveform)
+
+        time.sleep(.1)
+        digitalIO.outputSet(0b011) # all released
+
+    else:
+
+        # Turn supply OFF
+        supply_off(s)
+
+        pipe = write_latch_waveform(pipe, channel_index, waveform)
+
+    time.sleep(2)
+
+    # Turn ON
+    supply_on(s)
+
+    time.sleep(0.5)
+
+    print(f"CH{channel_index + 1} latchup detected by {description}")
+
+    release_overrides(digitalIO)
+
+    #trbcmd w 0xfe82 0xde05 0x100  #Mimosis reset
+    # trb.register_write(0xa000, 0xde05, 0x100)
+    return pipe
+
+
 def run(analogIn,
         digitalIO,
         samplingFreq,
         inputRange,
-        minDiff,
-        polarityDiff,
-        searchInt,
+        detector,
+        preSamples,
         pipe,
         trb,
-        sock):
+        sock,
+        channels=None,
+        ring=None,
+        ringDecimation=20,
+        pollInterval=0.01):
 
-    CH1 = 0
-    channels = (CH1,)
+    # all analog inputs by default
+    if channels is None:
+        channels = tuple(range(analogIn.channelCount()))
 
     for channel_index in channels:
         analogIn.channelEnableSet(channel_index, True)
@@ -88,210 +193,79 @@ def run(analogIn,
     analogIn.configure(False, True)  # Start acquisition sequence.
     num_samples = analogIn.bufferSizeGet()
 
+    def acquire():
+        """channels × samples block of the whole acquisition buffer"""
+        return np.stack([analogIn.statusData(channel_index, num_samples) for channel_index in channels])
+
     # first acquisition
     analogIn.status(True)
-    c1 = analogIn.statusData(CH1, num_samples)
+    c = acquire()
     writeIndex = analogIn.statusIndexWrite()
     lastWriteIndex = writeIndex
-    beforeLastIndex = 0
 
-    fig, ax1 = plt.subplots()
-    ax1.set_title("acquisition mode: {}".format(acquisition_mode.name))
-    ax1.set_xlabel("samples [-]")
-    ax1.set_ylabel("signals [V]")
-    ax1.set_ylim(-inputRange, +inputRange)
-    (p1, ) = ax1.plot(c1, '.', label="CH1")
-
-    plt.show(block=False)
+    # continuous current stream for the run controller (per-step current) and latchup_viewer.py,
+    # each frame holds min/max/mean/mean square of ringDecimation samples
+    decimator = None
+    if ring is not None:
+        shm_ring = ShmRing.create(ring[0], len(channels), int(ring[1] * samplingFreq / ringDecimation),
+                                  samplingFreq / ringDecimation, ringDecimation)
+        decimator = RingDecimator(shm_ring, ringDecimation)
+        print(f"Sample ring '{ring[0]}': {shm_ring.capacity} frames at {shm_ring.frame_rate:g} Hz")
 
-    vline = plt.axvline(0, c='grey')
-    vline.set_xdata([writeIndex])
-
-
-    def search_latch_up(c, offset, pipe,s):
-
-        skipCounter = 0
+    try:
+        pipe = open_pipe(pipe)
 
-        for x in range(len(c)-searchInt):
+        latchup = False
+        latchupCounter = 0
 
-            diff = abs(c[x+searchInt] - c[x])
-            # diff = c[x+searchInt] - c[x]
-            offset = offset if offset+x <= num_samples else offset+x-num_samples
-
-            overCurrent = 0.135
-
-            if c[x] >= overCurrent: #latchup condition!
-
-                # print(c[x+searchInt] - c[x])
-
-                digitalIO.outputSet(0b111) # override pressed
-                time.sleep(0.1)
-
-                # Turn supply OFF
-                s.send(b"INST OUTP1\r\nOUTP:SEL OFF\r\nOUTP?\r\n")
-                while int(s.recv(4096)) != 0:
-                    s.send(b"OUTP:SEL OFF\r\nOUTP?\r\n")
-
-                lo = 0 if x-searchInt < 0 else x-searchInt
-                try:
-                    os.write(pipe,c[lo:x+searchInt].tobytes())
-                except Exception as exception:
-                    if exception.errno == errno.EAGAIN:
-                        print("Waiting for pipe reader to consume data...")
-                        time.sleep(0.5)
-                    else:
-                        print("Pipe closed, waiting on re-opening...")
-                        pipe = open_pipe(pipe) # wait until pipe is open again
-
-                time.sleep(.1)
-                digitalIO.outputSet(0b011) # all released
-
-                time.sleep(2)
-
-                # Turn ON
-                s.send(b"INST OUTP1\r\nOUTP:SEL ON\r\nOUTP?\r\n")
-                while int(s.recv(4096)) != 1:
-                    s.send(b"OUTP:SEL ON\r\nOUTP?\r\n")
-
-                time.sleep(0.5)
-
-                print("Over " + str(overCurrent) + " " + str(offset+x))
-
-                x=digitalIO.inputStatus()
-                while x & 0b11000 != 0b11000:
-                    # digitalIO.outputSet(0b011) # all released
-                    # time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # override pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b101) # override together with analog
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # ovverride pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b110) # override with digital
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # ovverride pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b011) # all released
-                    time.sleep(1)
-                    x=digitalIO.inputStatus()
-
-                #trbcmd w 0xfe82 0xde05 0x100  #Mimosis reset
-                # trb.register_write(0xa000, 0xde05, 0x100)
-                return True
-
-            # elif diff < -minDiff: #latchup condition!
-            # elif diff > minDiff or c[x] >= 0.2: #latchup condition!
-            elif diff > minDiff:
-
-                print(c[x+searchInt] - c[x])
-
-                # Turn supply OFF
-                s.send(b"INST OUTP1\r\nOUTP:SEL OFF\r\nOUTP?\r\n")
-                while int(s.recv(4096)) != 0:
-                    s.send(b"OUTP:SEL OFF\r\nOUTP?\r\n")
-
-                lo = 0 if x-searchInt < 0 else x-searchInt
-                try:
-                    # os.write(pipe,c[lo:x+searchInt].tobytes())
-                    os.write(pipe,c[lo:-1].tobytes())
-                except Exception as exception:
-                    if exception.errno == errno.EAGAIN:
-                        print("Waiting for pipe reader to consume data...")
-                        time.sleep(0.5)
-                    else:
-                        print("Pipe closed, waiting on re-opening...")
-                        pipe = open_pipe(pipe) # wait until pipe is open again
-
-                time.sleep(2)
-
-                # Turn ON
-                s.send(b"INST OUTP1\r\nOUTP:SEL ON\r\nOUTP?\r\n")
-                while int(s.recv(4096)) != 1:
-                    s.send(b"OUTP:SEL ON\r\nOUTP?\r\n")
-
-                time.sleep(0.5)
-
-                print("Latchup detected " + str(offset+x))
-
-                x=digitalIO.inputStatus()
-                while x & 0b11000 != 0b11000:
-                    # digitalIO.outputSet(0b011) # all released
-                    # time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # override pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b101) # override together with analog
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # ovverride pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b110) # override with digital
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b111) # ovverride pressed
-                    time.sleep(0.1)
-                    digitalIO.outputSet(0b011) # all released
-                    time.sleep(1)
-                    x=digitalIO.inputStatus()
-
-                #trbcmd w 0xfe82 0xde05 0x100  #Mimosis reset
-                # trb.register_write(0xa000, 0xde05, 0x100)
-                return True
-
-        return False
-
-    pipe = open_pipe(pipe)
-
-    latchup = False
-    latchupCounter = 0
-
-    while True:
-
-        analogIn.status(True)
-        st = analogIn.statusRecord()
-        if st[1] != 0 or st[2] != 0:
-            print(st)
-        c1 = analogIn.statusData(CH1, num_samples)
-        writeIndex = analogIn.statusIndexWrite()-1
-        # samplesValid = analogIn.statusSamplesValid()
-
-        if latchup == False or latchupCounter >= 1:
-
-            latchupCounter = 0
-
-            # if writeIndex > lastWriteIndex and lastWriteIndex > beforeLastIndex and not latchup:
-            if writeIndex > lastWriteIndex and lastWriteIndex > beforeLastIndex:
-
-                latchup = search_latch_up(np.concatenate((
-                    [c1[beforeLastIndex]],
-                    c1[lastWriteIndex:writeIndex]), axis=None),beforeLastIndex,pipe,sock)
-
-                # elif writeIndex < lastWriteIndex and lastWriteIndex > beforeLastIndex and not latchup:
-            elif writeIndex < lastWriteIndex and lastWriteIndex > beforeLastIndex:
-
-                latchup = search_latch_up(np.concatenate((
-                    [c1[beforeLastIndex]],
-                    c1[lastWriteIndex:num_samples],
-                    c1[0:writeIndex],), axis=None), beforeLastIndex,pipe,sock)
-
-                # elif writeIndex > lastWriteIndex and lastWriteIndex < beforeLastIndex and not latchup:
-            elif writeIndex > lastWriteIndex and lastWriteIndex < beforeLastIndex:
-
-                latchup = search_latch_up(np.concatenate((
-                    [c1[beforeLastIndex]],
-                    c1[0:lastWriteIndex],
-                    c1[lastWriteIndex:writeIndex],), axis=None), beforeLastIndex,pipe,sock)
-        else:
-            latchupCounter += 1
+        while not stop_requested.is_set():
+
+            analogIn.status(True)
+            st = analogIn.statusRecord()
+            if st[1] != 0 or st[2] != 0:
+                print(st)
+            c = acquire()
+            writeIndex = analogIn.statusIndexWrite()-1
+            # samplesValid = analogIn.statusSamplesValid()
 
-        # p1.set_ydata(c1)
-        # vline.set_xdata(writeIndex)
-#        mypause(1e-3)
-        # plt.pause(1e-3)
+            # new samples since the last acquisition, the acquisition buffer is a ring buffer
+            if writeIndex >= lastWriteIndex:
+                block = c[:, lastWriteIndex:writeIndex]
+            else:
+                block = np.concatenate((c[:, lastWriteIndex:num_samples], c[:, 0:writeIndex]), axis=1)
+
+            if decimator is not None and block.shape[1] > 0:
+                decimator.push(block)
+
+            if latchup == False or latchupCounter >= 1:
+
+                latchupCounter = 0
+                latchup = False
+
+                # detectors keep their state across blocks, each sample is searched once
+                trigger = detector.first_trigger(block) if block.shape[1] > 0 else None
+                if trigger is not None:
+                    x, i, chain = trigger
+                    # whole buffer in time order up to the newest sample, preSamples before the trigger
+                    history = np.roll(c[i], -writeIndex)
+                    position = num_samples - block.shape[1] + x
+                    pipe = handle_latch_up(digitalIO, sock, pipe, channels[i], history[max(0, position - preSamples):],
+                                           chain.level, f"{chain.spec} at {(lastWriteIndex + x) % num_samples}")
+                    latchup = True
+            else:
+                latchupCounter += 1
+                # samples during the power cycle are skipped, detectors restart with the next block
+                detector.reset()
 
-        beforeLastIndex = writeIndex - searchInt if writeIndex - searchInt >= 0 else num_samples - abs(writeIndex-searchInt)
-        lastWriteIndex = writeIndex
+            lastWriteIndex = writeIndex
 
-        # User has closed the window, finish.
-        if len(plt.get_fignums()) == 0:
-            break
+            # wait for new samples, returns early on shutdown
+            stop_requested.wait(pollInterval)
+
+    finally:
+        if decimator is not None:
+            decimator.ring.close()
+        analogIn.configure(False, False)  # stop acquisition
 
 
 def main():
@@ -307,20 +281,50 @@ def main():
                         help='Sample time. Has precedence over --freq. Defaults to 50mu')
     parser.add_argument('-r', '--range', default=5.0,
                         help='Oscis input range. Defaults to 5.0 V')
-    parser.add_argument('-l', '--diff', default=1.0,
-                        help='Valtage difference for trigger. Defaults to 1.0 V')
+    parser.add_argument('-c', '--channels', type=int, nargs='+',
+                        help='AnalogIn channels to monitor (1 = CH1). Defaults to all channels')
+    parser.add_argument('-o', '--overcurrent', type=float, nargs='+', default=[0.135],
+                        help='Over-current threshold per channel (one value for all). Defaults to 0.135 V')
+    parser.add_argument('-l', '--diff', type=float, nargs='+', default=[1.0],
+                        help='Valtage difference for trigger per channel (one value for all). Defaults to 1.0 V')
     parser.add_argument('-s', '--interval', default=1,
                         help='Find voltage difference within INTERVAL samples. Defaults to 1')
-    parser.add_argument('-p', '--polarity',
-                        help='Trigger on voltage increase (1) or decrease (2). If not provided, trigger on both.')
+    parser.add_argument('-p', '--polarity', type=int, choices=[1, 2],
+                        help='Voltage step (--diff) detector: trigger on increase (1) or decrease (2). If not provided, trigger on both.')
+    parser.add_argument('-d', '--detector', action='append',
+                        help='Detector spec (see latchup_detectors.py), several trigger on any. '
+                             'Defaults to over-current (--overcurrent) or voltage step (--diff, --interval)')
+    parser.add_argument('--pre-samples', type=int, default=1000,
+                        help='Samples before the trigger sent with the waveform. Defaults to 1000')
+    parser.add_argument('--ring', default=CHECKER_RING,
+                        help='Shared memory ring of decimated samples, read by the run controller (per-step current) '
+                             f'and latchup_viewer.py. Defaults to {CHECKER_RING}')
+    parser.add_argument('--no-ring', action='store_true',
+                        help='Do not publish decimated samples')
+    parser.add_argument('--ring-seconds', type=float, default=60.0,
+                        help='Seconds of samples kept in the ring. Defaults to 60')
+    parser.add_argument('--ring-decimation', type=int, default=20,
+                        help='Samples per ring frame (min/max/mean/mean square). Defaults to 20')
+    parser.add_argument('--poll', type=float, default=0.01,
+                        help='Seconds between acquisitions. Defaults to 0.01')
 
     args = parser.parse_args()
 
     samplingFreq = float(args.freq) if args.time == None else 1/args.time
     inputRange = float(args.range)
-    minDiff = float(args.diff)
-    polarityDiff = int(args.polarity) if args.polarity != None else None
+    channels = None if args.channels is None else tuple(c - 1 for c in args.channels)
+    for name, values in (("--overcurrent", args.overcurrent), ("--diff", args.diff)):
+        if len(values) != 1 and (channels is None or len(values) != len(channels)):
+            parser.error(f"{name} needs one value or one per channel given with --channels")
     searchInt = int(args.interval)
+    detector_specs = args.detector or [
+        f"over:threshold={'/'.join(str(v) for v in args.overcurrent)}",
+        f"absdiff:threshold={'/'.join(str(v) for v in args.diff)},interval={searchInt},polarity={args.polarity or 0}",
+    ]
+    detector = make_detectors(detector_specs, samplingFreq)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
 
     try:
         with openDwfDevice(DwfLibrary(), score_func=lambda c : c[DwfEnumConfigInfo.AnalogInBufferSize]) as device:
@@ -393,12 +397,15 @@ def main():
                 digitalIO,
                 samplingFreq,
                 inputRange,
-                minDiff,
-                polarityDiff,
-                searchInt,
+                detector,
+                args.pre_samples,
                 pipe,
                 t,
-                s
+                s,
+                channels=channels,
+                ring=None if args.no_ring else (args.ring, args.ring_seconds),
+                ringDecimation=args.ring_decimation,
+                pollInterval=args.poll,
             )
 
     except PyDwfError as exception:
@@ -0,0 +1,373 @@
+#! /usr/bin/env python3
+"""Streaming latch-up detectors: NumPy filters on channels × samples blocks with state carried across blocks
+
+A detector is a chain of stages: optional filters (block in, block out) followed by one
+trigger stage (block in, boolean block out). Chains are built from spec strings,
+stages separated by "|", parameters as key=value, per-channel values separated by "/":
+
+    over:threshold=0.135                               level (over-current)
+    absdiff:threshold=1.0,interval=1,polarity=0        |x[n] - x[n - interval]| step (legacy checker rule),
+                                                       polarity 1: increase only, 2: decrease only
+    baseline:window=2000 | over:threshold=0.05         level above the moving average of the previous samples
+    hysteresis:high=0.15/0.3,low=0.1/0.2,hold=20       dual threshold, on for at least hold samples
+    cusum:drift=0.005,threshold=0.5                    upward CUSUM against the (learned) baseline level
+    slope:window=50,threshold=20                       least-squares slope over window samples (V/s)
+
+Offline replay of recorded latch-ups (detection rate, latency vs. a reference detector, throughput)
+and of background recordings (.npy, false triggers):
+$ ./latchup_detectors.py ../run_042/latch_data.pkl --detector "baseline:window=500 | hysteresis:high=0.1,low=0.05,hold=5"
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _channel_param(value):
+    """Parameter as channels × 1 column, broadcasts against channels × samples blocks"""
+    return np.asarray(value, dtype=float).reshape(-1, 1)
+
+
+class _History:
+    """Last n samples of each channel, initialized with the first sample (edge padding)"""
+    def __init__(self, n):
+        self.n = n
+        self.data = None
+
+    def reset(self):
+        self.data = None
+
+    def extend(self, block):
+        """Block with the carried history prepended, keeps the new history"""
+        if self.data is None:
+            self.data = np.repeat(block[:, :1], self.n, axis=1)
+        extended = np.concatenate([self.data, block], axis=1)
+        self.data = extended[:, extended.shape[1] - self.n:]
+        return extended
+
+
+class OverCurrent:
+    name = "over"
+    is_filter = False
+    level = True  # level detectors use the over-current reaction of the checker
+
+    def __init__(self, threshold=0.135):
+        self.threshold = _channel_param(threshold)
+
+    def reset(self):
+        pass
+
+    def process(self, block):
+        return block >= self.threshold
+
+
+class AbsDiff:
+    name = "absdiff"
+    is_filter = False
+    level = False
+
+    def __init__(self, threshold=1.0, interval=1, polarity=0):
+        self.threshold = _channel_param(threshold)
+        self.interval = int(interval)
+        self.polarity = int(polarity)
+        assert self.polarity in (0, 1, 2), "absdiff polarity is 0 (both), 1 (increase) or 2 (decrease)"
+        self._history = _History(self.interval)
+
+    def reset(self):
+        self._history.reset()
+
+    def process(self, block):
+        extended = self._history.extend(block)
+        diff = extended[:, self.interval:] - extended[:, :-self.interval]
+        if self.polarity == 1:
+            return diff > self.threshold
+        if self.polarity == 2:
+            return -diff > self.threshold
+        return np.abs(diff) > self.threshold
+
+
+class MovingAverageBaseline:
+    """Filter: signal minus the mean of the previous window samples"""
+    name = "baseline"
+    is_filter = True
+
+    def __init__(self, window=1000):
+        self.window = int(window)
+        self._history = _History(self.window)
+
+    def reset(self):
+        self._history.reset()
+
+    def process(self, block):
+        extended = self._history.extend(block)
+        cumsum = np.concatenate([np.zeros((block.shape[0], 1)), np.cumsum(extended, axis=1)], axis=1)
+        n = block.shape[1]
+        baseline = (cumsum[:, self.window:self.window + n] - cumsum[:, :n]) / self.window
+        return block - baseline
+
+
+class Slope:
+    """Least-squares slope (V/s) over the last window samples, triggers above threshold (below if negative)"""
+    name = "slope"
+    is_filter = False
+    level = False
+
+    def __init__(self, threshold=10.0, window=20, sample_rate=20000.0):
+        self.threshold = _channel_param(threshold)
+        self.window = int(window)
+        assert self.window >= 2, "Slope window needs at least 2 samples"
+        t = np.arange(self.window) - (self.window - 1) / 2
+        self._weights = t / np.sum(t**2) * sample_rate
+        self._history = _History(self.window - 1)
+
+    def reset(self):
+        self._history.reset()
+
+    def process(self, block):
+        slope = sliding_window_view(self._history.extend(block), self.window, axis=1) @ self._weights
+        return np.where(self.threshold >= 0, slope > self.threshold, slope < self.threshold)
+
+
+class Cusum:
+    """One-sided upward CUSUM S = max(0, S + x - target - drift), triggers when S > threshold
+
+    Without target, the mean of the first learn samples after reset() is the baseline level (no triggers meanwhile).
+    The recursion is evaluated per block in closed form: S_n = C_n - min(-S_0, min_k<=n C_k), C = cumsum.
+    """
+    name = "cusum"
+    is_filter = False
+    level = False
+
+    def __init__(self, threshold=0.5, drift=0.005, target=None, learn=1000):
+        self.threshold = _channel_param(threshold)
+        self.drift = _channel_param(drift)
+        self.target = None if target is None else _channel_param(target)
+        self.learn = int(learn)
+        self.reset()
+
+    def reset(self):
+        self._sum = 0.0
+        self._count = 0
+        self._s = None
+
+    def process(self, block):
+        triggers = np.zeros(block.shape, dtype=bool)
+        target = self.target
+        if target is None:
+            n_learn = min(self.learn - self._count, block.shape[1])
+            self._sum = self._sum + block[:, :n_learn].sum(axis=1, keepdims=True)
+            self._count += n_learn
+            if self._count < self.learn:
+                return triggers
+            target = self._sum / self._count
+            block = block[:, n_learn:]
+        if self._s is None:
+            self._s = np.zeros((block.shape[0], 1))
+        c = np.cumsum(block - target - self.drift, axis=1)
+        s = c - np.minimum(np.minimum.accumulate(c, axis=1), -self._s)
+        if s.shape[1]:
+            self._s = s[:, -1:]
+        triggers[:, triggers.shape[1] - block.shape[1]:] = s > self.threshold
+        return triggers
+
+
+class Hysteresis:
+    """Dual threshold: on at or above high, off at or below low, triggers once on for hold samples"""
+    name = "hysteresis"
+    is_filter = False
+    level = True
+
+    def __init__(self, high=0.135, low=0.1, hold=1):
+        self.high = _channel_param(high)
+        self.low = _channel_param(low)
+        assert np.all(self.low < self.high), "Hysteresis needs low < high"
+        self.hold = int(hold)
+        self.reset()
+
+    def reset(self):
+        self._on = None      # state at the end of the last block
+        self._run = None     # samples on at the end of the last block
+
+    def process(self, block):
+        n_channels, n = block.shape
+        if self._on is None:
+            self._on = np.zeros((n_channels, 1), dtype=bool)
+            self._run = np.zeros((n_channels, 1), dtype=int)
+        index = np.broadcast_to(np.arange(n), block.shape)
+        # state changes where a threshold is crossed, otherwise the last state is kept
+        switch = np.where(block >= self.high, 1, np.where(block <= self.low, 0, -1))
+        last_switch = np.maximum.accumulate(np.where(switch >= 0, index, -1), axis=1)
+        on = np.where(last_switch >= 0, np.take_along_axis(switch, np.maximum(last_switch, 0), axis=1) == 1, self._on)
+        # length of the current on-run, continuing the one of the last block
+        previous = np.concatenate([self._on, on[:, :-1]], axis=1)
+        run_start = np.maximum.accumulate(np.where(on & ~previous, index, -1), axis=1)
+        run = np.where(on, np.where(run_start >= 0, index - run_start + 1, index + 1 + self._run), 0)
+        self._on = on[:, -1:]
+        self._run = run[:, -1:]
+        return run >= self.hold
+
+
+STAGES = {cls.name: cls for cls in (OverCurrent, AbsDiff, MovingAverageBaseline, Slope, Cusum, Hysteresis)}
+
+
+class Chain:
+    """Filters followed by one trigger stage"""
+    def __init__(self, stages, spec=""):
+        assert stages and not stages[-1].is_filter, f"Detector '{spec}' must end with a trigger stage"
+        assert all(s.is_filter for s in stages[:-1]), f"Only filters may precede the trigger stage in '{spec}'"
+        self.stages = stages
+        self.spec = spec
+        self.level = stages[-1].level
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, block):
+        for stage in self.stages:
+            block = stage.process(block)
+        return block
+
+
+def make_detector(spec, sample_rate=20000.0):
+    """Chain from a spec string like "baseline:window=2000 | over:threshold=0.05/0.1" """
+    stages = []
+    for stage_spec in spec.split("|"):
+        name, _, params = stage_spec.strip().partition(":")
+        assert name in STAGES, f"Unknown detector stage '{name}', choose from {', '.join(STAGES)}"
+        kwargs = {}
+        for param in filter(None, (p.strip() for p in params.split(","))):
+            key, _, value = param.partition("=")
+            values = [float(v) for v in value.split("/")]
+            kwargs[key.strip()] = values[0] if len(values) == 1 else values
+        if STAGES[name] is Slope:
+            kwargs.setdefault("sample_rate", sample_rate)
+        stages.append(STAGES[name](**kwargs))
+    return Chain(stages, spec)
+
+
+class AnyOf:
+    """Several detectors, all are fed every block (their state stays current)"""
+    def __init__(self, detectors):
+        self.detectors = detectors
+
+    def reset(self):
+        for detector in self.detectors:
+            detector.reset()
+
+    def first_trigger(self, block):
+        """(sample, channel, detector) of the earliest trigger in the block or None
+
+        At the same sample, earlier detectors have precedence, then lower channels.
+        """
+        first = None
+        for i, detector in enumerate(self.detectors):
+            triggers = detector.process(block)
+            hit = triggers.any(axis=0)
+            if hit.any():
+                x = int(hit.argmax())
+                if first is None or x < first[0]:
+                    first = (x, int(triggers[:, x].argmax()), detector)
+        return first
+
+
+def make_detectors(specs, sample_rate=20000.0):
+    return AnyOf([make_detector(spec, sample_rate) for spec in specs])
+
+
+LEGACY_SPECS = ["over:threshold=0.135", "absdiff:threshold=1.0,interval=1"]
+
+
+def _events(path):
+    """(channel, waveform) of all latch-ups in a latch_data.pkl"""
+    import pandas as pd
+    df = pd.read_pickle(path)
+    events = []
+    for i, key in enumerate(df.columns):
+        waveform = df.iloc[:, i].to_numpy(dtype=float)
+        match = re.search(r"_ch(\d+)", str(key))
+        events.append((0 if match is None else int(match.group(1)), waveform[~np.isnan(waveform)]))
+    return events
+
+
+def _first_trigger_sample(detectors, block_size, channel, waveform, n_channels):
+    """Feeds the waveform block by block (in its channel row), sample index of the first trigger or None"""
+    detectors.reset()
+    padded = np.zeros((n_channels, len(waveform)))
+    padded[channel] = waveform
+    for start in range(0, len(waveform), block_size):
+        trigger = detectors.first_trigger(padded[:, start:start + block_size])
+        if trigger is not None and trigger[1] == channel:
+            return start + trigger[0]
+    return None
+
+
+def replay(detector_specs, reference_specs, paths, block_size=1000, sample_rate=20000.0):
+    """Detection rate and latency on recorded latch-ups (.pkl), false triggers on background recordings (.npy)"""
+    detectors = make_detectors(detector_specs, sample_rate)
+    reference = make_detectors(reference_specs, sample_rate)
+
+    events = [e for path in paths if not path.endswith(".npy") for e in _events(path)]
+    n_channels = max([channel + 1 for channel, _ in events], default=1)
+    detected = 0
+    latencies = []
+    reference_missed = 0
+    n_samples = 0
+    cpu_time = 0.0
+    for channel, waveform in events:
+        t_start = time.process_time()
+        t_detect = _first_trigger_sample(detectors, block_size, channel, waveform, n_channels)
+        cpu_time += time.process_time() - t_start
+        n_samples += len(waveform)
+        t_reference = _first_trigger_sample(reference, block_size, channel, waveform, n_channels)
+        detected += t_detect is not None
+        if t_reference is None:
+            reference_missed += 1
+        elif t_detect is not None:
+            latencies.append((t_detect - t_reference) / sample_rate * 1e3)
+
+    print(f"Detector: {' OR '.join(detector_specs)}")
+    print(f"Reference: {' OR '.join(reference_specs)}")
+    if events:
+        print(f"Latch-ups detected: {detected} / {len(events)} ({detected / len(events) * 100:.1f} %), "
+              f"reference detector missed {reference_missed}")
+    if latencies:
+        latencies = np.array(latencies)
+        print(f"Latency vs. reference (ms): mean={latencies.mean():.3f}, p50={np.percentile(latencies, 50):.3f}, "
+              f"p90={np.percentile(latencies, 90):.3f}, min={latencies.min():.3f}, max={latencies.max():.3f}")
+
+    # background recordings: every trigger is false, the detector restarts after each like in the checker
+    for path in (p for p in paths if p.endswith(".npy")):
+        background = np.atleast_2d(np.load(path))
+        detectors.reset()
+        false_triggers = 0
+        t_start = time.process_time()
+        for start in range(0, background.shape[1], block_size):
+            if detectors.first_trigger(background[:, start:start + block_size]) is not None:
+                false_triggers += 1
+                detectors.reset()
+        cpu_time += time.process_time() - t_start
+        n_samples += background.size
+        minutes = background.shape[1] / sample_rate / 60
+        print(f"{path}: {false_triggers} false triggers in {minutes:.1f} min ({false_triggers / minutes:.2f} / min)")
+
+    if cpu_time > 0:
+        print(f"Throughput: {n_samples / cpu_time / 1e6:.2f} MS/s (needed per channel: {sample_rate / 1e6:.3f} MS/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded waveforms through latch-up detectors")
+    parser.add_argument("files", nargs="+", help="latch_data.pkl files (latch-ups) and/or .npy background recordings (channels × samples)")
+    parser.add_argument("-d", "--detector", action="append", help="detector spec, several trigger on any (default: legacy checker rule)")
+    parser.add_argument("--reference", action="append", help="reference detector for latencies (default: legacy checker rule)")
+    parser.add_argument("-b", "--block-size", type=int, default=1000, help="samples per acquisition block")
+    parser.add_argument("-f", "--freq", type=float, default=20000, help="sampling frequency")
+    args = parser.parse_args()
+
+    replay(args.detector or LEGACY_SPECS, args.reference or LEGACY_SPECS, args.files, args.block_size, args.freq)
+
+
+if __name__ == "__main__":
+    main()
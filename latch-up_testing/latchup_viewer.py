@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+# Live view of the latch-up checker signals, runs as a separate process:
+# $ ./latchup_checker_MINIMAL.py &
+# $ ./latchup_viewer.py
+# The checker publishes decimated frames (min/max/mean) to a shared memory ring, the viewer only reads it,
+# closing or restarting the viewer does not affect the acquisition.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.animation import FuncAnimation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from microbeam.microbeam_shm_ring import ShmRing, RING_FIELDS, CHECKER_RING  # noqa: E402
+
+MIN, MAX = RING_FIELDS.index("min"), RING_FIELDS.index("max")
+
+
+def attach(name):
+    """Waits until the checker has created the ring"""
+    while True:
+        try:
+            return ShmRing.attach(name)
+        except FileNotFoundError:
+            print(f"Waiting for ring '{name}' (checker running without --no-ring?)...")
+            time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live view of the latch-up checker signals")
+    parser.add_argument("--ring", default=CHECKER_RING, help=f"shared memory ring name. Defaults to {CHECKER_RING}")
+    parser.add_argument("--seconds", type=float, default=10.0, help="time window. Defaults to 10 s")
+    parser.add_argument("--interval", type=int, default=200, help="refresh interval (ms). Defaults to 200")
+    parser.add_argument("--range", type=float, default=None, help="fixed y range ±RANGE (V), autoscale otherwise")
+    args = parser.parse_args()
+
+    ring = attach(args.ring)
+
+    fig, ax = plt.subplots()
+    ax.set_xlabel("time (s)")
+    ax.set_ylabel("signals [V]")
+    ax.grid(visible=True)
+    if args.range is not None:
+        ax.set_ylim(-args.range, args.range)
+    lines = []
+
+    def setup_lines():
+        for line in lines:
+            line.remove()
+        lines.clear()
+        for channel in range(ring.channels):
+            # min/max envelope of each decimation bin, drawn as one line (min, max, min, ...)
+            lines.extend(ax.plot([], [], linewidth=0.8, label=f"CH{channel + 1}"))
+        ax.legend(loc="upper left")
+        ax.set_xlim(-args.seconds, 0)
+
+    setup_lines()
+
+    def update(_):
+        nonlocal ring
+        if ring.closed:
+            ring.close()
+            ring = attach(args.ring)
+            setup_lines()
+        n_frames = int(args.seconds * ring.frame_rate)
+        sequence, frames = ring.latest(n_frames)
+        t = (np.arange(len(frames)) - len(frames)) / ring.frame_rate  # newest frame at 0
+        for channel, line in enumerate(lines):
+            line.set_data(np.repeat(t, 2), frames[:, channel, [MIN, MAX]].ravel())
+        if args.range is None and len(frames):
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+        ax.set_title(f"ring '{args.ring}': {ring.frame_rate:g} frames/s, {sequence} frames")
+        return lines
+
+    animation = FuncAnimation(fig, update, interval=args.interval, cache_frame_data=False)  # noqa: F841
+    plt.show()
+    ring.close()
+
+
+if __name__ == "__main__":
+    main()
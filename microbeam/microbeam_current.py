@@ -0,0 +1,150 @@
+"""DUT supply current per scan step, read from the latch-up checker's shared memory ring"""
+import os
+import time
+
+import numpy as np
+
+from .microbeam_shm_ring import ShmRing, CHECKER_RING, RING_FIELDS
+
+STEP_CURRENT_HEADER = "step,x_lsb,y_lsb,hits,channel,frames,mean,max,std\n"
+_MAX, _MEAN, _MEAN_SQ = (RING_FIELDS.index(f) for f in ("max", "mean", "mean_sq"))
+
+
+class StepCurrentLog:
+    """step_current.csv of a run, opened with the first rows (written with its header first) and kept open
+
+    Rows are buffered by the file until flush(), all methods are meant for the run controller's I/O thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def write(self, rows):
+        """Appends rows (tuples in STEP_CURRENT_HEADER order)"""
+        if self._fd is None:
+            new_file = not os.path.exists(self.path)
+            self._fd = open(self.path, "a")
+            if new_file:
+                self._fd.write(STEP_CURRENT_HEADER)
+        self._fd.writelines(",".join(f"{v:.6g}" if isinstance(v, float) else str(v) for v in row) + "\n" for row in rows)
+
+    def flush(self):
+        if self._fd is not None:
+            self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+def truncate_step_current(path, next_step):
+    """Drops the rows of steps from next_step on (resumed runs repeat them)"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as fd:
+        lines = fd.readlines()
+    kept = lines[:1] + [line for line in lines[1:] if int(line.split(",", 1)[0]) < next_step]
+    with open(path, "w") as fd:
+        fd.writelines(kept)
+
+
+class StepCurrentMonitor:
+    """Mean, max and std of the checker channels during each scan step
+
+    The checker ring is attached when available (and re-attached after a checker restart),
+    without a checker the steps have no current data. A killed checker never closes its ring:
+    once no frames arrived for stall_timeout (s), the segment name is checked for a new checker.
+    Frames are reduced where they are in shared memory, polling often enough keeps up with
+    rings shorter than a step.
+    """
+    def __init__(self, logger, ring_name=CHECKER_RING):
+        self._logger = logger
+        self.ring_name = ring_name  # None => disabled
+        self.ring = None
+        self.stall_timeout = 1.0
+        self._stall_check = 0.0  # time of the next check for a replaced ring
+        self._next = 0
+        self._in_step = False
+        self._sums = None  # frames, sum of means, sum of mean squares, max; per channel
+        self.dropped_frames = 0
+
+    def _attach(self):
+        if self.ring is not None and not self.ring.closed and not self._stalled_and_replaced():
+            return True
+        if self.ring is not None:
+            if self.ring.closed:
+                self._logger.info("Current ring '%s' closed by the checker.", self.ring_name)
+            else:
+                self._logger.warning("Current ring '%s' of checker pid %d was replaced by a new checker "
+                                     "(the old one was killed), re-attaching.", self.ring_name, self.ring.writer_pid)
+            self.ring.close()
+            self.ring = None
+        if self.ring_name is None:
+            return False
+        try:
+            self.ring = ShmRing.attach(self.ring_name)
+        except FileNotFoundError:
+            return False
+        assert self.ring.fields == len(RING_FIELDS), f"ring '{self.ring_name}' has unknown fields"
+        self._logger.info("Current ring '%s' attached: %d channels at %g frames/s.",
+                          self.ring_name, self.ring.channels, self.ring.frame_rate)
+        # a step in progress continues with the frames of the new ring
+        self._next = self.ring.sequence
+        self._stall_check = time.monotonic() + self.stall_timeout
+        self._reset_sums()
+        return True
+
+    def _stalled_and_replaced(self):
+        """No frames for stall_timeout and another checker owns the segment name now (checked once per stall_timeout)"""
+        now = time.monotonic()
+        if self.ring.sequence != self._next:
+            self._stall_check = now + self.stall_timeout
+            return False
+        if now < self._stall_check:
+            return False
+        self._stall_check = now + self.stall_timeout
+        return self.ring.replaced()
+
+    def _reset_sums(self):
+        self._sums = np.zeros((4, self.ring.channels))
+        self._sums[3] = -np.inf
+
+    def start_step(self):
+        self._in_step = True
+        if self._attach():
+            self._next = self.ring.sequence
+            self._reset_sums()
+
+    def poll(self):
+        """Adds the frames written since the last poll to the step"""
+        if not self._in_step or not self._attach():
+            return
+        start, sequence, views = self.ring.views(self._next)
+        for frames in views:
+            self._sums[0] += len(frames)
+            self._sums[1] += frames[:, :, _MEAN].sum(axis=0)
+            self._sums[2] += frames[:, :, _MEAN_SQ].sum(axis=0)
+            np.maximum(self._sums[3], frames[:, :, _MAX].max(axis=0), out=self._sums[3])
+        dropped = start - self._next + self.ring.overwritten(start)
+        if dropped > 0:
+            self.dropped_frames += dropped
+            self._logger.warning("Current ring: %d frames lost (poll more often or make the ring longer).", dropped)
+        self._next = sequence
+
+    def finish_step(self):
+        """(channel, frames, mean, max, std) per channel of the step, empty without checker data"""
+        self.poll()
+        self._in_step = False
+        if self.ring is None or self._sums[0, 0] == 0:
+            return []
+        n, total, total_sq, peak = self._sums
+        mean = total / n
+        std = np.sqrt(np.maximum(total_sq / n - mean**2, 0))
+        return [(channel, int(n[channel]), float(mean[channel]), float(peak[channel]), float(std[channel]))
+                for channel in range(len(n))]
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
@@ -0,0 +1,64 @@
+"""Beam interface backends: what the run controller uses of the hardware, implementations are imported on selection"""
+import abc
+import importlib
+
+# mode -> module, class and constructor arguments, only the selected module is imported
+# (the hardware backend imports the Pi libraries only in init_hw())
+INTERFACE_BACKENDS = {
+    "rpi": (".microbeam_interface_rpi", "MicrobeamInterfaceRpi", {"simulate": False}),
+    "simulate": (".microbeam_interface_rpi", "MicrobeamInterfaceRpi", {"simulate": True}),
+    "replay": (".microbeam_replay", "MicrobeamInterfaceReplay", {}),  # needs run_path (and speed)
+}
+
+
+class MicrobeamInterface(abc.ABC):
+    """Interface of beam control backends to the run controller
+
+    The run controller sets _run_ctrl and metrics, reads the attributes _simulate (open and close
+    the shutter around each step itself), min_hit_delay (s between polls of a step) and
+    shutters_left (set to 0 to stop a step), and calls the methods below. A backend missing
+    one of the abstract methods fails when it is constructed.
+    """
+    @abc.abstractmethod
+    async def init_hw(self, **options):
+        """Connects the hardware (or loads the recording), called once before any other method"""
+
+    @abc.abstractmethod
+    async def close_hw(self):
+        """Releases the hardware and stops background emitters, called once at shutdown"""
+
+    @abc.abstractmethod
+    async def prepare_run(self, hits_per_shutter=1):
+        """Sets up hit gating before the scan loop of a run starts (hits_per_step is already set)"""
+
+    @abc.abstractmethod
+    async def deliver_hits(self, hits_per_step=None, enable=True):
+        """Starts the hits of a step at the current position (hits_per_step given), enable=False stops them"""
+
+    @abc.abstractmethod
+    async def read_hits(self):
+        """Waits for the next hits, returns timestamp (µs), number of hits, x and y"""
+
+    @abc.abstractmethod
+    async def write_dac(self, x, y):
+        """Moves the beam to x, y (LSB), the next hits are reported at this position"""
+
+    @abc.abstractmethod
+    async def open_shutter(self):
+        """Lets the beam through, hits are only delivered with the shutter open"""
+
+    @abc.abstractmethod
+    async def close_shutter(self):
+        """Blocks the beam, pending hits of the step are dropped"""
+
+    def read_latch_data(self):
+        """Latch-up FIFO data injected by the backend itself (polled every min_hit_delay), None if there is none"""
+        return None
+
+
+def make_interface(mode, logger, **kwargs):
+    """Backend instance for mode (see INTERFACE_BACKENDS), kwargs are passed to its constructor"""
+    assert mode in INTERFACE_BACKENDS, f"unknown interface mode {mode}, one of {', '.join(INTERFACE_BACKENDS)}"
+    module_name, class_name, defaults = INTERFACE_BACKENDS[mode]
+    backend = getattr(importlib.import_module(module_name, __package__), class_name)
+    return backend(logger, **{**defaults, **kwargs})
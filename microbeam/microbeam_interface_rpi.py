@@ -1,18 +1,20 @@
 import asyncio
 #import uvloop
 #asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-import asyncpio as apio #pip install git+https://github.com/spthm/asyncpio.git
 import time
 import random
-from .microbeam_run_controller import RunState
+from .microbeam_interface import MicrobeamInterface
+from .microbeam_metrics import StepMetrics
 import numpy as np
 
-class MicrobeamInterfaceRpi:
+class MicrobeamInterfaceRpi(MicrobeamInterface):
+    """Raspberry Pi GPIOs (trigger, shutter) and SPI DAC through pigpiod, or random grid hits with simulate=True"""
     def __init__(self, logger, simulate=False):
         self._logger    = logger
         self._simulate = simulate
 
         self._run_ctrl = None   # will be set in init() of run controller
+        self.metrics = StepMetrics()  # replaced by the metrics of the run controller
 
         self.x =0
         self.y =0
@@ -91,6 +93,9 @@ class MicrobeamInterfaceRpi:
         if self._simulate:
             self.init_time = time.time()
         else:
+            # only needed for the hardware, simulate mode runs without the Pi libraries
+            import asyncpio as apio #pip install git+https://github.com/spthm/asyncpio.git
+
             # init hardware pins
             self.pi = apio.pi()
             await self.pi.connect(pigpio_host)
@@ -105,12 +110,12 @@ class MicrobeamInterfaceRpi:
 
             self.spi = await self.pi.spi_open(0,1300000,1)
             await self.pi.set_mode(self.ldac, apio.OUTPUT)
-            self._logger.info(f"HW initialized")
+            self._logger.info("HW initialized")
 
     async def prepare_run(self, hits_per_shutter=1):
         if self._simulate is False:
             if hits_per_shutter > self._run_ctrl.hits_per_step:
-                self._logger.warning(f"Requested hits_per_shutter ({hits_per_shutter}) > hits_per_step ({self._run_ctrl.hits_per_step}), reduced!")
+                self._logger.warning("Requested hits_per_shutter (%d) > hits_per_step (%d), reduced!", hits_per_shutter, self._run_ctrl.hits_per_step)
                 hits_per_shutter = self._run_ctrl.hits_per_step
             
             if hits_per_shutter <= 1:
@@ -124,7 +129,7 @@ class MicrobeamInterfaceRpi:
         
     async def simulate_hit(self):
         rand_sleep = random.gauss(mu=0.001, sigma=0.0001)
-        self._logger.debug(f"Simulating hit in {rand_sleep:_.03f} s...")
+        self._logger.debug("Simulating hit in %.3f s...", rand_sleep)
         await asyncio.sleep(rand_sleep)
         if self.shutter_closed is False:
             mu = 10     # grid wire spacing
@@ -133,7 +138,7 @@ class MicrobeamInterfaceRpi:
             ymod = np.random.normal(loc=mu, scale=sigma, size=1).astype(int) #round(random.gauss(mu, sigma))
             if bool(np.mod(self.x, xmod) == 0) is not bool(np.mod(self.y, ymod) == 0):
                 # simulate regular grid structure
-                self._logger.info(f"Simulated hit at x={self.x} % {xmod}, y={self.y} % {ymod}!")
+                self._logger.info("Simulated hit at x=%s %% %s, y=%s %% %s!", self.x, xmod, self.y, ymod)
                 tick = (time.time() - self.init_time) * 1e6
                 await self._trigger_cb(self.trigger, tick)
 
@@ -144,7 +149,7 @@ class MicrobeamInterfaceRpi:
         self.hits_per_shutter_event.set()          
 
     async def read_hits(self):  
-        self._logger.debug(f"Waiting for hits...")
+        self._logger.debug("Waiting for hits...")
         await self.hits_per_shutter_event.wait()
         
         #await self.pi.wait_for_event(self.trigger, 60*60) # this only triggers once, why?
@@ -169,20 +174,22 @@ class MicrobeamInterfaceRpi:
             if self._simulate is True:
                 await self.simulate_hit()
             else:
+                t = self.metrics.mark()
                 while hits_delivered == False:
                     (s,par) = await self.pi.script_status(self.pigpio_script)
                     if s == 1: # PI_SCRIPT_HALTED
                         await self.pi.run_script(self.pigpio_script)
                         hits_delivered = True
                     elif s == -48: # script already deleted:
-                        self._logger.warning(f"Script already deleted!")
+                        self._logger.warning("Script already deleted!")
                         break
                     else:                    
-                        self._logger.debug(f"Script not halted, status {'RUNNING' if (s == 2) else s}, waiting again...")
+                        self._logger.debug("Script not halted, status %s, waiting again...", 'RUNNING' if (s == 2) else s)
                         hits_delivered = True                        
                         #FIXME: this is a problem if time timeout occured before
                         await asyncio.sleep(self.min_hit_delay)
                         #await self.pi.run_script(self.pigpio_script)
+                self.metrics.observe("iface_run_script", t)
         else: # cheap shutdown action
             if self.pigpio_script is not None:
                 await self.pi.delete_script(self.pigpio_script)
@@ -194,10 +201,12 @@ class MicrobeamInterfaceRpi:
         #await self._lower.write([x & 0xff, (x >> 8) & 0xff, y & 0xff, (y >> 8) & 0xff])
         #await self._lower.flush()
         if self._simulate is False:
+            t = self.metrics.mark()
             await self.pi.write(self.ldac,1)
             await self.pi.spi_write(self.spi,[0b00010000, (x >> 8) & 0xff, x & 0xff]) # DAC A = X
             await self.pi.spi_write(self.spi,[0b00010001, (y >> 8) & 0xff, y & 0xff]) # DAC B = Y
             await self.pi.write(self.ldac,0) # latch x and y outputs at the same time
+            self.metrics.observe("iface_spi_write", t)
         self.x = x
         self.y = y
 
@@ -205,13 +214,18 @@ class MicrobeamInterfaceRpi:
         self.shutter_closed = True
         if not self._simulate:
             await self.pi.write(self.shutter,int(not self.SHUTTER_OPEN))
-        self._logger.debug(f"Shutter closed")
+        self._logger.debug("Shutter closed")
 
     async def open_shutter(self):
         if not self._simulate:
             await self.pi.write(self.shutter,int(self.SHUTTER_OPEN))
         self.shutter_closed = False
-        self._logger.debug(f"Shutter opened")
+        self._logger.debug("Shutter opened")
+
+    def read_latch_data(self):
+        """Latch-up waveform injected by the interface itself (raw float64 bytes), None if there is none"""
+        # real latch-ups arrive through the FIFO of the run controller
+        return None
 
     async def set_shutter_override(self, enable):
         # skipped as there is no Glasgow FPGA logic that would control the shutter
@@ -224,7 +238,7 @@ class MicrobeamInterfaceRpi:
                 await self.pi.delete_script(self.pigpio_script)
                 self.pigpio_script = None
             await self.pi.stop()
-            self._logger.info(f"HW closed. In total logged {self._run_ctrl.hit_count} hits.")
+            self._logger.info("HW closed. In total logged %d hits.", self._run_ctrl.hit_count)
 
 
 
@@ -0,0 +1,146 @@
+"""Queue-based logging: formatting and file writes happen in a background thread, not in the event loop"""
+import queue
+import time
+import picologging as logging
+import picologging.handlers
+
+# active listener, set up by setup_queue_logging()
+_listener = None
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues the unformatted record, the listener thread does all formatting
+
+    NOTE: arguments are formatted later, don't pass objects that are modified right after the log call.
+    """
+    def prepare(self, record):
+        return record
+
+
+class _HandlerChange:
+    """Queue item adding or removing a listener handler in order with the log records"""
+    def __init__(self, handler, add):
+        self.handler = handler
+        self.add = add
+
+
+class RunLogListener(logging.handlers.QueueListener):
+    """Queue listener whose handlers may be added/removed while running (e.g. per-run log files)"""
+    def __init__(self, log_queue, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+
+    def add_handler(self, handler):
+        self.queue.put_nowait(_HandlerChange(handler, add=True))
+
+    def remove_handler(self, handler):
+        """Removes and closes the handler after all records queued before have been written"""
+        self.queue.put_nowait(_HandlerChange(handler, add=False))
+
+    def handle(self, record):
+        if isinstance(record, _HandlerChange):
+            if record.add:
+                self.handlers = self.handlers + (record.handler,)
+            else:
+                self.handlers = tuple(h for h in self.handlers if h is not record.handler)
+                record.handler.close()
+            return
+        super().handle(record)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message template for records up to INFO level
+
+    Repetitive per-step messages (same %-style template) are limited to `rate` records
+    per second with bursts of up to `burst` records, one-off messages and warnings always pass.
+    """
+    def __init__(self, rate, burst=10, max_level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self.suppressed = 0
+        self._buckets = {}  # template -> [tokens, last update]
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(record.msg)
+        if bucket is None:
+            bucket = self._buckets[record.msg] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+
+class SampleFilter(logging.Filter):
+    """Passes every n-th record up to INFO level, warnings and errors always pass"""
+    def __init__(self, every_n, max_level=logging.INFO):
+        super().__init__()
+        self.every_n = every_n
+        self.max_level = max_level
+        self._count = 0
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        self._count += 1
+        return self.every_n <= 1 or self._count % self.every_n == 1
+
+
+def setup_queue_logging(level=logging.INFO, log_file=None, log_format="%(created)f [%(levelname)s]  %(message)s",
+                        console=True, rate_limit=None, sample_every=None):
+    """Routes all records of the root logger through a queue to a background thread
+
+    rate_limit: max. records per second per message template (up to INFO level)
+    sample_every: only pass every n-th record (up to INFO level)
+    Returns the started listener, call stop() on it before exiting to flush all records.
+    """
+    global _listener
+
+    formatter = logging.Formatter(log_format)
+    handlers = []
+    if console:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        handlers.append(stream_handler)
+    if log_file is not None:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    if rate_limit is not None:
+        queue_handler.addFilter(RateLimitFilter(rate_limit))
+    if sample_every is not None:
+        queue_handler.addFilter(SampleFilter(sample_every))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = RunLogListener(log_queue, *handlers)
+    _listener.start()
+    return _listener
+
+
+def add_log_handler(handler):
+    """Attaches a handler to the logging queue if set up, otherwise directly to the root logger"""
+    if _listener is not None:
+        _listener.add_handler(handler)
+    else:
+        logging.getLogger().addHandler(handler)
+
+
+def remove_log_handler(handler):
+    """Detaches and closes a handler added with add_log_handler()"""
+    if _listener is not None:
+        _listener.remove_handler(handler)
+    else:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
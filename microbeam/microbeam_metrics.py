@@ -0,0 +1,194 @@
+"""Lightweight hot-path timing instrumentation of scan steps"""
+import asyncio
+import bisect
+import collections
+import time
+
+# histogram bucket upper bounds in seconds (1-2.5-5 series, 10 µs ... 50 s)
+BUCKETS = [m * 10.0**e for e in range(-5, 2) for m in (1.0, 2.5, 5.0)]
+
+
+class PhaseHistogram:
+    """Fixed-bucket histogram of phase durations"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last bucket: > BUCKETS[-1]
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bucket bound below which a fraction q of all observations lies"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class StepMetrics:
+    """Per-phase duration histograms, aggregated in memory
+
+    Usage in the hot path (costs one method call when disabled):
+        t = metrics.mark()
+        ... phase A ...
+        t = metrics.observe("phase_a", t)
+        ... phase B ...
+        metrics.observe("phase_b", t)
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = {}
+
+    def reset(self):
+        self.phases = {}
+
+    def mark(self):
+        if not self.enabled:
+            return 0.0
+        return time.perf_counter()
+
+    def observe(self, phase, t_start):
+        """Adds the time since t_start (from mark()) to the phase histogram, returns a new mark"""
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = PhaseHistogram()
+        hist.add(now - t_start)
+        return now
+
+    def summary_lines(self):
+        """Human-readable per-phase summary, e.g. for the run log"""
+        lines = [f"{'phase':<20} {'count':>8} {'total s':>10} {'mean ms':>10} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'max ms':>10}"]
+        for phase, hist in sorted(self.phases.items()):
+            lines.append(
+                f"{phase:<20} {hist.count:>8} {hist.sum:>10.3f} {hist.sum/hist.count*1e3:>10.3f} "
+                f"{hist.quantile(0.5)*1e3:>10.3f} {hist.quantile(0.9)*1e3:>10.3f} "
+                f"{hist.quantile(0.99)*1e3:>10.3f} {hist.max*1e3:>10.3f}"
+            )
+        return lines
+
+    def prometheus_lines(self, prefix="microbeam"):
+        """Histograms in Prometheus text exposition format"""
+        name = f"{prefix}_step_phase_seconds"
+        lines = [
+            f"# HELP {name} Time spent per scan step phase",
+            f"# TYPE {name} histogram",
+        ]
+        for phase, hist in sorted(self.phases.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hist.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{phase="{phase}",le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{phase="{phase}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{phase="{phase}"}} {hist.sum}')
+            lines.append(f'{name}_count{{phase="{phase}"}} {hist.count}')
+        return lines
+
+
+class HitRateEstimator:
+    """Online beam hit rate and step duration (EWMA over recent steps)
+
+    The rate is the ratio of smoothed hits and smoothed open shutter time of all steps, timed-out
+    ones included (for Poisson arrivals the ratio of sums stays unbiased, and the estimate follows
+    a dropping beam intensity). Steps with latch-ups are left out. The step duration includes all
+    steps and overheads and is used for the remaining run time.
+    """
+    def __init__(self, alpha=0.1, nominal_rate=25.0):
+        self.alpha = alpha
+        self.nominal_rate = nominal_rate  # hits/s until the first step has been measured
+        self._hits = None
+        self._shutter_time = None
+        self._step_duration = None
+
+    def add_step(self, hits, shutter_time, step_duration, usable=True):
+        """usable: False for steps cut short by a latch-up (aborted steps are not added at all)"""
+        a = self.alpha
+        if usable and shutter_time > 0:
+            if self._hits is None:
+                self._hits, self._shutter_time = hits, shutter_time
+            else:
+                self._hits = a * hits + (1 - a) * self._hits
+                self._shutter_time = a * shutter_time + (1 - a) * self._shutter_time
+        if self._step_duration is None:
+            self._step_duration = step_duration
+        else:
+            self._step_duration = a * step_duration + (1 - a) * self._step_duration
+
+    @property
+    def rate(self):
+        """Estimated hit rate (hits/s)"""
+        if self._hits is None:
+            return self.nominal_rate
+        # without any recent hits: at most one hit per smoothed shutter time, keeps timeouts finite
+        return max(self._hits, 1.0) / self._shutter_time
+
+    def expected_step_time(self, hits_per_step):
+        """Expected time to collect hits_per_step hits (s)"""
+        return hits_per_step / self.rate
+
+    def eta(self, remaining_points, hits_per_step):
+        """Expected remaining run time (s)"""
+        step_duration = self._step_duration if self._step_duration is not None else self.expected_step_time(hits_per_step)
+        return remaining_points * step_duration
+
+
+class LoopLagMonitor:
+    """Event loop lag: how late a task sleeping for interval seconds is woken up
+
+    Runs as a task on the loop it measures (run()), keeps the lags of the last window probes.
+    """
+    def __init__(self, interval=0.01, window=1000):
+        self.interval = interval
+        self.lags = collections.deque(maxlen=window)
+        self.max = 0.0  # since start
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - t - self.interval)
+            self.lags.append(lag)
+            if lag > self.max:
+                self.max = lag
+
+    def summary(self):
+        """Median, 99th percentile and max of the recent lags, max since start (s)"""
+        lags = sorted(self.lags)
+        if not lags:
+            return {"p50": 0.0, "p99": 0.0, "recent_max": 0.0, "max": self.max}
+        return {
+            "p50": lags[len(lags) // 2],
+            "p99": lags[min(len(lags) - 1, int(0.99 * len(lags)))],
+            "recent_max": lags[-1],
+            "max": self.max,
+        }
+
+    @staticmethod
+    def summary_prometheus_lines(summary, prefix="microbeam", loop="control"):
+        """Lag summary (also from another process) in Prometheus text exposition format"""
+        name = f"{prefix}_loop_lag_seconds"
+        return [
+            f"# HELP {name} Event loop wake-up lag, recent probes and max since start",
+            f"# TYPE {name} gauge",
+            f'{name}{{loop="{loop}",stat="p50"}} {summary["p50"]}',
+            f'{name}{{loop="{loop}",stat="p99"}} {summary["p99"]}',
+            f'{name}{{loop="{loop}",stat="recent_max"}} {summary["recent_max"]}',
+            f'{name}{{loop="{loop}",stat="max"}} {summary["max"]}',
+        ]
+
+    def prometheus_lines(self, prefix="microbeam", loop="control"):
+        return self.summary_prometheus_lines(self.summary(), prefix, loop)
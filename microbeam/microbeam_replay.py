@@ -0,0 +1,236 @@
+"""Replay of recorded runs through the run controller, TCP subscribers and web GUI
+
+The recorded scan plan is scanned again. Runs without scan_plan.csv or without the step column in
+hit_log.csv (older beam times) get a plan with one step per position change in the hit log.
+At every step, the backend re-emits the triggers recorded there with their original intervals
+divided by the speed factor (0: as fast as possible), and the latch-up waveforms of latch_data.pkl
+once the step has seen as many hits as when they occurred. The replayed run is logged as a new run.
+
+usage example:
+$ ./beam_control.py --mode replay --replay run_042 --replay-speed 10
+"""
+import asyncio
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .microbeam_interface_rpi import MicrobeamInterfaceRpi
+from .microbeam_scan_plan import PLAN_COLUMNS, PLAN_X, PLAN_Y, PLAN_REP, PLAN_SLEW, load_plan, save_plan, transition_slew
+from .microbeam_waveforms import pack_latch_message, parse_event_key, event_channel
+
+
+class RecordedRun:
+    """Scan plan, triggers and latch-ups of a recorded run, one entry of steps per plan row
+
+    Each step holds the delays (s, before each trigger, the first one after the shutter opened),
+    the hits per trigger and the latch-ups as (hits of the step before it, FIFO message).
+    """
+    def __init__(self, run_path):
+        import pandas as pd
+        self.run_path = run_path
+        hit_log = pd.read_csv(os.path.join(run_path, "hit_log.csv"))
+        xy = hit_log[["x_lsb", "y_lsb"]].to_numpy(dtype=np.int64)
+        plan_path = os.path.join(run_path, "scan_plan.csv")
+        if "step" in hit_log and os.path.exists(plan_path):
+            self.plan_file = plan_path
+            self.plan = load_plan(plan_path)
+            step_of_row = hit_log["step"].to_numpy(dtype=np.int64)
+        else:
+            # a new step wherever the position changes, steps without hits are not in the log
+            self.plan_file = None
+            step_of_row = np.concatenate([[0], np.cumsum(np.any(xy[1:] != xy[:-1], axis=1))]) if len(xy) else np.zeros(0, np.int64)
+            first_rows = np.flatnonzero(np.diff(step_of_row, prepend=-1))
+            self.plan = np.zeros((len(first_rows), len(PLAN_COLUMNS)), dtype=np.int64)
+            self.plan[:, [PLAN_X, PLAN_Y]] = xy[first_rows]
+            self.plan[:, PLAN_SLEW] = transition_slew(self.plan)
+
+        sys_ts = hit_log["sys_ts_sec"].to_numpy(dtype=float)
+        hits = hit_log["hits"].to_numpy(dtype=np.int64)
+        gaps = np.maximum(np.diff(sys_ts, prepend=sys_ts[:1]), 0)
+        new_step = np.diff(step_of_row, prepend=-1) != 0
+        # the gap before the first trigger of a step also contains the controller's own step overhead,
+        # which the replay produces live: the first trigger comes after the typical trigger interval
+        within = gaps[~new_step]
+        first_delay = float(np.median(within if len(within) else gaps[1:])) if len(gaps) > 1 else 0.0
+        delays = np.where(new_step, first_delay, gaps)
+
+        self.steps = [(np.zeros(0), np.zeros(0, np.int64), []) for _ in range(len(self.plan))]
+        bounds = np.flatnonzero(new_step).tolist() + [len(hit_log)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            step = step_of_row[start]
+            if 0 <= step < len(self.steps):
+                self.steps[step] = (delays[start:stop], hits[start:stop], [])
+
+        checkpoint_path = os.path.join(run_path, "checkpoint.json")
+        step_hits = np.array([step[1].sum() for step in self.steps], dtype=np.int64)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r") as fd:
+                params = json.load(fd)["params"]
+            self.hits_per_step = params["hits_per_step"]
+            self.step_timeout = params["step_timeout"]
+        else:
+            # older runs: enough hits for every recorded step, timeouts longer than any recorded step
+            self.hits_per_step = int(step_hits.max(initial=1))
+            self.step_timeout = max(1.0, 2 * max((float(step[0].sum()) for step in self.steps), default=0.0))
+
+        self.latch_ups = 0
+        self.unplaced_latch_ups = 0
+        if os.path.exists(os.path.join(run_path, "latch_data.pkl")):
+            self._place_latch_ups(pd.read_pickle(os.path.join(run_path, "latch_data.pkl")), step_hits)
+
+    def _place_latch_ups(self, latch_df, step_hits):
+        """Assigns each latch-up to the first step at its position whose hit count range contains its key's hit count"""
+        hits_after = np.cumsum(step_hits)
+        hits_before = hits_after - step_hits
+        tagged = any("_ch" in str(key) for key in latch_df.columns)
+        for i, key in enumerate(latch_df.columns):
+            parsed = parse_event_key(key)
+            waveform = latch_df.iloc[:, i].to_numpy(dtype=float)
+            valid = np.flatnonzero(~np.isnan(waveform))
+            waveform = waveform[:valid[-1] + 1] if len(valid) else waveform[:0]
+            self.latch_ups += 1
+            candidates = [] if parsed is None else np.flatnonzero(
+                (self.plan[:, PLAN_X] == parsed[1]) & (self.plan[:, PLAN_Y] == parsed[2])
+                & (hits_before <= parsed[0]) & (parsed[0] <= hits_after))
+            if len(candidates) == 0:
+                self.unplaced_latch_ups += 1
+                continue
+            step = candidates[0]
+            message = pack_latch_message(event_channel(key), waveform) if tagged else waveform.tobytes()
+            latch_ups = self.steps[step][2]
+            n_hits = int(parsed[0] - hits_before[step])
+            if tagged and latch_ups and latch_ups[-1][0] == n_hits:
+                # channels tripping together arrive in one FIFO read
+                latch_ups[-1] = (n_hits, latch_ups[-1][1] + message)
+            else:
+                latch_ups.append((n_hits, message))
+        for _, _, latch_ups in self.steps:
+            latch_ups.sort(key=lambda latch_up: latch_up[0])
+
+
+class MicrobeamInterfaceReplay(MicrobeamInterfaceRpi):
+    """Re-emits the triggers and latch-ups of a recorded run at the steps the run controller scans
+
+    speed scales the recorded timing (2 = twice as fast, 0 = as fast as possible). A step whose
+    index or position does not match the recording gets no hits.
+    """
+    def __init__(self, logger, run_path, speed=1.0):
+        super().__init__(logger, simulate=True)
+        assert speed >= 0, "replay speed must not be negative"
+        self.run_path = run_path
+        self.speed = speed
+        # the run controller polls for hits and latch-ups at this interval
+        self.min_hit_delay = max(0.001, self.min_hit_delay / speed) if speed > 0 else 0.001
+        self.recording = None
+        self._hit_queue = asyncio.Queue()
+        self._latch_queue = []
+        self._emitter = None
+        self._plan_file = None
+        self._mismatch_logged = False
+
+    def scale_time(self, seconds):
+        """Recorded duration in replay time"""
+        return seconds / self.speed if self.speed > 0 else 0.0
+
+    async def init_hw(self, pigpio_host=None):
+        self.init_time = asyncio.get_running_loop().time()
+        self.recording = RecordedRun(self.run_path)
+        self._plan_file = self.recording.plan_file
+        if self._plan_file is None:
+            fd, self._plan_file = tempfile.mkstemp(prefix="replay_plan_", suffix=".csv")
+            os.close(fd)
+            save_plan(self._plan_file, self.recording.plan)
+        self._logger.info("Replaying %s at %s: %d steps, %d latch-ups (%d not placed).",
+                          self.run_path, f"{self.speed:g}x speed" if self.speed > 0 else "max. speed",
+                          len(self.recording.plan), self.recording.latch_ups, self.recording.unplaced_latch_ups)
+
+    def run_parameters(self, min_step_timeout=0.1):
+        """start_run() arguments for the recorded plan, the step timeout scaled like the recorded timing
+
+        min_step_timeout (s) leaves the emitter time to deliver the triggers of steps that ended with a timeout.
+        """
+        plan = self.recording.plan
+        step_timeout = self.recording.step_timeout
+        return {
+            "start_x": int(plan[:, PLAN_X].min(initial=0)),
+            "start_y": int(plan[:, PLAN_Y].min(initial=0)),
+            "stop_x": int(plan[:, PLAN_X].max(initial=0)),
+            "stop_y": int(plan[:, PLAN_Y].max(initial=0)),
+            "points_x": len(np.unique(plan[:, PLAN_X])),
+            "points_y": len(np.unique(plan[:, PLAN_Y])),
+            "hits_per_step": self.recording.hits_per_step,
+            "step_timeout": max(self.scale_time(step_timeout), min_step_timeout) if step_timeout > 0 else 0,
+            "repeat_count": int(plan[:, PLAN_REP].max(initial=0)) + 1,
+            "units": "lsb",
+            "plan_file": self._plan_file,
+        }
+
+    async def deliver_hits(self, hits_per_step=None, enable=True):
+        if hits_per_step is None or not enable:
+            return  # the emitter of the step delivers all its recorded triggers
+        self.shutters_left = hits_per_step
+        self._stop_emitter()
+        self._emitter = asyncio.create_task(self._emit_step(self._run_ctrl.step_index, self.x, self.y))
+
+    async def _emit_step(self, index, x, y):
+        steps = self.recording.steps
+        if index >= len(steps) or (x, y) != tuple(self.recording.plan[index, [PLAN_X, PLAN_Y]]):
+            if not self._mismatch_logged:
+                self._logger.warning("Step %d at (%d|%d) is not in the recording, no hits replayed.", index, x, y)
+                self._mismatch_logged = True
+            return
+        delays, hits, latch_ups = steps[index]
+        loop = asyncio.get_running_loop()
+        pending = list(latch_ups)
+        emitted = 0
+        for delay, n_hits in zip(delays, hits):
+            await self._release_latch_ups(pending, emitted)
+            await asyncio.sleep(self.scale_time(delay))
+            # triggers recorded after a latch-up (during its recovery) are replayed as well
+            if self.shutter_closed:
+                return
+            self._hit_queue.put_nowait(((loop.time() - self.init_time) * 1e6, int(n_hits), x, y))
+            emitted += n_hits
+        await self._release_latch_ups(pending, np.inf)
+
+    async def _release_latch_ups(self, pending, emitted):
+        """Queues the latch-ups due after emitted hits, continues once the run controller has read them"""
+        if pending and pending[0][0] <= emitted:
+            while not self._hit_queue.empty():
+                await asyncio.sleep(0)  # the hits before it are counted first
+        while pending and pending[0][0] <= emitted:
+            self._latch_queue.append(pending.pop(0)[1])
+        while self._latch_queue and not self.shutter_closed:
+            # like the checker, the latch-up is seen at the hit count it occurred at
+            await asyncio.sleep(self.min_hit_delay)
+
+    def _stop_emitter(self):
+        if self._emitter is not None and not self._emitter.done():
+            self._emitter.cancel()
+        self._emitter = None
+
+    async def read_hits(self):
+        return await self._hit_queue.get()
+
+    def read_latch_data(self):
+        if self._latch_queue:
+            return self._latch_queue.pop(0)
+        return None
+
+    async def close_hw(self):
+        self._stop_emitter()
+        if self._plan_file is not None and self._plan_file != self.recording.plan_file and os.path.exists(self._plan_file):
+            os.remove(self._plan_file)
+        self._logger.info("Replay closed.")
+
+
+async def start_replay(run_ctrl, iface, delay=0.0, min_step_timeout=0.1):
+    """Starts the replayed run after delay (s), latch-up recovery shortened like the recorded timing
+
+    The recovery lasts at least min_step_timeout (s) as well, the triggers recorded during it are replayed.
+    """
+    await asyncio.sleep(delay)
+    run_ctrl.latch_recovery_time = max(iface.scale_time(run_ctrl.latch_recovery_time), min_step_timeout)
+    await run_ctrl.start_run(**iface.run_parameters(min_step_timeout))
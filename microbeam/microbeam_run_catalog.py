@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""SQLite index of all runs (parameters, calibration, counters, durations, files)
+
+The run controller updates the catalog at run start and end. Runs recorded before
+(or without) the catalog are indexed from their run_NNN directories with backfill.
+
+usage examples (run in the run directory, python -m microbeam.microbeam_run_catalog --help for all options):
+$ python -m microbeam.microbeam_run_catalog backfill
+$ python -m microbeam.microbeam_run_catalog query --filter latch_counter_min=1 --filter hits_per_step=10
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sqlite3
+import time
+
+CATALOG_FILE = "run_catalog.sqlite"
+
+# column name -> SQL type
+COLUMNS = {
+    "run_id": "INTEGER PRIMARY KEY",
+    "path": "TEXT",
+    "state": "TEXT",            # running, finished or indexed (backfill)
+    "start_time": "REAL",       # unix time
+    "end_time": "REAL",
+    "duration_s": "REAL",
+    "units": "TEXT",
+    "start_x": "REAL",
+    "stop_x": "REAL",
+    "points_x": "INTEGER",
+    "start_y": "REAL",
+    "stop_y": "REAL",
+    "points_y": "INTEGER",
+    "hits_per_step": "INTEGER",
+    "step_timeout": "REAL",
+    "repeat_count": "INTEGER",
+    "scan_order": "TEXT",
+    "lsb_per_um_x": "REAL",
+    "lsb_per_um_y": "REAL",
+    "scan_points": "INTEGER",
+    "scan_points_done": "INTEGER",
+    "hit_count": "INTEGER",
+    "timeout_counter": "INTEGER",
+    "latch_counter": "INTEGER",
+    "files": "TEXT",            # JSON list of file names in the run directory
+    "params": "TEXT",           # JSON of further run parameters
+}
+
+
+class RunCatalog:
+    def __init__(self, path):
+        self.path = path
+        # used from the run controller's I/O thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS runs ({', '.join(f'{k} {v}' for k, v in COLUMNS.items())})")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def upsert(self, run_id, **fields):
+        """Inserts or updates the given columns of a run"""
+        assert all(k in COLUMNS for k in fields), f"Unknown catalog columns: {set(fields) - set(COLUMNS)}"
+        fields["run_id"] = run_id
+        names = list(fields)
+        self._db.execute(
+            f"INSERT INTO runs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT(run_id) DO UPDATE SET {', '.join(f'{k}=excluded.{k}' for k in names if k != 'run_id')}",
+            [fields[k] for k in names],
+        )
+        self._db.commit()
+
+    def upsert_many(self, rows):
+        for row in rows:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values()),
+            )
+        self._db.commit()
+
+    def run_ids(self):
+        return {row[0] for row in self._db.execute("SELECT run_id FROM runs")}
+
+    def query(self, filters=None, order_by="run_id", limit=None):
+        """Runs matching all filters: {column: value} for equality, column_min / column_max for ranges"""
+        where = []
+        args = []
+        for key, value in (filters or {}).items():
+            column, op = key, "="
+            if key.endswith("_min") and key[:-4] in COLUMNS:
+                column, op = key[:-4], ">="
+            elif key.endswith("_max") and key[:-4] in COLUMNS:
+                column, op = key[:-4], "<="
+            assert column in COLUMNS, f"Unknown catalog column '{column}'"
+            where.append(f"{column} {op} ?")
+            args.append(value)
+        assert order_by.lstrip("-") in COLUMNS, f"Unknown catalog column '{order_by}'"
+        sql = "SELECT * FROM runs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order_by.lstrip('-')} {'DESC' if order_by.startswith('-') else 'ASC'}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(row) for row in self._db.execute(sql, args)]
+
+
+# run log lines written by MicrobeamRunController.start_run() and the scan generator
+_LOG_PATTERNS = [
+    (re.compile(r"Scan unit: (\S+)"), ["units"]),
+    (re.compile(r"X Start: (\S+), X Stop: (\S+), X Points: (\S+)"), ["start_x", "stop_x", "points_x"]),
+    (re.compile(r"Y Start: (\S+), Y Stop: (\S+), Y Points: (\S+)"), ["start_y", "stop_y", "points_y"]),
+    (re.compile(r"Hits per step: (\S+), Step timeout: (\S+), Repeat count: (\S+)"), ["hits_per_step", "step_timeout", "repeat_count"]),
+    (re.compile(r"Scan order: (.+), (\d+) points, total DAC slew"), ["scan_order", "scan_points"]),
+    (re.compile(r"X scale: (\S+) LSB/micrometer"), ["lsb_per_um_x"]),
+    (re.compile(r"Y scale: (\S+) LSB/micrometer"), ["lsb_per_um_y"]),
+    (re.compile(r"Scan finished, (\d+) / (\d+) points done"), ["scan_points_done", "scan_points"]),
+    (re.compile(r"Final hit count: (\d+), timeouts reached: (\d+)"), ["hit_count", "timeout_counter"]),
+    (re.compile(r"Latch-up counter: (\d+)"), ["latch_counter"]),
+]
+
+
+def _convert(column, value):
+    if COLUMNS[column].startswith("INTEGER"):
+        return int(float(value))
+    if COLUMNS[column] == "REAL":
+        return float(value)
+    return value
+
+
+def index_run_dir(path):
+    """Catalog row of an existing run directory, from its run log, hit log and file list"""
+    row = {
+        "run_id": int(os.path.basename(path.rstrip(os.sep)).split("_")[1]),
+        "path": os.path.abspath(path),
+        "state": "indexed",
+        "files": json.dumps(sorted(os.listdir(path))),
+    }
+
+    if os.path.exists(os.path.join(path, "run_log.txt")):
+        with open(os.path.join(path, "run_log.txt"), errors="replace") as fd:
+            for line in fd:
+                for pattern, columns in _LOG_PATTERNS:
+                    match = pattern.search(line)
+                    if match:
+                        for column, value in zip(columns, match.groups()):
+                            try:
+                                row[column] = _convert(column, value)
+                            except ValueError:
+                                pass
+
+    if "latch_counter" not in row and os.path.exists(os.path.join(path, "latch_data.pkl")):
+        import pandas as pd
+        row["latch_counter"] = len(pd.read_pickle(os.path.join(path, "latch_data.pkl")).columns)
+
+    # hit log: start/end time and counters if the run log has no summary (e.g. crashed runs)
+    if os.path.exists(os.path.join(path, "hit_log.csv")):
+        hits = 0
+        latch_ups = set()
+        first_ts = last_ts = None
+        with open(os.path.join(path, "hit_log.csv")) as fd:
+            fd.readline()
+            for line in fd:
+                fields = line.split(",")
+                if len(fields) < 6:
+                    continue
+                try:
+                    ts = float(fields[1])
+                    hits += int(fields[4])
+                except ValueError:
+                    continue
+                first_ts = ts if first_ts is None else first_ts
+                last_ts = ts
+                if fields[5].strip() != "-":
+                    latch_ups.add(fields[5].strip())
+        row.setdefault("hit_count", hits)
+        row.setdefault("latch_counter", len(latch_ups))  # latch-ups without a later hit are missing here
+        if first_ts is not None:
+            row["start_time"] = first_ts
+            row["end_time"] = last_ts
+            row["duration_s"] = last_ts - first_ts
+    return row
+
+
+def backfill(catalog, run_dir, workers=None, force=False):
+    """Indexes all run_NNN directories not yet in the catalog (all with force) in parallel processes"""
+    known = set() if force else catalog.run_ids()
+    paths = sorted(
+        os.path.join(run_dir, name) for name in os.listdir(run_dir)
+        if re.fullmatch(r"run_\d+", name) and os.path.isdir(os.path.join(run_dir, name)) and int(name[4:]) not in known
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(index_run_dir, paths, chunksize=8))
+    catalog.upsert_many(rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run catalog: backfill from run directories and query")
+    parser.add_argument("--run-dir", default=os.getcwd(), help="directory with run.id and the run_NNN directories")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_backfill = subparsers.add_parser("backfill", help="index existing run directories")
+    parser_backfill.add_argument("--workers", type=int, default=None, help="parallel processes (default: CPU count)")
+    parser_backfill.add_argument("--force", action="store_true", help="re-index runs already in the catalog")
+    parser_query = subparsers.add_parser("query", help="list runs")
+    parser_query.add_argument("--filter", action="append", default=[], help="column=value, column_min=value or column_max=value")
+    parser_query.add_argument("--columns", default="run_id,state,units,points_x,points_y,hits_per_step,scan_points_done,hit_count,latch_counter,duration_s",
+                              help="comma separated columns to print")
+    parser_query.add_argument("--order-by", default="run_id", help="column, prefix with - for descending order")
+    parser_query.add_argument("--limit", type=int, default=None)
+    parser_query.add_argument("--json", action="store_true", help="print all columns as JSON")
+    args = parser.parse_args()
+
+    catalog = RunCatalog(os.path.join(args.run_dir, CATALOG_FILE))
+    if args.command == "backfill":
+        t_start = time.perf_counter()
+        n_runs = backfill(catalog, args.run_dir, workers=args.workers, force=args.force)
+        print(f"Indexed {n_runs} runs in {time.perf_counter() - t_start:.2f} s")
+    else:
+        filters = dict(f.split("=", 1) for f in args.filter)
+        runs = catalog.query(filters, order_by=args.order_by, limit=args.limit)
+        if args.json:
+            print(json.dumps(runs, indent=4))
+        else:
+            columns = args.columns.split(",")
+            print("\t".join(columns))
+            for run in runs:
+                print("\t".join(str(run[c]) for c in columns))
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,322 @@
 """Run control and interface governance logic"""
 import asyncio
+import collections
+import concurrent.futures
+import functools
 #import uvloop
 #asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 import enum
 import os
 import picologging as logging
+import struct
 import time
 import json
-import aiofiles
-import pandas as pd
 
 import numpy as np
 
+from .microbeam_metrics import StepMetrics, HitRateEstimator, LoopLagMonitor
+from .microbeam_logging import add_log_handler, remove_log_handler
+from .microbeam_run_catalog import RunCatalog, CATALOG_FILE
+from .microbeam_waveforms import LATCH_MAGIC, minmax_decimate, parse_latch_messages
+from .microbeam_sensitivity import SensitivityMap
+from .microbeam_current import StepCurrentMonitor, StepCurrentLog, truncate_step_current
+from .microbeam_scan_plan import PLAN_SLEW, PLAN_LEVEL, make_grid_plan, make_point_plan, load_plan, save_plan, refine_plan, transition_slew
+
+HIT_LOG_HEADER = "hw_ts_1us,sys_ts_sec,x_lsb,y_lsb,hits,latch_up,step\n"
+# latch_data.bin record header: column key length (bytes), waveform samples (float64); followed by key and samples
+LATCH_RECORD = struct.Struct("<HI")
+# marks runs whose odd repetitions scan columns of constant x (analysis tools swap the axes there)
+SWAPPED_XY_MARKER = "SWAPPED_XY_IN_EVERY_2ND_SCAN_REPETITION"
+
+
+# file operations of the run lifecycle, executed in the run controller's I/O thread
+
+def _create_run_files(run_dir, last_run_id, plan):
+    """Next run id (also after resumed older runs), run directory, scan plan and hit log; returns run id and hit log"""
+    with open(os.path.join(run_dir, "run.id"), "r") as fd:
+        run_id = max(last_run_id, int(fd.read())) + 1
+    with open(os.path.join(run_dir, "run.id"), "w") as fd:
+        fd.write(str(run_id))
+    run_path = os.path.join(run_dir, f"run_{run_id:03d}")
+    os.mkdir(run_path)
+    save_plan(os.path.join(run_path, "scan_plan.csv"), plan)
+    hit_log = open(os.path.join(run_path, "hit_log.csv"), "w")
+    hit_log.write(HIT_LOG_HEADER)
+    return run_id, hit_log
+
+
+def _write_lines(fd, lines):
+    fd.writelines(lines)
+    fd.flush()
+
+
+def _load_json(path):
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+
+def _save_latch_data(path, latch_waveforms):
+    """latch_data.pkl: one NaN-padded DataFrame column per latch-up (pandas is only needed here and for resuming)"""
+    import pandas as pd
+    columns = [pd.DataFrame({key: waveform}) for key, waveform in latch_waveforms]
+    (pd.concat(columns, axis=1) if columns else pd.DataFrame()).to_pickle(path)
+
+
+def _append_latch_data(path, latch_waveforms):
+    """latch_data.bin: appends the latch-ups since the last checkpoint, the waveforms already saved are not rewritten"""
+    with open(path, "ab") as fd:
+        for key, waveform in latch_waveforms:
+            key = key.encode()
+            waveform = np.asarray(waveform, dtype="<f8")
+            fd.write(LATCH_RECORD.pack(len(key), len(waveform)) + key + waveform.tobytes())
+
+
+def _load_latch_data(path, count):
+    """First count latch-ups of latch_data.bin, later records are cut off for appending"""
+    latch_waveforms = []
+    with open(path, "r+b") as fd:
+        while len(latch_waveforms) < count:
+            header = fd.read(LATCH_RECORD.size)
+            if len(header) < LATCH_RECORD.size:
+                break
+            key_length, samples = LATCH_RECORD.unpack(header)
+            key = fd.read(key_length).decode()
+            latch_waveforms.append((key, np.frombuffer(fd.read(8 * samples), dtype="<f8")))
+        fd.truncate(fd.tell())
+    return latch_waveforms
+
+
+def _load_run_files(run_path, checkpoint):
+    """Scan plan, hit log (cut back to the checkpoint, reopened for appending) and latch-up data of a resumed run
+
+    Returns plan, hit log file, hit log DataFrame, latch-up waveforms and whether the hit log was shorter than expected.
+    """
+    import pandas as pd
+    plan = load_plan(os.path.join(run_path, "scan_plan.csv"))[:checkpoint["plan_points"]]
+    hit_log_path = os.path.join(run_path, "hit_log.csv")
+    hit_log_short = os.path.getsize(hit_log_path) < checkpoint["hit_log_offset"]
+    with open(hit_log_path, "r+") as fd:
+        fd.truncate(checkpoint["hit_log_offset"])
+    hit_log_file = open(hit_log_path, "a")
+    hit_log = pd.read_csv(hit_log_path, usecols=["hw_ts_1us", "sys_ts_sec", "x_lsb", "y_lsb", "hits"])
+    latch_waveforms = []
+    if os.path.exists(os.path.join(run_path, "latch_data.bin")):
+        latch_waveforms = _load_latch_data(os.path.join(run_path, "latch_data.bin"), checkpoint["latch_columns"])
+    elif os.path.exists(os.path.join(run_path, "latch_data.pkl")):
+        # runs checkpointed before latch_data.bin existed
+        latch_df = pd.read_pickle(os.path.join(run_path, "latch_data.pkl")).iloc[:, :checkpoint["latch_columns"]]
+        for i, key in enumerate(latch_df.columns):
+            # without the NaN padding of shorter waveforms
+            waveform = latch_df.iloc[:, i].to_numpy(dtype=float)
+            valid = np.flatnonzero(~np.isnan(waveform))
+            latch_waveforms.append((key, waveform[:valid[-1] + 1] if len(valid) else waveform[:0]))
+        _append_latch_data(os.path.join(run_path, "latch_data.bin"), latch_waveforms)
+    return plan, hit_log_file, hit_log, latch_waveforms, hit_log_short
+
+
+def _write_checkpoint_files(run_path, checkpoint, new_latch_waveforms):
+    """Appends new latch-up data, then atomically replaces checkpoint.json"""
+    if new_latch_waveforms:
+        _append_latch_data(os.path.join(run_path, "latch_data.bin"), new_latch_waveforms)
+    with open(os.path.join(run_path, "checkpoint.json.tmp"), "w") as fd:
+        json.dump(checkpoint, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(os.path.join(run_path, "checkpoint.json.tmp"), os.path.join(run_path, "checkpoint.json"))
+
+
+def _remove_resume_files(run_path):
+    """Drops the crash-recovery journal of a completed run, latch_data.pkl holds its latch-ups
+
+    checkpoint.json stays: it marks the run complete and keeps its parameters (replay).
+    """
+    for name in ["latch_data.bin", "checkpoint.json.tmp"]:
+        if os.path.exists(os.path.join(run_path, name)):
+            os.remove(os.path.join(run_path, name))
+
+
+def _touch(path):
+    open(path, mode='a').close()
+
+
 class RunState(enum.Enum):
     IDLE = 0
     RUN_ACTIVE = 1
 
 class MicrobeamSubscriberSocket:
-    def __init__(self, tcp_server_port=8188):
+    """TCP subscribers, the first ack_clients connected ones (0 = all) may gate the scan with acks
+
+    A step is acknowledged once ack_quorum of them (0 = all) replied "ack", their replies are
+    awaited concurrently. ack_timeout (s, 0 for none) limits the wait for each step,
+    clients that disconnect are excluded automatically.
+    """
+    def __init__(self, tcp_server_port=8188, ack_clients=1, ack_quorum=0, ack_timeout=0):
         self._write_clients = []
         self._read_clients = []
         self.tcp_server_port = tcp_server_port
+        self.ack_clients = ack_clients
+        self.ack_quorum = ack_quorum
+        self.ack_timeout = ack_timeout
+        self._pending_reads = {}      # reader -> readline task, kept if a reply is late
+        self._acked_by = {}           # pipelined acks: seq -> clients that acknowledged it so far
+        self._expected_seqs = []      # pipelined acks: undecided steps, oldest first
+        self._decided_seqs = set()
+        self._decided = collections.deque()
 
     async def handle_client(self, reader, writer):
         logging.info("Adding TCP subscriber to client list")
         self._read_clients.append(reader)
         self._write_clients.append(writer)
 
-    
+    def _remove_client(self, index):
+        logging.info("Removing TCP subscriber from client list")
+        reader = self._read_clients.pop(index)
+        self._write_clients.pop(index).close()
+        task = self._pending_reads.pop(reader, None)
+        if task is not None:
+            task.cancel()
+
     async def push_msg(self, msg):
         removal_queue = []
 
-        for writer in self._write_clients:
+        for index, writer in enumerate(self._write_clients):
             try:
                 writer.write((msg + "\n").encode('utf8'))
                 await writer.drain()
-            except ConnectionResetError:
-                removal_queue.append(writer)
-
-        for dead_writer in removal_queue:
-            logging.info("Removing TCP subscriber from client list")
-            dead_writer.close()
-            self._write_clients.pop(dead_writer)
+            except ConnectionError:
+                removal_queue.append(index)
+
+        for index in reversed(removal_queue):
+            self._remove_client(index)
+
+    def _ack_readers(self):
+        return self._read_clients if self.ack_clients == 0 else self._read_clients[:self.ack_clients]
+
+    def _quorum(self, n_clients):
+        return n_clients if self.ack_quorum == 0 else min(self.ack_quorum, n_clients)
+
+    async def _next_replies(self, readers, timeout=None):
+        """Waits concurrently for the next reply lines of the given clients
+
+        Returns {reader: line} of all clients that replied in time, disconnected clients are removed.
+        """
+        tasks = {}
+        for reader in readers:
+            task = self._pending_reads.get(reader)
+            if task is None:
+                task = self._pending_reads[reader] = asyncio.ensure_future(reader.readline())
+            tasks[task] = reader
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        replies = {}
+        for task in done:
+            reader = tasks[task]
+            self._pending_reads.pop(reader, None)
+            try:
+                data = task.result()
+            except (ConnectionError, asyncio.CancelledError):
+                data = b""
+            if not data:
+                if reader in self._read_clients:
+                    self._remove_client(self._read_clients.index(reader))
+                continue
+            replies[reader] = data.decode('utf8').strip()
+        return replies
 
     async def read_ack(self):
-        if self._read_clients:
-            data = await self._read_clients[0].readline()
-            if data.decode('utf8').rstrip() == "ack":
+        """Waits for the ack quorum of one step: True if reached, False on any other reply, timeout or if all clients are gone"""
+        if not self._read_clients:
+            return None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ack_timeout if self.ack_timeout > 0 else None
+        readers = list(self._ack_readers())
+        acked = set()
+        while True:
+            readers = [reader for reader in readers if reader in self._read_clients]
+            if not readers:
+                return False
+            if len(acked) >= self._quorum(len(readers)):
                 return True
-            return False
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                logging.warning("Ack timeout, %d of %d required acks received", len(acked), self._quorum(len(readers)))
+                return False
+            replies = await self._next_replies([reader for reader in readers if reader not in acked], remaining)
+            for reader, line in replies.items():
+                if line != "ack":
+                    return False
+                acked.add(reader)
+
+    def reset_acks(self):
+        """Forgets pipelined ack state (sequence ids restart with every run)"""
+        self._acked_by = {}
+        self._expected_seqs = []
+        self._decided_seqs = set()
+        self._decided.clear()
+
+    def expect_ack(self, seq):
+        """Pipelined acks: step seq was pushed and awaits acks (plain "ack" replies refer to the oldest ones)"""
+        self._expected_seqs.append(seq)
+
+    def cancel_ack(self, seq):
+        """Pipelined acks: step seq was decided without the clients (ack timeout), later replies are ignored"""
+        self._decide(seq)
+
+    def _decide(self, seq):
+        self._acked_by.pop(seq, None)
+        if seq is not None:
+            self._decided_seqs.add(seq)
+            if seq in self._expected_seqs:
+                self._expected_seqs.remove(seq)
+
+    async def read_ack_msg(self):
+        """Reads replies of the ack clients for pipelined acks until a step is decided
+
+        Returns (ok, seq): ok once ack_quorum distinct clients replied "ack <seq>", not ok as soon as one
+        replied anything else (e.g. "nack <seq>"). Replies without sequence id refer to the oldest expected
+        step the client has not acknowledged yet, seq is None if there is none.
+        Returns None if all ack clients disconnected.
+        """
+        while not self._decided:
+            readers = self._ack_readers()
+            if not readers:
+                return None
+            replies = await self._next_replies(readers)
+            for reader, line in replies.items():
+                fields = line.split()
+                if len(fields) > 1 and fields[1].isdigit():
+                    seq = int(fields[1])
+                else:
+                    seq = next((seq for seq in self._expected_seqs if reader not in self._acked_by.get(seq, ())), None)
+                if seq in self._decided_seqs:
+                    continue  # quorum already reached or step flagged by another client
+                if len(fields) == 0 or fields[0] != "ack":
+                    decision = (False, seq)
+                else:
+                    acked_by = self._acked_by.setdefault(seq, set())
+                    acked_by.add(reader)  # repeated acks of one client count once
+                    readers = self._ack_readers()
+                    if len(acked_by.intersection(readers)) < self._quorum(len(readers)):
+                        continue
+                    decision = (True, seq)
+                self._decide(seq)
+                self._decided.append(decision)
+        return self._decided.popleft()
 
 class MicrobeamRunController:
     """Run control and bookkeeping class"""
 
-    def __init__(self, logger, iface, wait_for_client_ack=False, fifo_file=None):
+    def __init__(self, logger, iface, wait_for_client_ack=False, fifo_file=None, run_dir=None, enable_metrics=False, ack_pipeline_depth=0):
         self._logger = logger
         self._iface = iface
         self._iface._run_ctrl = self  # interface class needs direct access to run_ctrl for logging hits from GPIO trigger callback
 
+        # per-step phase timing, shared with the interface
+        self.metrics = StepMetrics(enabled=enable_metrics)
+        self._iface.metrics = self.metrics
+        # wake-up lag of the event loop running the scan, measured once run() is started as a task
+        self.loop_lag = LoopLagMonitor()
+
         self._stop_run_task = None
         self._wait_for_hits_task = None
         self._read_task = None
@@ -65,10 +324,29 @@ class MicrobeamRunController:
         self._scan_run = False
 
         self.wait_for_client_ack = wait_for_client_ack
+        # pipelined acks: up to ack_pipeline_depth steps in flight incl. the current one (0 = legacy ack per step)
+        self.ack_pipeline_depth = ack_pipeline_depth
+        self.ack_timeout = 60.0   # max. wait for outstanding acks (s), they are flagged afterwards
+        self.nack_repeat = False  # repeat points with a failing ack instead of only flagging them
+        self._outstanding_acks = {}  # seq (plan step index) -> plan row, in order of the steps
+        self._ack_event = None
+        self._repeat_rows = []
         self.swap_xy_in_every_2nd_scan = True # FIXME: add GUI element for this
+        self.scan_order = "raster"
+        self.dac_settle_time_per_lsb = 0.0 # optional settling delay after each DAC step, proportional to its slew (s/LSB)
 
         self.scan_points = 0
         self.scan_points_done = 0
+        self.step_index = 0
+        self.scan_plan = None
+        self.step_results = []  # per plan step: hits, duration (s), latch-ups, flagged by client ack
+
+        # resumable runs: state at the last step boundary, written to checkpoint.json every checkpoint_every steps
+        self.checkpoint_every = 10
+        self._run_params = None
+        self._checkpoint = None
+        self._step_checkpoints = {}  # pipelined acks: snapshots at the step boundaries of outstanding steps
+        self._latch_columns_saved = 0  # latch-ups already in latch_data.bin
 
         self.fifo_file = fifo_file
         
@@ -79,20 +357,49 @@ class MicrobeamRunController:
         self.hits_per_step_event = None
         self.timeout_counter = 0
 
+        # online beam hit rate, kept across runs; optional adaptive step timeout based on it
+        self.hit_rate = HitRateEstimator()
+        self.adaptive_timeout_min = 1.0  # lower bound of adaptive step timeouts (s)
+        self.current_step_timeout = 0    # step timeout in use (s, 0 for none)
+
         self.latch_counter = 0
-        self.latch_df = None
+        self.latch_recovery_time = 5.0  # wait after a latch-up before moving on (s)
+        self._latch_rest = b""  # incomplete latch-up message of the last FIFO read
+        self.latch_waveforms = []  # (column key, waveform) per latch-up of the run, saved as latch_data.pkl
+        # recent latch-ups for the web GUI: position, hit count, time, decimated preview and full waveform
+        self.latch_events = collections.deque(maxlen=50)
+        self.latch_preview_points = 250  # min/max bins of the preview
+        # hits and latch-ups per position, saved as sensitivity_map.csv at run end
+        self.sensitivity = SensitivityMap()
+        # DUT supply current per step from the latch-up checker's sample ring, saved as step_current.csv
+        self.step_current = StepCurrentMonitor(self._logger)
+        self.step_current_log = None
 
         self.dac_x = 0
         self.dac_y = 0
         self.state = RunState.IDLE
 
-        self.run_dir = os.getcwd()
+        self.run_dir = os.getcwd() if run_dir is None else run_dir
 
         self.run_log_handler = None
         self.run_hit_log = None
+        # hit log lines are written in the I/O thread at step ends, at the latest after hit_log_flush_interval (s)
+        self.hit_log_flush_interval = 1.0
+        self._hit_log_lines = []
+        self._hit_log_offset = 0  # file size once all lines are written
+        self._hit_log_flushed = 0.0
+
+        # all file access of run start, checkpoints and run end, one thread keeps the order of operations
+        self._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="run_io")
 
         self.subscriber_socket = MicrobeamSubscriberSocket()
 
+        # index of all runs in this run directory, updated at run start and end
+        self.catalog = RunCatalog(os.path.join(self.run_dir, CATALOG_FILE))
+        # catalog queries (web GUI) use their own thread and connection, run file access never waits for them
+        self._catalog_reader = RunCatalog(os.path.join(self.run_dir, CATALOG_FILE))
+        self._query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog_query")
+
         if not os.path.exists(os.path.join(self.run_dir, "run.id")):
             with open(os.path.join(self.run_dir, "run.id"), "w") as fd:
                 fd.write(str(-1))
@@ -126,12 +433,21 @@ class MicrobeamRunController:
 
     def _log_hit(self, hw_ts, sys_ts, x, y, hits, latch_up=False):
         # local storage
-        if self.state == RunState.RUN_ACTIVE:
-            assert self.run_hit_log is not None
+        if self.state == RunState.RUN_ACTIVE and self.run_hit_log is not None:
             for i in range(hits):
                 self.hits.append({'hw_ts': hw_ts, 'sys_ts': sys_ts, 'x': x, 'y': y})
-            self.run_hit_log.write(f"{hw_ts},{sys_ts:.7f},{x},{y},{hits},{self.latch_counter if (latch_up is True) else '-'}\n")
-            self.run_hit_log.flush()
+            line = f"{hw_ts},{sys_ts:.7f},{x},{y},{hits},{self.latch_counter if (latch_up is True) else '-'},{self.step_index}\n"
+            self._hit_log_lines.append(line)
+            self._hit_log_offset += len(line)
+            if time.monotonic() - self._hit_log_flushed > self.hit_log_flush_interval:
+                self._flush_hit_log()
+
+    def _flush_hit_log(self):
+        """Queues the buffered hit log lines in the I/O thread"""
+        self._hit_log_flushed = time.monotonic()
+        if self._hit_log_lines and self.run_hit_log is not None:
+            self._submit_io(_write_lines, self.run_hit_log, self._hit_log_lines)
+            self._hit_log_lines = []
 
     async def _read_hit_task(self):
         """FIFO read access / event input queue"""
@@ -145,35 +461,168 @@ class MicrobeamRunController:
             
             sys_ts = time.time()
             self.hit_count += hits
-            self._logger.debug(f"At least {hits} hit(s) *logged* at time {ticks/1000:_.03f} ms @ ({x}|{y})")
+            self._logger.debug("At least %d hit(s) *logged* at time %.3f ms @ (%d|%d)", hits, ticks/1000, x, y)
             self._log_hit(hw_ts=ticks, sys_ts=sys_ts, x=x, y=y, hits=hits,latch_up=self.latch_occured)
             # NOTE: latchup events wil be in most cases logged with the consecutive hit entry! (due to sleep(min_hit_delay) in main loop)
 
-    async def start(self):
+    async def start(self, serve_subscribers=True):
         """Launch background tasks controlling event data flow"""
         self.hits_per_step_event = asyncio.Event()
+        self._ack_event = asyncio.Event()
         self._read_task = asyncio.create_task(self._read_hit_task())
         #self._read_task.add_done_callback(self._handle_read_task_result)
-        server = await asyncio.start_server(self.subscriber_socket.handle_client, 'localhost', self.subscriber_socket.tcp_server_port)
-        asyncio.create_task(server.serve_forever())
+        if serve_subscribers:
+            server = await asyncio.start_server(self.subscriber_socket.handle_client, 'localhost', self.subscriber_socket.tcp_server_port)
+            asyncio.create_task(server.serve_forever())
 
 
         
-    async def _scan_generator_task(
-            self,
-            start_x,
-            start_y,
-            stop_x,
-            stop_y,
-            points_x,
-            points_y,
-            hits_per_step,
-            step_timeout,
-            repeat_count,
-            units,
-        ):
-        """Scan generation logic"""
+    def _scan_values_to_lsbs(self, x_vals, y_vals, units):
+        """Converts scan coordinates in the given units to DAC LSBs (vectorized)
+
+        Raises ValueError for points outside the DAC range (clipping would pile them up at the edge)
+        and for micrometers without calibration.
+        """
+        x_vals = np.asarray(x_vals, dtype=float)
+        y_vals = np.asarray(y_vals, dtype=float)
+        if units == "volt":
+            # +10 V is full scale, it clips to the last LSB
+            if not np.all((np.abs(x_vals) <= 10) & (np.abs(y_vals) <= 10)):
+                raise ValueError("Scan points exceed the DAC range of +-10 V")
+            x_vals = self._dac_voltage_to_lsbs(x_vals)
+            y_vals = self._dac_voltage_to_lsbs(y_vals)
+        elif units == "um":
+            if self._lsb_per_um_x == 0 or self._lsb_per_um_y == 0:
+                raise ValueError("Micrometer unit selected, but system calibration info is invalid, check cal.json file!")
+            x_vals = np.round(x_vals * self._lsb_per_um_x)
+            y_vals = np.round(y_vals * self._lsb_per_um_y)
+        # grid axes differ in length, each is checked on its own
+        if not (np.all((-32768 <= x_vals) & (x_vals <= 32767)) and np.all((-32768 <= y_vals) & (y_vals <= 32767))):
+            raise ValueError(f"Scan points exceed the DAC range of -32768..32767 LSB (x {x_vals.min():.0f}..{x_vals.max():.0f}, "
+                             f"y {y_vals.min():.0f}..{y_vals.max():.0f})")
+        return x_vals.astype(int), y_vals.astype(int)
+
+    def _snapshot_checkpoint(self, next_step, elapsed, complete=False):
+        """Records the run state at a step boundary (cheap, done after every step)
+
+        With pipelined acks, the snapshots back to the oldest outstanding step are kept:
+        a resumed run repeats the steps whose acks never arrived.
+        """
+        oldest = min(self._outstanding_acks, default=next_step)
+        for step in [step for step in self._step_checkpoints if step < oldest]:
+            del self._step_checkpoints[step]
+        self._checkpoint = self._step_checkpoints[next_step] = {
+            "run_id": self.run_id,
+            "params": self._run_params,
+            "plan_points": len(self.scan_plan),
+            "next_step": next_step,
+            "complete": complete,
+            "elapsed_s": elapsed,
+            "scan_points_done": self.scan_points_done,
+            "hit_count": self.hit_count,
+            "timeout_counter": self.timeout_counter,
+            "latch_counter": self.latch_counter,
+            "latch_columns": len(self.latch_waveforms),
+            "hit_log_offset": self._hit_log_offset,
+        }
+
+    async def run_io(self, func, *args, **kwargs):
+        """Runs blocking file access or serialization in the I/O thread, in order of submission"""
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, functools.partial(func, *args, **kwargs))
+
+    async def query_catalog(self, filters, order_by="run_id", limit=None):
+        """Run catalog query (see RunCatalog.query()) in the query thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._query_executor, functools.partial(self._catalog_reader.query, filters, order_by=order_by, limit=limit))
+
+    def _submit_io(self, func, *args):
+        """Queues func in the I/O thread without waiting for it (in order with run_io()), errors are logged"""
+        future = asyncio.get_running_loop().run_in_executor(self._io_executor, func, *args)
+        future.add_done_callback(functools.partial(self._handle_io_result, func))
+        return future
+
+    def _handle_io_result(self, func, future):
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error("%s failed in the I/O thread: %s", getattr(func, "__qualname__", func), future.exception())
+
+    def _submit_checkpoint(self):
+        """Queues the checkpoint of the last snapshot (the oldest unacked step with pipelined acks) in the I/O thread
+
+        Hit log lines and step current rows are flushed and latch-ups since the previous checkpoint are appended
+        to latch_data.bin first.
+        Returns the future of the write, errors are logged.
+        """
+        run_path = os.path.join(self.run_dir, f"run_{self.run_id:03d}")
+        checkpoint = dict(self._step_checkpoints.get(min(self._outstanding_acks, default=-1), self._checkpoint))
+        # the plan on disk is the current one, also for an older snapshot
+        checkpoint["plan_points"] = len(self.scan_plan)
+        if self._run_params["refinement"] is not None:
+            # refinement decisions depend on all previous step results
+            checkpoint["step_results"] = [list(r) for r in self.step_results[:checkpoint["next_step"]]]
+        # the waveforms themselves are never modified: safe to write in the I/O thread
+        new_latch_waveforms = self.latch_waveforms[self._latch_columns_saved:]
+        self._latch_columns_saved = len(self.latch_waveforms)
+        self._flush_hit_log()
+        self._submit_io(self.step_current_log.flush)
+        return self._submit_io(_write_checkpoint_files, run_path, checkpoint, new_latch_waveforms)
+
+    async def _write_checkpoint(self):
+        """Atomically replaces checkpoint.json with the last snapshot, saves new latch-up data first"""
+        await self._submit_checkpoint()
+
+    async def _ack_reader_task(self):
+        """Pipelined acks: attributes the replies of the main TCP client to their outstanding steps"""
+        while True:
+            reply = await self.subscriber_socket.read_ack_msg()
+            if reply is None:
+                self._logger.error("Main TCP client disconnected, aborting scan!")
+                self._scan_run = False
+                self._ack_event.set()
+                return
+            ok, seq = reply
+            if seq not in self._outstanding_acks:
+                self._logger.warning("Ack for unknown or timed out step %s ignored.", seq)
+                continue
+            row = self._outstanding_acks.pop(seq)
+            if not ok:
+                self._flag_step(seq, row)
+            self._ack_event.set()
+
+    async def _wait_for_acks(self, max_outstanding):
+        """Pipelined acks: waits until at most max_outstanding steps are unacknowledged, flags them on timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.ack_timeout
+        while len(self._outstanding_acks) > max_outstanding and self._scan_run:
+            self._ack_event.clear()
+            try:
+                await asyncio.wait_for(self._ack_event.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                self._logger.warning("No ack for step(s) %s within %s s.", list(self._outstanding_acks), self.ack_timeout)
+                for seq in list(self._outstanding_acks):
+                    self.subscriber_socket.cancel_ack(seq)
+                    self._flag_step(seq, self._outstanding_acks.pop(seq))
+
+    def _flag_step(self, seq, row):
+        """Marks a step as flagged by the main TCP client (nack or timeout), optionally queues it for repetition"""
+        self.step_results[seq] = self.step_results[seq][:3] + (1,)
+        self._logger.warning("Step %d at (%d|%d) flagged by TCP client%s", seq, row[0], row[1],
+                             ", repeating it." if self.nack_repeat else ".")
+        if self.nack_repeat:
+            self._repeat_rows.append(row)
+
+    async def _scan_generator_task(self, plan, hits_per_step, step_timeout, refinement=None, time_budget=0, start_step=0, elapsed=0,
+                                   adaptive_timeout=0):
+        """Scan generation logic, visits all points of the precomputed scan plan
+
+        With refinement (keyword arguments of refine_plan() except plan, step_results and level,
+        plus max_level), the plan is extended by finer points around sensitive positions each
+        time all points of the current level are done. time_budget (s, 0 for none) ends the scan early.
+        Resumed runs start at start_step with the scan time already used (elapsed, s).
+        With adaptive_timeout > 0, the step timeout is that multiple of the expected time for hits_per_step.
+        """
         self._scan_run = True  # external scan abort signal
+        loop = asyncio.get_running_loop()
+        t_scan_start = loop.time() - elapsed
 
         # poll period
         # poll_period = 0.01  # walue used in 2022 was 10 ms
@@ -181,149 +630,137 @@ class MicrobeamRunController:
             step_timeout_count = int(1e9 / self._iface.min_hit_delay) # ~ heat death of universe
         else:
             step_timeout_count = int(step_timeout / self._iface.min_hit_delay)
-        
-        x_vals = np.linspace(start_x, stop_x, points_x, endpoint=True)
-        y_vals = np.linspace(start_y, stop_y, points_y, endpoint=True)
-
-        if units == "volt":
-            x_vals = self._dac_voltage_to_lsbs(x_vals)
-            y_vals = self._dac_voltage_to_lsbs(y_vals)
-        elif units == "um":
-            if self._lsb_per_um_x == 0 or self._lsb_per_um_x == 0:
-                self._logger.warning("Micrometer unit selected, but system calibration info is invalid, check cal.json file!")
-                exit(1)
-            x_vals = self._dac_um_to_lsbs_x(x_vals)
-            y_vals = self._dac_um_to_lsbs_y(y_vals)
-        
-        x_vals = x_vals.astype(int)
-        y_vals = y_vals.astype(int)
-
-        self.scan_points = len(x_vals) * len(y_vals) * repeat_count
-        self.scan_points_done = 0
+        self.current_step_timeout = step_timeout
 
-        self.latch_df = pd.DataFrame()
+        self.scan_plan = plan
+        self.scan_points = len(plan)
 
         if self.wait_for_client_ack is True:
             if not self.subscriber_socket._read_clients:
                 self._logger.error("TCP client required for run control, but none connected. Aborting run.")
                 return
             
+        fifo = None
+        self._latch_rest = b""
         if self.fifo_file is not None:
             #fifo = await aiofiles.open(self.fifo_file, mode='r')
             fifo = os.open(self.fifo_file, os.O_RDONLY | os.O_NONBLOCK)
             
         await self._iface.prepare_run(hits_per_shutter=1) #FIXME: add GUI element for hits_per_shutter?
-            
-        step_start_count = 0
+
+        # pipelined acks: the beam moves on while the main TCP client still reads out previous steps
+        pipelined = self.wait_for_client_ack and self.ack_pipeline_depth > 0
+        ack_reader_task = None
+        if pipelined:
+            self._outstanding_acks = {}
+            self._repeat_rows = []
+            self.subscriber_socket.reset_acks()
+            ack_reader_task = asyncio.create_task(self._ack_reader_task())
+            self._logger.info("Pipelined client acks, depth %d", self.ack_pipeline_depth)
 
        # ensure shutter is closed at start of scan
         await self._iface.close_shutter()
-        for repetition in range(repeat_count):
-            if self.swap_xy_in_every_2nd_scan is True and (repetition % 2) == 1:
-                # first x, then y
-                vals_1st_order = x_vals
-                vals_2nd_order = y_vals
-                self._logger.warning(f"CHANGING SCAN SEQUENCE to first x, then y!")
-            else:
-                # first y, then x
-                vals_1st_order = y_vals
-                vals_2nd_order = x_vals
-                self._logger.info(f"Default scan sequence: first y, then x.")
-            for i in vals_1st_order:
-                for j in vals_2nd_order:
-                    if self.swap_xy_in_every_2nd_scan is True and (repetition % 2) == 1:
-                        x = i
-                        y = j
-                    else:
-                        x = j
-                        y = i
-                    # new sweep step
-                    await self.write_dac(x, y)
-                    self._logger.info(f"Scan advancing to point {self.scan_points_done+1} / {self.scan_points}")
-                    await self.subscriber_socket.push_msg(f"pos {x} {y}")
-
-                    if self.wait_for_client_ack:
-                        wait_for_client_task = asyncio.create_task(self.subscriber_socket.read_ack())
-                        #wait_for_tasks.append(wait_for_client_task)
-                    
-                    step_start_count = self.hit_count
-
-                    timeout_count = 0
-                    self.latch_occured = False
-
-                    if self._iface._simulate is True:
-                        await self._iface.open_shutter()
-                    
-                    await self._iface.deliver_hits(hits_per_step)
-
-                    while timeout_count < step_timeout_count and (self.hit_count - step_start_count) < hits_per_step and self._scan_run:
-                        if self.wait_for_client_ack is True and wait_for_client_task.done():
-                            hits_awaited = (self.hit_count - step_start_count)
-                            if hits_awaited >= hits_per_step/2:
-                                self._logger.info(f"Step acknowledged by main TCP client, hits per step: {hits_awaited} / {hits_per_step}")
-                                # OK, go to next step
-                            else:
-                                self._logger.info(f"Less than half of hits per step received before TCP client acknowledged, hits per step: {hits_awaited} / {hits_per_step}. Aborting scan!")
-                                self._scan_run = False # Abort scan
-                                await self.subscriber_socket.push_msg(f"abort")
-                                break
-                        
-                        await asyncio.sleep(self._iface.min_hit_delay)
-
-                        if self.fifo_file is not None:
-                            latch_data = None
-                            try:
-                                #latch_data = await fifo.read()
-                                latch_data = os.read(fifo, 1024*1024)
-                            except:
-                                pass
-                                #self._logger.debug(f"No FIFO data available.")
-                            if latch_data is not None and len(latch_data) > 0:
-                                    self._iface.shutters_left = 0 # prevent future hits at this step, if any
-                                    self.latch_occured = True
-                                    self.latch_counter += 1
-                                    #print(np.frombuffer(latch_data))
-                                    latch_data_np = np.frombuffer(latch_data)
-                                    new_df = pd.DataFrame( { f"{self.hit_count}_{x}_{y}" : latch_data_np } )
-                                    self.latch_df = pd.concat([self.latch_df,new_df], axis=1)
-                                    #self.latch_df = self.latch_df.append(new_df, ignore_index=True)
-                                    self._logger.info(f"LATCH-UP: {self.latch_counter} logged, hit count: {self.hit_count}. Waiting 5 s to recover.")
-                                    #self._logger.debug(f"FIFO data: {len(latch_data)} bytes")
-                                    await asyncio.sleep(5) # wait for the latch-up to be over
-                                    timeout_count = step_timeout_count # let timeout pass, go to next step
-
-                        timeout_count += 1
-
-                    # -- At this point, either hits_per_step hits were received, timeout reached or scan aborted
-                    
-                    self._iface.shutters_left = 0
-
-                    if self._iface._simulate is True:
-                        await self._iface.close_shutter()
-
-                    if timeout_count == step_timeout_count:
-                        self._logger.info(f"Timeout reached ({step_timeout_count } x {self._iface.min_hit_delay}s), moving on.")
-                        self.timeout_counter += 1
-                    self._logger.debug(f"Step finished, {self.hit_count - step_start_count} hits received.")
-
-                    if not self._scan_run:
-                        break
-                    else:
-                        self.scan_points_done += 1
-                if not self._scan_run:
-                    break
+        repetition = -1
+        step_index = start_step
+        while True:
+            if pipelined:
+                # at the end of the plan, all acks are needed (failing ones may add points)
+                t = self.metrics.mark()
+                await self._wait_for_acks(self.ack_pipeline_depth - 1 if step_index < len(self.scan_plan) else 0)
+                self.metrics.observe("ack_wait", t)
+                if self._repeat_rows:
+                    self.scan_plan = np.insert(self.scan_plan, step_index, np.array(self._repeat_rows), axis=0)
+                    self.scan_plan[:, PLAN_SLEW] = transition_slew(self.scan_plan)
+                    self.scan_points = len(self.scan_plan)
+                    self._logger.info("Repeating %d point(s) flagged by main TCP client", len(self._repeat_rows))
+                    self._repeat_rows = []
+                    await self.run_io(save_plan, os.path.join(self.run_dir, f"run_{self.run_id:03d}", "scan_plan.csv"), self.scan_plan.copy())
+                    self._snapshot_checkpoint(step_index, loop.time() - t_scan_start)
+                    await self._write_checkpoint()
+            if step_index >= len(self.scan_plan) or not self._scan_run:
+                break
+
+            x, y, step_repetition, slew, level = (int(v) for v in self.scan_plan[step_index, :PLAN_LEVEL + 1])
+            if step_repetition != repetition and level == 0:
+                repetition = step_repetition
+                # only grid plans are built with swapped repetitions
+                if self._run_params.get("swap_xy", False) and (repetition % 2) == 1:
+                    self._logger.warning("CHANGING SCAN SEQUENCE to first x, then y!")
+                    if repetition == 1:
+                        await self.run_io(_touch, os.path.join(self.run_dir, f"run_{self.run_id:03d}", SWAPPED_XY_MARKER))
+                else:
+                    self._logger.info("Default scan sequence: first y, then x.")
+                self._logger.info("Scan repetition %d (%s order)", repetition, self.scan_order)
+
+            if adaptive_timeout > 0:
+                # a multiple of the expected time for hits_per_step, at most the run's step timeout
+                timeout = max(self.adaptive_timeout_min, adaptive_timeout * self.hit_rate.expected_step_time(hits_per_step))
+                if step_timeout > 0:
+                    timeout = min(timeout, step_timeout)
+                self.current_step_timeout = timeout
+                step_timeout_count = int(timeout / self._iface.min_hit_delay)
+
+            self.step_index = step_index
+            self.step_results.append(await self._scan_step(x, y, slew, hits_per_step, step_timeout_count, fifo))
+
             if not self._scan_run:
                 break
-            if self.swap_xy_in_every_2nd_scan is True and repetition == 1:
-                open(os.path.join(self.run_dir, f"run_{self.run_id:03d}", "SWAPPED_XY_IN_EVERY_2ND_SCAN_REPETITION"), mode='a').close()
-        
-        if self.fifo_file is not None:
+            else:
+                self.scan_points_done += 1
+            step_index += 1
+
+            self._snapshot_checkpoint(step_index, loop.time() - t_scan_start, complete=step_index == len(self.scan_plan))
+            if step_index % self.checkpoint_every == 0 or self.latch_occured:
+                self._submit_checkpoint()  # the next step does not wait for the disk
+
+            if time_budget > 0 and loop.time() - t_scan_start > time_budget:
+                self._logger.info("Time budget of %s s used up, ending scan.", time_budget)
+                break
+
+            # adaptive refinement once all points of a level are done
+            if refinement is not None and step_index == len(self.scan_plan) and level < refinement["max_level"]:
+                if pipelined:
+                    await self._wait_for_acks(0)
+                new_rows = refine_plan(
+                    self.scan_plan,
+                    np.array(self.step_results, dtype=float),
+                    level,
+                    pitch_x=refinement["pitch_x"],
+                    pitch_y=refinement["pitch_y"],
+                    bounds=refinement["bounds"],
+                    gradient_threshold=refinement["gradient_threshold"],
+                    gradient_z=refinement.get("gradient_z", 3.0),
+                )
+                self._logger.info("Refinement level %d: %d new points", level + 1, len(new_rows))
+                if len(new_rows) > 0:
+                    self.scan_plan = np.concatenate([self.scan_plan, new_rows])
+                    self.scan_points = len(self.scan_plan)
+                    # store the extended plan, resumed runs continue with it
+                    await self.run_io(save_plan, os.path.join(self.run_dir, f"run_{self.run_id:03d}", "scan_plan.csv"), self.scan_plan.copy())
+                    self._snapshot_checkpoint(step_index, loop.time() - t_scan_start)
+                    await self._write_checkpoint()
+
+        if ack_reader_task is not None:
+            ack_reader_task.cancel()
+
+        # state of the last completed step, an aborted step is repeated on resume
+        await self._write_checkpoint()
+
+        if fifo is not None:
             os.close(fifo)
-            self.latch_df.to_pickle(os.path.join(self.run_dir, f"run_{self.run_id:03d}", "latch_data.pkl"))
-            self._logger.info(f"Latch-up counter: {self.latch_counter}")
+        if self.fifo_file is not None or self.latch_waveforms:
+            await self.run_io(_save_latch_data, os.path.join(self.run_dir, f"run_{self.run_id:03d}", "latch_data.pkl"), list(self.latch_waveforms))
+            self._logger.info("Latch-up counter: %d", self.latch_counter)
+        if self._checkpoint["complete"]:
+            await self.run_io(_remove_resume_files, os.path.join(self.run_dir, f"run_{self.run_id:03d}"))
+        await self.run_io(self.sensitivity.save, os.path.join(self.run_dir, f"run_{self.run_id:03d}", "sensitivity_map.csv"))
 
-        self._logger.info(f"Scan finished, {self.scan_points_done} / {self.scan_points} points done.")
-        self._logger.info(f"Final hit count: {self.hit_count}, timeouts reached: {self.timeout_counter}.")
+        self._logger.info("Scan finished, %d / %d points done.", self.scan_points_done, self.scan_points)
+        self._logger.info("Final hit count: %d, timeouts reached: %d.", self.hit_count, self.timeout_counter)
+        if self.metrics.enabled:
+            self._logger.info("Step phase timing:")
+            for line in self.metrics.summary_lines():
+                self._logger.info("%s", line)
 
 
 
@@ -336,6 +773,162 @@ class MicrobeamRunController:
         await self._iface.deliver_hits(enable=False)
 
     
+    async def _scan_step(self, x, y, slew, hits_per_step, step_timeout_count, fifo):
+        """Moves the beam to (x, y) and waits for hits, timeout, latch-up or scan abort
+
+        Returns hits received, step duration (s), latch-ups and whether the client ack flagged the step.
+        """
+        t_step = t = self.metrics.mark()
+        t_step_start = asyncio.get_running_loop().time()
+        await self.write_dac(x, y)
+        if self.dac_settle_time_per_lsb > 0:
+            await asyncio.sleep(slew * self.dac_settle_time_per_lsb)
+        t = self.metrics.observe("write_dac", t)
+        self._logger.info("Scan advancing to point %d / %d", self.scan_points_done+1, self.scan_points)
+        t = self.metrics.observe("log", t)
+        pipelined = self.wait_for_client_ack and self.ack_pipeline_depth > 0
+        legacy_ack = self.wait_for_client_ack and not pipelined
+        if pipelined:
+            await self.subscriber_socket.push_msg(f"pos {x} {y} {self.step_index}")
+        else:
+            await self.subscriber_socket.push_msg(f"pos {x} {y}")
+        t = self.metrics.observe("push_msg", t)
+
+        if legacy_ack:
+            wait_for_client_task = asyncio.create_task(self.subscriber_socket.read_ack())
+            #wait_for_tasks.append(wait_for_client_task)
+            t_ack = t
+            ack_observed = False
+        
+        step_start_count = self.hit_count
+        step_start_latch_count = self.latch_counter
+        self.step_current.start_step()
+
+        timeout_count = 0
+        self.latch_occured = False
+
+        if self._iface._simulate is True:
+            await self._iface.open_shutter()
+        
+        await self._iface.deliver_hits(hits_per_step)
+        t = self.metrics.observe("deliver_hits", t)
+        t_shutter_start = asyncio.get_running_loop().time()
+
+        while timeout_count < step_timeout_count and (self.hit_count - step_start_count) < hits_per_step and self._scan_run:
+            if legacy_ack and wait_for_client_task.done():
+                if not ack_observed:
+                    self.metrics.observe("client_ack", t_ack)
+                    ack_observed = True
+                hits_awaited = (self.hit_count - step_start_count)
+                if hits_awaited >= hits_per_step/2:
+                    self._logger.info("Step acknowledged by main TCP client, hits per step: %d / %d", hits_awaited, hits_per_step)
+                    # OK, go to next step
+                else:
+                    self._logger.info("Less than half of hits per step received before TCP client acknowledged, hits per step: %d / %d. Aborting scan!", hits_awaited, hits_per_step)
+                    self._scan_run = False # Abort scan
+                    await self.subscriber_socket.push_msg(f"abort")
+                    break
+            
+            await asyncio.sleep(self._iface.min_hit_delay)
+
+            # simulated interfaces may inject latch-ups themselves, otherwise poll the FIFO
+            t_fifo = self.metrics.mark()
+            latch_data = self._iface.read_latch_data()
+            if latch_data is None and fifo is not None:
+                try:
+                    #latch_data = await fifo.read()
+                    latch_data = os.read(fifo, 1024*1024)
+                except:
+                    pass
+                    #self._logger.debug(f"No FIFO data available.")
+            t_fifo = self.metrics.observe("fifo_poll", t_fifo)
+            self.step_current.poll()
+            messages = []
+            if latch_data:
+                # a message split across FIFO reads is completed by the next ones
+                latch_data = self._latch_rest + latch_data
+                # multi-channel checkers tag each waveform with the channel that tripped
+                tagged = latch_data.startswith(LATCH_MAGIC)
+                messages, self._latch_rest = parse_latch_messages(latch_data)
+            if messages:
+                self._iface.shutters_left = 0 # prevent future hits at this step, if any
+                self.latch_occured = True
+                #print(np.frombuffer(latch_data))
+                for channel, latch_data_np in messages:
+                    self.latch_counter += 1
+                    key = f"{self.hit_count}_{x}_{y}" + (f"_ch{channel}" if tagged else "")
+                    self.latch_waveforms.append((key, latch_data_np))
+                    preview_x, preview_y = minmax_decimate(latch_data_np, self.latch_preview_points)
+                    self.latch_events.append({
+                        "id": self.latch_counter,
+                        "channel": channel,
+                        "hit_count": self.hit_count,
+                        "x": int(x),
+                        "y": int(y),
+                        "sys_ts": time.time(),
+                        "samples": len(latch_data_np),
+                        "preview_x": preview_x.tolist(),
+                        "preview_y": np.nan_to_num(preview_y).tolist(),
+                        "waveform": latch_data_np,
+                    })
+                    self._logger.info("LATCH-UP: %d logged on channel %d, hit count: %d.", self.latch_counter, channel, self.hit_count)
+                self._logger.info("Waiting %g s to recover from latch-up.", self.latch_recovery_time)
+                #self._logger.debug(f"FIFO data: {len(latch_data)} bytes")
+                await asyncio.sleep(self.latch_recovery_time) # wait for the latch-up to be over
+                timeout_count = step_timeout_count # let timeout pass, go to next step
+                self.metrics.observe("latch_up", t_fifo)
+
+            timeout_count += 1
+
+        # -- At this point, either hits_per_step hits were received, timeout reached or scan aborted
+        t = self.metrics.observe("wait_for_hits", t)
+        
+        self._iface.shutters_left = 0
+
+        if self._iface._simulate is True:
+            await self._iface.close_shutter()
+
+        if timeout_count == step_timeout_count:
+            self._logger.info("Timeout reached (%d x %ss), moving on.", step_timeout_count, self._iface.min_hit_delay)
+            self.timeout_counter += 1
+        self._logger.debug("Step finished, %d hits received.", self.hit_count - step_start_count)
+        self.metrics.observe("step", t_step)
+
+        if self._scan_run:
+            now = asyncio.get_running_loop().time()
+            self.hit_rate.add_step(
+                self.hit_count - step_start_count,
+                shutter_time=now - t_shutter_start,
+                step_duration=now - t_step_start,
+                usable=not self.latch_occured,
+            )
+
+        if legacy_ack and not wait_for_client_task.done():
+            wait_for_client_task.cancel()  # late replies are kept by the subscriber socket for the next step
+
+        if pipelined and self._scan_run:
+            # the client reads out this step now and replies "ack <seq>" later
+            self._outstanding_acks[self.step_index] = self.scan_plan[self.step_index].copy()
+            self.subscriber_socket.expect_ack(self.step_index)
+            await self.subscriber_socket.push_msg(f"done {self.step_index}")
+
+        # a client replying anything but "ack" flags the step (e.g. SEU seen in the DUT registers)
+        flagged = (legacy_ack and wait_for_client_task.done() and not wait_for_client_task.cancelled()
+                   and wait_for_client_task.exception() is None and wait_for_client_task.result() is False)
+        self.sensitivity.add(x, y, self.hit_count - step_start_count, self.latch_counter - step_start_latch_count)
+        current = self.step_current.finish_step()
+        if current:
+            # buffered in the open file, flushed with the next checkpoint
+            self._submit_io(self.step_current_log.write,
+                            [(self.step_index, x, y, self.hit_count - step_start_count) + stats for stats in current])
+        self._flush_hit_log()
+        return (
+            self.hit_count - step_start_count,
+            asyncio.get_running_loop().time() - t_step_start,
+            int(self.latch_occured),
+            int(flagged),
+        )
+
     def _handle_read_task_result(self, task):
         try:
             task.result()
@@ -351,19 +944,48 @@ class MicrobeamRunController:
             pass
         except Exception:
             self._logger.exception('Exception raised by scan task = %r', task)
-        
-        self._logger.info(f"Run {self.run_id} ended.")
 
-        # close all files
-        self.run_hit_log.close()
+    async def _run_task(self, **scan_params):
+        """Scan generator followed by the end of run bookkeeping, also if the scan fails"""
+        try:
+            await self._scan_generator_task(**scan_params)
+        finally:
+            await self._finish_run()
+
+    async def _finish_run(self):
+        self._logger.info("Run %d ended.", self.run_id)
+
+        # no more hits are logged from here on
+        self._flush_hit_log()
+        hit_log = self.run_hit_log
         self.run_hit_log = None
 
-        # remove run-specific log handler
-        logging.getLogger().removeHandler(self.run_log_handler)
+        # close all files, the run is active until they are complete (followed downloads read them up to here)
+        await self.run_io(hit_log.close)
+        await self.run_io(self.step_current_log.close)
+        self.state = RunState.IDLE
+        await self._update_catalog(
+            state="finished",
+            end_time=time.time(),
+            duration_s=self._checkpoint["elapsed_s"] if self._checkpoint is not None else None,
+            scan_points=self.scan_points,
+            scan_points_done=self.scan_points_done,
+            hit_count=self.hit_count,
+            timeout_counter=self.timeout_counter,
+            latch_counter=self.latch_counter,
+            files=json.dumps(sorted(await self.run_io(os.listdir, os.path.join(self.run_dir, f"run_{self.run_id:03d}")))),
+        )
+
+        # remove run-specific log handler (closed once all queued records are written)
+        remove_log_handler(self.run_log_handler)
         self.run_log_handler = None
 
-        # reset internal run state 
-        self.state = RunState.IDLE
+    async def _update_catalog(self, **fields):
+        """Run catalog failures are logged, they must not affect the run"""
+        try:
+            await self.run_io(self.catalog.upsert, self.run_id, **fields)
+        except Exception:
+            self._logger.exception("Run catalog update failed")
 
     async def write_dac(self, x_lsb, y_lsb):
         """Base function for DAC access (takes care of position housekeeping)"""
@@ -371,7 +993,7 @@ class MicrobeamRunController:
         y_lsb = int(y_lsb)
         assert -32768 <= x_lsb <= 32767
         assert -32768 <= y_lsb <= 32767
-        self._logger.info(f"Setting DAC to ({x_lsb}|{y_lsb})")
+        self._logger.info("Setting DAC to (%d|%d)", x_lsb, y_lsb)
         await self._iface.write_dac(x_lsb, y_lsb)
         self.dac_x = x_lsb
         self.dac_y = y_lsb
@@ -385,12 +1007,23 @@ class MicrobeamRunController:
         assert units in ["lsb", "um", "volt"], "Invalid unit provided to write_dac_units"
 
         if units == "lsb":
+            if not (-32768 <= x <= 32767 and -32768 <= y <= 32767):
+                self._logger.error("DAC position (%s|%s) LSB out of range, not moving.", x, y)
+                return
             await self.write_dac(x, y)
         if units == "volt":
             await self.write_dac(self._dac_voltage_to_lsbs(x), self._dac_voltage_to_lsbs(y))
         if units == "um":
+            if self._lsb_per_um_x == 0 or self._lsb_per_um_y == 0:
+                self._logger.error("Micrometer unit selected, but system calibration info is invalid, check cal.json file! Not moving.")
+                return
             await self.write_dac(self._dac_um_to_lsbs_x(x), self._dac_um_to_lsbs_y(y))
 
+    async def latch_waveform(self, event_id):
+        """Full waveform of a recent latch-up (see latch_events), None if it is no longer kept"""
+        event = next((e for e in self.latch_events if e["id"] == event_id), None)
+        return None if event is None else event["waveform"]
+
     async def start_run(
             self,
             start_x,
@@ -403,8 +1036,29 @@ class MicrobeamRunController:
             step_timeout,
             repeat_count,
             units,
+            scan_order="raster",
+            plan_file=None,
+            max_refine_level=0,
+            refine_gradient=0.5,
+            refine_significance=3.0,
+            time_budget=0,
+            points=None,
+            mask=None,
+            adaptive_timeout=0,
         ):
-        """Starts a new run with set of parameters provided by front-end"""
+        """Starts a new run with set of parameters provided by front-end
+
+        The scan plan is computed up front from the grid parameters and scan order,
+        or loaded from plan_file (scan_plan.csv of a previous run) for exact reproduction.
+        Regions of interest: points (N × 2 list of x, y in scan units) replaces the grid,
+        mask (points_y × points_x, row 0 = start_y, non-zero = scan) skips grid points.
+        With max_refine_level > 0 the grid is refined adaptively around latch-ups,
+        flagged acks and hit rate gradients (relative, refine_gradient, significant at
+        refine_significance standard deviations) up to that level,
+        time_budget (s, 0 for none) limits the scan duration.
+        adaptive_timeout > 0 sets the step timeout to that multiple of the expected time
+        for hits_per_step at the current beam hit rate (step_timeout is the upper limit).
+        """
 
         assert units in ["um", "lsb", "volt"], "Invalid unit supplied for tun"
 
@@ -412,36 +1066,197 @@ class MicrobeamRunController:
             self._logger.error("Not starting a new run (system state not IDLE)")
             return
 
-        self.run_id += 1
-        self._logger.info(f"Starting new run {self.run_id}")
-        with open(os.path.join(self.run_dir, "run.id"), "w") as fd:
-            fd.write(str(self.run_id))
-        os.mkdir(os.path.join(self.run_dir, f"run_{self.run_id:03d}"))
-        
+        refinement = None
+        swap_xy = False
+        if plan_file is not None or points is not None or mask is not None:
+            assert max_refine_level == 0, "Adaptive refinement needs a full grid"
+        if plan_file is not None:
+            plan = await self.run_io(load_plan, plan_file)
+            scan_order = f"file {plan_file}"
+            # a plan reproduced from a swapped grid run is swapped as well
+            swap_xy = await self.run_io(os.path.exists, os.path.join(os.path.dirname(plan_file), SWAPPED_XY_MARKER))
+        elif points is not None:
+            points = np.asarray(points, dtype=float).reshape(-1, 2)
+            try:
+                x_vals, y_vals = self._scan_values_to_lsbs(points[:, 0], points[:, 1], units)
+            except ValueError as e:
+                self._logger.error("Not starting a new run: %s", e)
+                return
+            plan = make_point_plan(x_vals, y_vals, repeat_count, order=scan_order)
+            scan_order = f"{scan_order}, {len(points)} ROI points"
+        else:
+            try:
+                x_vals, y_vals = self._scan_values_to_lsbs(
+                    np.linspace(start_x, stop_x, points_x, endpoint=True),
+                    np.linspace(start_y, stop_y, points_y, endpoint=True),
+                    units,
+                )
+            except ValueError as e:
+                self._logger.error("Not starting a new run: %s", e)
+                return
+            swap_xy = self.swap_xy_in_every_2nd_scan
+            plan = make_grid_plan(x_vals, y_vals, repeat_count, order=scan_order, swap_xy_every_2nd=swap_xy, mask=mask)
+            if mask is not None:
+                scan_order = f"{scan_order}, ROI mask"
+            if max_refine_level > 0:
+                refinement = {
+                    "max_level": max_refine_level,
+                    "pitch_x": (x_vals[-1] - x_vals[0]) / (len(x_vals) - 1) if len(x_vals) > 1 else 0,
+                    "pitch_y": (y_vals[-1] - y_vals[0]) / (len(y_vals) - 1) if len(y_vals) > 1 else 0,
+                    "bounds": (x_vals.min(), x_vals.max(), y_vals.min(), y_vals.max()),
+                    "gradient_threshold": refine_gradient,
+                    "gradient_z": refine_significance,
+                }
+        self.scan_order = scan_order
+
+        # run ids continue after the latest one, also if an older run was resumed in between
+        self.run_id, self.run_hit_log = await self.run_io(_create_run_files, self.run_dir, self.run_id, plan)
+        self._hit_log_lines = []
+        self._hit_log_offset = len(HIT_LOG_HEADER)
+        self.step_current_log = StepCurrentLog(os.path.join(self.run_dir, f"run_{self.run_id:03d}", "step_current.csv"))
+        self._logger.info("Starting new run %d", self.run_id)
+
         # set up run logging
+        await self._add_run_log_handler()
+
+        self._logger.info("Start of run %d", self.run_id)
+        self._logger.info("Run parameters:")
+        self._logger.info("Scan unit: %s", units)
+        self._logger.info("X Start: %s, X Stop: %s, X Points: %s", start_x, stop_x, points_x)
+        self._logger.info("Y Start: %s, Y Stop: %s, Y Points: %s", start_y, stop_y, points_y)
+        self._logger.info("Hits per step: %s, Step timeout: %s, Repeat count: %s", hits_per_step, step_timeout, repeat_count)
+        self._logger.info("Adaptive step timeout: %s x expected step time, current hit rate estimate: %.1f hits/s",
+                          adaptive_timeout, self.hit_rate.rate)
+        self._logger.info("Scan order: %s, %d points, total DAC slew %d LSB (max. %d LSB per step)",
+                          scan_order, len(plan), plan[:, PLAN_SLEW].sum(), plan[:, PLAN_SLEW].max())
+        self._logger.info("Adaptive refinement levels: %d (gradient threshold %s at %s sigma), time budget: %s s",
+                          max_refine_level, refine_gradient, refine_significance, time_budget)
+        self._logger.info("")
+        self._logger.info("Calibration Coefficients")
+        self._logger.info("X scale: %s LSB/micrometer", self._lsb_per_um_x)
+        self._logger.info("Y scale: %s LSB/micrometer", self._lsb_per_um_y)
+
+        self.hit_count = 0
+        self.timeout_counter = 0
+        self.latch_counter = 0
+        self.scan_points_done = 0
+        self.hits = []
+        self.step_results = []
+        self.latch_waveforms = []
+        self.latch_events.clear()
+        self.sensitivity.clear()
+        self._outstanding_acks = {}
+        self._step_checkpoints = {}
+        self._latch_columns_saved = 0
+
+        if refinement is not None:
+            # JSON serializable for the checkpoint
+            refinement["bounds"] = [int(v) for v in refinement["bounds"]]
+            refinement["pitch_x"] = float(refinement["pitch_x"])
+            refinement["pitch_y"] = float(refinement["pitch_y"])
+        self._run_params = {
+            "hits_per_step": hits_per_step,
+            "step_timeout": step_timeout,
+            "units": units,
+            "scan_order": scan_order,
+            "refinement": refinement,
+            "time_budget": time_budget,
+            "adaptive_timeout": adaptive_timeout,
+            "swap_xy": swap_xy,
+        }
+        self.scan_plan = plan
+        self._snapshot_checkpoint(0, 0)
+        await self._write_checkpoint()
+
+        await self._update_catalog(
+            path=os.path.abspath(os.path.join(self.run_dir, f"run_{self.run_id:03d}")),
+            state="running",
+            start_time=time.time(),
+            units=units,
+            start_x=start_x,
+            stop_x=stop_x,
+            points_x=points_x,
+            start_y=start_y,
+            stop_y=stop_y,
+            points_y=points_y,
+            hits_per_step=hits_per_step,
+            step_timeout=step_timeout,
+            repeat_count=repeat_count,
+            scan_order=scan_order,
+            lsb_per_um_x=self._lsb_per_um_x,
+            lsb_per_um_y=self._lsb_per_um_y,
+            scan_points=len(plan),
+            params=json.dumps(self._run_params),
+        )
+
+        await self._launch_run(plan, start_step=0, elapsed=0)
+
+    async def resume_run(self, run_id):
+        """Continues an aborted or crashed run at the first step not completed before its last checkpoint
+
+        The hit log is cut back to the checkpoint and appended to, later latch-up data is dropped.
+        """
+        if self.state != RunState.IDLE:
+            self._logger.error("Not resuming run %d (system state not IDLE)", run_id)
+            return
+        run_path = os.path.join(self.run_dir, f"run_{run_id:03d}")
+        if not os.path.exists(os.path.join(run_path, "checkpoint.json")):
+            self._logger.error("Run %d has no checkpoint, can't resume it.", run_id)
+            return
+        checkpoint = await self.run_io(_load_json, os.path.join(run_path, "checkpoint.json"))
+        if checkpoint["complete"]:
+            self._logger.error("Run %d is already complete.", run_id)
+            return
+
+        self.run_id = run_id
+        await self._add_run_log_handler()
+        self._logger.info("Resuming run %d at step %d / %d", run_id, checkpoint["next_step"], checkpoint["plan_points"])
+
+        # drop hits and latch-up data of steps after the checkpoint, they are repeated
+        plan, self.run_hit_log, hit_log, self.latch_waveforms, hit_log_short = await self.run_io(_load_run_files, run_path, checkpoint)
+        self._hit_log_lines = []
+        self._hit_log_offset = await self.run_io(self.run_hit_log.tell)
+        await self.run_io(truncate_step_current, os.path.join(run_path, "step_current.csv"), checkpoint["next_step"])
+        self.step_current_log = StepCurrentLog(os.path.join(run_path, "step_current.csv"))
+        if hit_log_short:
+            self._logger.warning("Hit log shorter than at checkpoint, hits may be missing!")
+        self._run_params = checkpoint["params"]
+        self.scan_order = self._run_params["scan_order"]
+        self.hit_count = checkpoint["hit_count"]
+        self.timeout_counter = checkpoint["timeout_counter"]
+        self.latch_counter = checkpoint["latch_counter"]
+        self.scan_points_done = checkpoint["scan_points_done"]
+        # only stored for refinement, otherwise placeholders keep the results aligned with the plan
+        self.step_results = [tuple(r) for r in checkpoint.get("step_results", [(0, 0, 0, 0)] * checkpoint["next_step"])]
+
+        self.hits = [
+            {'hw_ts': hw_ts, 'sys_ts': sys_ts, 'x': x, 'y': y}
+            for hw_ts, sys_ts, x, y, hits in hit_log.itertuples(index=False) for i in range(hits)
+        ]
+
+        self.latch_events.clear()
+        self.sensitivity = SensitivityMap.from_run_data(hit_log, [key for key, _ in self.latch_waveforms])
+        self._latch_columns_saved = len(self.latch_waveforms)
+
+        self.scan_plan = plan
+        self._checkpoint = checkpoint
+        self._outstanding_acks = {}
+        self._step_checkpoints = {checkpoint["next_step"]: checkpoint}
+        await self._update_catalog(state="running")
+        await self._launch_run(plan, start_step=checkpoint["next_step"], elapsed=checkpoint["elapsed_s"])
+
+    async def _add_run_log_handler(self):
         logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-        self.run_log_handler = logging.FileHandler(os.path.join(self.run_dir, f"run_{self.run_id:03d}", "run_log.txt"))
+        self.run_log_handler = await self.run_io(logging.FileHandler, os.path.join(self.run_dir, f"run_{self.run_id:03d}", "run_log.txt"))
         self.run_log_handler.setFormatter(logFormatter)
-        logging.getLogger().addHandler(self.run_log_handler)
-
-        # set up hit log
-        self.run_hit_log = open(os.path.join(self.run_dir, f"run_{self.run_id:03d}", "hit_log.csv"), "w")
-        self.run_hit_log.write(f"hw_ts_1us,sys_ts_sec,x_lsb,y_lsb,hits,latch_up\n")
-
-        self._logger.info(f"Start of run {self.run_id}")
-        self._logger.info(f"Run parameters:")
-        self._logger.info(f"Scan unit: {units}")
-        self._logger.info(f"X Start: {start_x}, X Stop: {stop_x}, X Points: {points_x}")
-        self._logger.info(f"Y Start: {start_y}, Y Stop: {stop_y}, Y Points: {points_y}")
-        self._logger.info(f"Hits per step: {hits_per_step}, Step timeout: {step_timeout}, Repeat count: {repeat_count}")
-        self._logger.info(f"")
-        self._logger.info(f"Calibration Coefficients")
-        self._logger.info(f"X scale: {self._lsb_per_um_x} LSB/micrometer")
-        self._logger.info(f"Y scale: {self._lsb_per_um_y} LSB/micrometer")
+        add_log_handler(self.run_log_handler)
 
+    async def _launch_run(self, plan, start_step, elapsed):
+        """Common part of start_run() and resume_run(): informs subscribers and starts the scan task"""
         if self._iface._simulate is True:
-            self._logger.warning(f"HIT SIMULATION MODE ACTIVATED!")
+            self._logger.warning("HIT SIMULATION MODE ACTIVATED!")
 
+        hits_per_step = self._run_params["hits_per_step"]
         self.hits_per_step=hits_per_step
         self.hits_per_step_event.clear()
 
@@ -450,23 +1265,18 @@ class MicrobeamRunController:
         await self.subscriber_socket.push_msg(f"start_run {self.run_id}")
 
         self.state = RunState.RUN_ACTIVE
-        self.hit_count = 0
-        self.timeout_counter = 0
-        self.latch_counter = 0    
-        self.hits = []
+        self.metrics.reset()
         
         self._scan_task = asyncio.create_task(
-            self._scan_generator_task(
-                start_x=start_x,
-                start_y=start_y,
-                stop_x=stop_x,
-                stop_y=stop_y,
-                points_x=points_x,
-                points_y=points_y,
+            self._run_task(
+                plan=plan,
                 hits_per_step=hits_per_step,
-                step_timeout=step_timeout,
-                repeat_count=repeat_count,
-                units=units
+                step_timeout=self._run_params["step_timeout"],
+                refinement=self._run_params["refinement"],
+                time_budget=self._run_params["time_budget"],
+                adaptive_timeout=self._run_params.get("adaptive_timeout", 0),
+                start_step=start_step,
+                elapsed=elapsed,
             )
         )
         self._scan_task.add_done_callback(self._handle_scan_task_result)
@@ -480,7 +1290,7 @@ class MicrobeamRunController:
             self._logger.error("No run to stop!")
             return
         else:
-            self._logger.info(f"Stopping run {self.run_id}")
+            self._logger.info("Stopping run %d", self.run_id)
         # complete the current scan
         self._scan_run = False
         await self._scan_task  # wait for scan task to finish
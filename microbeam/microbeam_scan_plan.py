@@ -0,0 +1,231 @@
+"""Precomputed scan plans: ordered (x, y, repetition) DAC points incl. estimated slew per transition"""
+import numpy as np
+
+SCAN_ORDERS = ["raster", "serpentine", "hilbert", "random"]
+
+# plan columns (all integer)
+PLAN_X = 0          # DAC X value (LSB)
+PLAN_Y = 1          # DAC Y value (LSB)
+PLAN_REP = 2        # scan repetition
+PLAN_SLEW = 3       # DAC slew from the previous point, max(|dx|, |dy|) (LSB)
+PLAN_LEVEL = 4      # refinement level (0 = initial grid, see refine_plan())
+PLAN_COLUMNS = ["x_lsb", "y_lsb", "repetition", "slew_lsb", "level"]
+
+
+def _hilbert_index(ix, iy, bits):
+    """Distance along a Hilbert curve covering a 2^bits x 2^bits grid (vectorized)"""
+    n = 1 << bits
+    x = ix.astype(np.int64)
+    y = iy.astype(np.int64)
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate quadrant
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+
+def transition_slew(plan, start=(0, 0)):
+    """DAC slew of every transition, the first one from the start (= parking) position"""
+    prev = np.vstack([np.asarray(start, dtype=np.int64).reshape(1, 2), plan[:-1, [PLAN_X, PLAN_Y]]])
+    return np.max(np.abs(plan[:, [PLAN_X, PLAN_Y]] - prev), axis=1)
+
+
+def make_grid_plan(x_vals, y_vals, repeat_count, order="raster", swap_xy_every_2nd=False, seed=None, start=(0, 0), mask=None):
+    """Plan visiting every point of the x_vals × y_vals grid once per repetition
+
+    raster:     rows of constant y, x advancing, full flyback (legacy order)
+    serpentine: like raster, but every other row is scanned backwards (no flyback)
+    hilbert:    Hilbert curve through the grid, only short moves
+    random:     new random permutation for every repetition (decorrelates drifts and position)
+    With swap_xy_every_2nd, odd repetitions scan columns of constant x instead of rows.
+    mask (bool, shape len(y_vals) × len(x_vals)) restricts the plan to a region of interest,
+    masked out points are skipped without changing the order of the remaining ones.
+    """
+    assert order in SCAN_ORDERS, f"Invalid scan order '{order}', choose from {SCAN_ORDERS}"
+    x_vals = np.asarray(x_vals, dtype=np.int64)
+    y_vals = np.asarray(y_vals, dtype=np.int64)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        assert mask.shape == (len(y_vals), len(x_vals)), \
+            f"ROI mask shape {mask.shape} doesn't match the grid ({len(y_vals)} y × {len(x_vals)} x points)"
+        assert mask.any(), "ROI mask is empty"
+    rng = np.random.default_rng(seed)
+
+    blocks = []
+    for repetition in range(repeat_count):
+        swap = swap_xy_every_2nd and (repetition % 2) == 1
+        outer_vals, inner_vals = (x_vals, y_vals) if swap else (y_vals, x_vals)
+        i_outer, i_inner = np.meshgrid(np.arange(len(outer_vals)), np.arange(len(inner_vals)), indexing="ij")
+        if order == "serpentine":
+            i_inner[1::2] = i_inner[1::2, ::-1]
+        i_outer = i_outer.ravel()
+        i_inner = i_inner.ravel()
+
+        if order == "hilbert":
+            bits = max(1, int(np.ceil(np.log2(max(len(outer_vals), len(inner_vals))))))
+            sequence = np.argsort(_hilbert_index(i_inner, i_outer, bits), kind="stable")
+        elif order == "random":
+            sequence = rng.permutation(len(i_outer))
+        else:
+            sequence = np.arange(len(i_outer))
+
+        i_outer = i_outer[sequence]
+        i_inner = i_inner[sequence]
+        if mask is not None:
+            keep = mask[i_inner, i_outer] if swap else mask[i_outer, i_inner]
+            i_outer = i_outer[keep]
+            i_inner = i_inner[keep]
+        outer = outer_vals[i_outer]
+        inner = inner_vals[i_inner]
+        x, y = (outer, inner) if swap else (inner, outer)
+        zeros = np.zeros(len(x), dtype=np.int64)
+        blocks.append(np.column_stack([x, y, np.full(len(x), repetition), zeros, zeros]))
+
+    plan = np.concatenate(blocks).astype(np.int64)
+    plan[:, PLAN_SLEW] = transition_slew(plan, start)
+    return plan
+
+
+def make_point_plan(x_vals, y_vals, repeat_count, order="raster", seed=None, start=(0, 0)):
+    """Plan visiting an arbitrary list of points (e.g. a region of interest) once per repetition
+
+    Points are ordered like in make_grid_plan() based on their row (y) and column (x) rank,
+    duplicates are visited once.
+    """
+    assert order in SCAN_ORDERS, f"Invalid scan order '{order}', choose from {SCAN_ORDERS}"
+    points = np.unique(np.column_stack([np.asarray(x_vals, dtype=np.int64), np.asarray(y_vals, dtype=np.int64)]), axis=0)
+    assert len(points) > 0, "Empty point list"
+    ix = np.unique(points[:, 0], return_inverse=True)[1].ravel()
+    iy = np.unique(points[:, 1], return_inverse=True)[1].ravel()
+    rng = np.random.default_rng(seed)
+
+    blocks = []
+    for repetition in range(repeat_count):
+        if order == "serpentine":
+            sequence = np.lexsort((np.where(iy % 2 == 1, -ix, ix), iy))
+        elif order == "hilbert":
+            bits = max(1, int(np.ceil(np.log2(max(ix.max(), iy.max()) + 1))))
+            sequence = np.argsort(_hilbert_index(ix, iy, bits), kind="stable")
+        elif order == "random":
+            sequence = rng.permutation(len(points))
+        else:
+            sequence = np.lexsort((ix, iy))
+        zeros = np.zeros(len(points), dtype=np.int64)
+        blocks.append(np.column_stack([points[sequence], np.full(len(points), repetition), zeros, zeros]))
+
+    plan = np.concatenate(blocks).astype(np.int64)
+    plan[:, PLAN_SLEW] = transition_slew(plan, start)
+    return plan
+
+
+def load_points(path):
+    """Reads a point list (CSV with x and y columns and a header line, scan units)"""
+    points = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    assert points.shape[1] >= 2, f"Point list {path} needs x and y columns"
+    return points[:, :2]
+
+
+def load_mask(path):
+    """Reads a ROI mask (text file of 0/1 values, one line per y point, or .npy), non-zero = scan"""
+    if path.endswith(".npy"):
+        return np.load(path) != 0
+    with open(path) as fd:
+        return np.loadtxt((line.replace(",", " ") for line in fd), ndmin=2) != 0
+
+
+def save_plan(path, plan):
+    np.savetxt(path, plan, fmt="%d", delimiter=",", header=",".join(PLAN_COLUMNS[:plan.shape[1]]), comments="")
+
+
+def load_plan(path, start=(0, 0)):
+    """Loads a plan saved with a run (e.g. for exact reproduction), slew is recomputed"""
+    plan = np.loadtxt(path, delimiter=",", skiprows=1, dtype=np.int64, ndmin=2)
+    assert plan.shape[1] >= PLAN_REP + 1, f"Scan plan {path} needs at least x, y and repetition columns"
+    if plan.shape[1] < len(PLAN_COLUMNS):
+        plan = np.column_stack([plan, np.zeros((len(plan), len(PLAN_COLUMNS) - plan.shape[1]), dtype=np.int64)])
+    plan[:, PLAN_SLEW] = transition_slew(plan, start)
+    return plan
+
+
+def refine_plan(plan, step_results, level, pitch_x, pitch_y, bounds, gradient_threshold=0.5, gradient_z=3.0):
+    """Quadtree refinement: new plan rows (level + 1) around the sensitive points of `level`
+
+    step_results holds one row (hits, duration, latch_ups, flagged) per done plan step.
+    A position is refined if it saw a latch-up, a flagged client ack (e.g. SEU) or if its
+    hit rate differs by more than gradient_threshold (relative) from a grid neighbour and
+    that difference is significant: more than gradient_z standard deviations of the
+    Poisson counts, given the exposure (step duration) of both positions.
+    New points are placed at half the pitch of `level` around it, within
+    bounds = (x_min, x_max, y_min, y_max), skipping positions already planned.
+    """
+    done = plan[:len(step_results)]
+    if not np.any(done[:, PLAN_LEVEL] == level):
+        return np.zeros((0, len(PLAN_COLUMNS)), dtype=np.int64)
+
+    # aggregate all visits (repetitions) per position
+    positions, inverse = np.unique(done[:, [PLAN_X, PLAN_Y]], axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    totals = np.zeros((len(positions), step_results.shape[1]))
+    np.add.at(totals, inverse, step_results)
+    hits, duration, latch_ups, flagged = totals.T
+    rate = np.divide(hits, duration, out=np.zeros_like(hits), where=duration > 0)
+    # level at which each position was introduced
+    position_level = np.full(len(positions), np.iinfo(np.int64).max)
+    np.minimum.at(position_level, inverse, done[:, PLAN_LEVEL])
+
+    # hit rate gradient towards the 4 neighbours on the grid of this level (coarser grids are subsets of it)
+    level_pitch_x = pitch_x / 2**level
+    level_pitch_y = pitch_y / 2**level
+    gx = np.round((positions[:, 0] - bounds[0]) / level_pitch_x).astype(np.int64) if level_pitch_x > 0 else np.zeros(len(positions), dtype=np.int64)
+    gy = np.round((positions[:, 1] - bounds[2]) / level_pitch_y).astype(np.int64) if level_pitch_y > 0 else np.zeros(len(positions), dtype=np.int64)
+    index_at = {(i, j): n for n, (i, j) in enumerate(zip(gx, gy))}
+    gradient = np.zeros(len(positions))
+    for n in np.flatnonzero(position_level == level):
+        i, j = gx[n], gy[n]
+        for neighbour in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1)):
+            m = index_at.get(neighbour)
+            if m is None or max(rate[n], rate[m]) <= 0 or duration[n] <= 0 or duration[m] <= 0:
+                continue
+            # rate difference against its standard deviation if both positions had the pooled rate
+            pooled = (hits[n] + hits[m]) / (duration[n] + duration[m])
+            sigma = np.sqrt(pooled / duration[n] + pooled / duration[m])
+            if abs(rate[n] - rate[m]) > gradient_z * sigma:
+                gradient[n] = max(gradient[n], abs(rate[n] - rate[m]) / max(rate[n], rate[m]))
+
+    sensitive = positions[(position_level == level) & ((latch_ups > 0) | (flagged > 0) | (gradient > gradient_threshold))]
+    if len(sensitive) == 0:
+        return np.zeros((0, len(PLAN_COLUMNS)), dtype=np.int64)
+
+    # 8 new neighbours at half pitch around every sensitive position
+    offsets = np.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)], dtype=float)
+    offsets *= (level_pitch_x / 2, level_pitch_y / 2)
+    candidates = np.round(sensitive[:, None, :] + offsets[None, :, :]).reshape(-1, 2).astype(np.int64)
+    candidates[:, 0] = np.clip(candidates[:, 0], bounds[0], bounds[1])
+    candidates[:, 1] = np.clip(candidates[:, 1], bounds[2], bounds[3])
+    candidates = np.unique(candidates, axis=0)
+
+    planned = {(x, y) for x, y in plan[:, [PLAN_X, PLAN_Y]]}
+    candidates = np.array([c for c in candidates if (c[0], c[1]) not in planned], dtype=np.int64).reshape(-1, 2)
+    if len(candidates) == 0:
+        return np.zeros((0, len(PLAN_COLUMNS)), dtype=np.int64)
+
+    # serpentine order through the new points: rows of constant y, alternating x direction
+    rows = np.unique(candidates[:, 1], return_inverse=True)[1].ravel()
+    order = np.lexsort((np.where(rows % 2 == 1, -candidates[:, 0], candidates[:, 0]), candidates[:, 1]))
+    candidates = candidates[order]
+
+    new_rows = np.zeros((len(candidates), len(PLAN_COLUMNS)), dtype=np.int64)
+    new_rows[:, [PLAN_X, PLAN_Y]] = candidates
+    new_rows[:, PLAN_REP] = plan[-1, PLAN_REP]
+    new_rows[:, PLAN_LEVEL] = level + 1
+    new_rows[:, PLAN_SLEW] = transition_slew(new_rows, start=plan[-1, [PLAN_X, PLAN_Y]])
+    return new_rows
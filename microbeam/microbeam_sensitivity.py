@@ -0,0 +1,94 @@
+"""Spatial latch-up sensitivity: hits and latch-ups per scan point, cross-section with confidence intervals"""
+import statistics
+
+import numpy as np
+
+from .microbeam_waveforms import parse_event_key
+
+
+def wilson_interval(k, n, confidence=0.95):
+    """Wilson score interval of the binomial probability k / n (vectorized, n = 0 gives [0, 1])"""
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    assert 0 < confidence < 1, "confidence must be between 0 and 1"
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = k / n
+        denominator = 1 + z**2 / n
+        center = (p + z**2 / (2 * n)) / denominator
+        half_width = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    # exact at k = 0 (rounding would leave a tiny positive lower bound)
+    low = np.where((n > 0) & (k > 0), np.clip(center - half_width, 0, 1), 0.0)
+    high = np.where(n > 0, np.clip(center + half_width, 0, 1), 1.0)
+    return low, high
+
+
+class SensitivityMap:
+    """Hits delivered and latch-ups observed per DAC position, updated after every scan step
+
+    The cross-section is given as latch-ups per hit, each hit is treated as a Bernoulli trial.
+    """
+    def __init__(self):
+        self._counts = {}  # (x_lsb, y_lsb) -> [hits, latch-ups]
+
+    def clear(self):
+        self._counts = {}
+
+    def add(self, x, y, hits, latch_ups=0):
+        counts = self._counts.setdefault((int(x), int(y)), [0, 0])
+        counts[0] += hits
+        counts[1] += latch_ups
+
+    def counts(self):
+        """(x_lsb, y_lsb, hits, latch-ups) per position"""
+        return [(x, y, hits, latch_ups) for (x, y), (hits, latch_ups) in self._counts.items()]
+
+    def table(self, confidence=0.95):
+        """One row per position: hits, latch-ups, cross-section and its confidence interval"""
+        import pandas as pd
+        df = pd.DataFrame(self.counts(), columns=["x_lsb", "y_lsb", "hits", "latch_ups"])
+        # a latch-up before the first logged hit of a step still needs the beam
+        trials = np.maximum(df["hits"].to_numpy(), df["latch_ups"].to_numpy())
+        with np.errstate(invalid="ignore", divide="ignore"):
+            df["cross_section"] = np.where(trials > 0, df["latch_ups"] / trials, np.nan)
+        df["ci_low"], df["ci_high"] = wilson_interval(df["latch_ups"], trials, confidence)
+        return df.sort_values(["y_lsb", "x_lsb"], ignore_index=True)
+
+    def summary(self, confidence=0.95, max_cross_section=0.01, min_cross_section=0.0):
+        """Positions significantly sensitive and cleared (ci_high < max_cross_section)
+
+        A position is sensitive if ci_low exceeds the run-wide cross-section (all latch-ups per
+        all hits) and min_cross_section: its cross-section is significantly above the average
+        of the scanned area. With uniform sensitivity no position stands out.
+        """
+        df = self.table(confidence)
+        hits, latch_ups = int(df["hits"].sum()), int(df["latch_ups"].sum())
+        trials = int(np.maximum(df["hits"], df["latch_ups"]).sum())
+        run_cross_section = latch_ups / trials if trials > 0 else 0.0
+        sensitive = df["ci_low"] > max(run_cross_section, min_cross_section)
+        cleared = df["ci_high"] < max_cross_section
+        return {
+            "points": len(df),
+            "hits": hits,
+            "latch_ups": latch_ups,
+            "run_cross_section": run_cross_section,
+            "sensitive_points": int(sensitive.sum()),
+            "cleared_points": int(cleared.sum()),
+            "undecided_points": int((~sensitive & ~cleared).sum()),
+        }
+
+    def save(self, path, confidence=0.95):
+        self.table(confidence).to_csv(path, index=False)
+
+    @classmethod
+    def from_run_data(cls, hit_log, latch_keys):
+        """Rebuilds the map from a hit_log.csv DataFrame and the latch_data.pkl column keys"""
+        sensitivity = cls()
+        for (x, y), hits in hit_log.groupby(["x_lsb", "y_lsb"])["hits"].sum().items():
+            sensitivity.add(x, y, hits)
+        # the hit log marks latch-ups on the following hit, the waveform keys hold the exact position
+        for key in latch_keys:
+            parsed = parse_event_key(key)
+            if parsed is not None:
+                sensitivity.add(parsed[1], parsed[2], 0, 1)
+        return sensitivity
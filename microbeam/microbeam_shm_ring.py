@@ -0,0 +1,239 @@
+"""Shared memory between processes: ring buffer of frames (e.g. decimated checker samples) and JSON snapshots
+
+Both have one writer and any number of readers.
+
+Ring layout: a fixed header followed by capacity frames of channels × fields float64 values.
+Frame i is stored in slot i % capacity, the header holds the number of frames written so far
+(the sequence counter). The writer stores the frames first and publishes the counter afterwards,
+readers copy the frames and check the counter again to drop frames overwritten in the meantime.
+"""
+import json
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+RING_MAGIC = b"MBRG"
+# magic, channels, fields, open flag, capacity (frames), frame rate (Hz), decimation factor,
+# writer pid and creation time (s, identify the segment of a writer that restarted under the same name)
+RING_HEADER = struct.Struct("<4sIIIQdQId")
+_SEQUENCE_OFFSET = 64  # own cache line, written on every push
+_DATA_OFFSET = 128
+
+_SNAPSHOT_HEADER = struct.Struct("<QQ")  # version (odd while being written), length
+
+# ring of the latch-up checker (DUT supply current), per decimation bin: min, max, mean and mean of the squares
+CHECKER_RING = "latchup_ring"
+RING_FIELDS = ("min", "max", "mean", "mean_sq")
+
+
+def _attach_shm(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # readers must not unlink the segment on exit (the resource tracker would, Python < 3.13)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _create_shm(name, size):
+    """New segment, replaces a stale one of the same name (e.g. left by a killed writer)"""
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+
+class ShmRing:
+    """Frames of channels × fields float64 values in a named shared memory segment
+
+    Use ShmRing.create() in the writer and ShmRing.attach() in readers.
+    """
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self.owner = owner
+        magic, self.channels, self.fields, _, self.capacity, self.frame_rate, self.decimation, \
+            self.writer_pid, self.created = RING_HEADER.unpack_from(shm.buf, 0)
+        assert magic == RING_MAGIC, f"{shm.name} is not a sample ring"
+        self._sequence = np.ndarray((1,), dtype=np.uint64, buffer=shm.buf, offset=_SEQUENCE_OFFSET)
+        self._frames = np.ndarray((self.capacity, self.channels, self.fields), dtype=np.float64,
+                                  buffer=shm.buf, offset=_DATA_OFFSET)
+
+    @classmethod
+    def create(cls, name, channels, capacity, frame_rate, decimation=1, fields=len(RING_FIELDS)):
+        """New ring, replaces a stale segment of the same name"""
+        assert channels > 0 and capacity > 0 and fields > 0
+        shm = _create_shm(name, _DATA_OFFSET + capacity * channels * fields * 8)
+        shm.buf[:_DATA_OFFSET] = bytes(_DATA_OFFSET)
+        RING_HEADER.pack_into(shm.buf, 0, RING_MAGIC, channels, fields, 1, capacity, frame_rate, decimation,
+                              os.getpid(), time.time())
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Existing ring, raises FileNotFoundError if the writer has not created it yet"""
+        return cls(_attach_shm(name), owner=False)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def sequence(self):
+        """Frames written since the ring was created"""
+        return int(self._sequence[0])
+
+    @property
+    def closed(self):
+        """The writer has finished, readers should re-attach to follow a new writer"""
+        return RING_HEADER.unpack_from(self._shm.buf, 0)[3] == 0
+
+    def replaced(self):
+        """The segment under this name belongs to another writer (this one was killed and replaced)"""
+        try:
+            shm = _attach_shm(self.name)
+        except FileNotFoundError:
+            return False
+        try:
+            writer = RING_HEADER.unpack_from(shm.buf, 0)[7:]
+        finally:
+            shm.close()
+        return writer != (self.writer_pid, self.created)
+
+    def push(self, frames):
+        """Appends frames (n × channels × fields), only the newest capacity frames are kept"""
+        assert self.owner
+        frames = np.asarray(frames, dtype=np.float64)
+        sequence = self.sequence + len(frames)
+        frames = frames[-self.capacity:]
+        start = (sequence - len(frames)) % self.capacity
+        head = min(len(frames), self.capacity - start)
+        self._frames[start:start + head] = frames[:head]
+        self._frames[:len(frames) - head] = frames[head:]
+        self._sequence[0] = sequence
+
+    def read(self, since, max_frames=None):
+        """(sequence, frames) of the frames written after sequence number since
+
+        Frames that were overwritten before they could be read are skipped, the first returned
+        frame has the sequence number sequence - len(frames).
+        """
+        sequence = self.sequence
+        start = max(since, sequence - self.capacity)
+        if max_frames is not None:
+            start = max(start, sequence - max_frames)
+        indices = np.arange(start, sequence) % self.capacity
+        frames = self._frames[indices]
+        # the writer may have wrapped around while copying
+        return sequence, frames[self.overwritten(start):]
+
+    def views(self, since):
+        """(start, sequence, views) of the frames written after since, without copying
+
+        start is the sequence number of the first frame (later than since if frames were lost),
+        the views (up to 2 because of the wrap-around) point into shared memory: check
+        overwritten(start) once done with them.
+        """
+        sequence = self.sequence
+        start = max(since, sequence - self.capacity)
+        first = start % self.capacity
+        head = min(sequence - start, self.capacity - first)
+        views = [self._frames[first:first + head], self._frames[:sequence - start - head]]
+        return start, sequence, [v for v in views if len(v)]
+
+    def overwritten(self, start):
+        """Number of frames from sequence number start on that the writer has overwritten since"""
+        return max(0, self.sequence - self.capacity - start)
+
+    def latest(self, n_frames):
+        """(sequence, frames) of up to n_frames newest frames"""
+        return self.read(0, max_frames=n_frames)
+
+    def close(self):
+        """Detaches, the writer also marks the ring finished and removes the segment"""
+        self._sequence = self._frames = None
+        if self.owner:
+            RING_HEADER.pack_into(self._shm.buf, 0, RING_MAGIC, self.channels, self.fields, 0,
+                                  self.capacity, self.frame_rate, self.decimation, self.writer_pid, self.created)
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+class RingDecimator:
+    """Reduces blocks of channels × samples to frames of RING_FIELDS over factor samples each
+
+    Samples that do not fill a whole bin are kept for the next block.
+    """
+    def __init__(self, ring, factor):
+        assert factor >= 1 and ring.fields == len(RING_FIELDS)
+        self.ring = ring
+        self.factor = factor
+        self._rest = np.zeros((ring.channels, 0))
+
+    def push(self, block):
+        block = np.concatenate((self._rest, block), axis=1) if self._rest.shape[1] else np.asarray(block)
+        n_bins = block.shape[1] // self.factor
+        self._rest = block[:, n_bins * self.factor:].copy()
+        if n_bins == 0:
+            return
+        bins = block[:, :n_bins * self.factor].reshape(self.ring.channels, n_bins, self.factor)
+        frames = np.stack((bins.min(axis=2), bins.max(axis=2), bins.mean(axis=2), np.square(bins).mean(axis=2)), axis=-1)
+        self.ring.push(frames.transpose(1, 0, 2))
+
+
+class ShmSnapshot:
+    """Latest version of a JSON document in a named shared memory segment
+
+    The writer makes the version odd while it copies a new document in (seqlock), readers retry
+    until they copied a document with the same even version before and after.
+    """
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self.owner = owner
+        self.size = shm.size - _SNAPSHOT_HEADER.size
+        self._header = np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, name, size=1024 * 1024):
+        shm = _create_shm(name, _SNAPSHOT_HEADER.size + size)
+        shm.buf[:_SNAPSHOT_HEADER.size] = bytes(_SNAPSHOT_HEADER.size)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach_shm(name), owner=False)
+
+    def write(self, document):
+        """Publishes the document, returns False if it does not fit"""
+        assert self.owner
+        data = json.dumps(document).encode()
+        if len(data) > self.size:
+            return False
+        version = int(self._header[0])
+        self._header[0] = version + 1
+        self._shm.buf[_SNAPSHOT_HEADER.size:_SNAPSHOT_HEADER.size + len(data)] = data
+        self._header[1] = len(data)
+        self._header[0] = version + 2
+        return True
+
+    def read(self, retries=100):
+        """(version, document) of the latest document, (0, None) before the first write"""
+        for _ in range(retries):
+            version = int(self._header[0])
+            if version % 2:
+                continue
+            length = int(self._header[1])
+            data = bytes(self._shm.buf[_SNAPSHOT_HEADER.size:_SNAPSHOT_HEADER.size + length])
+            if int(self._header[0]) == version:
+                return version, json.loads(data) if version else None
+        raise TimeoutError("snapshot writer did not finish")
+
+    def close(self):
+        self._header = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""Virtual-time simulation of complete scans
+
+Runs the unmodified scan generator of MicrobeamRunController on an event loop
+whose clock only advances when all tasks are waiting. Sleeps (polling, latch-up
+recovery, ack delays, DAC latency, hit arrival) therefore cost no wall time and
+a whole run is simulated as fast as the CPU allows.
+
+usage example (python -m microbeam.microbeam_simulation --help for all options):
+$ python -m microbeam.microbeam_simulation --points-x 50 --points-y 50 --hits-per-step 10 --hit-rate 25
+"""
+import argparse
+import asyncio
+import json
+import os
+import selectors
+import shutil
+import tempfile
+import time
+import picologging as logging
+
+import numpy as np
+
+from .microbeam_interface_rpi import MicrobeamInterfaceRpi
+from .microbeam_run_controller import MicrobeamRunController, MicrobeamSubscriberSocket
+from .microbeam_scan_plan import SCAN_ORDERS, load_points, load_mask
+
+
+class _VirtualClockSelector(selectors.DefaultSelector):
+    """Selector that never blocks on timers, it advances the virtual clock instead"""
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+        self.pending_executor_jobs = 0
+
+    def select(self, timeout=None):
+        if self.pending_executor_jobs > 0 and timeout != 0:
+            # file I/O in executor threads takes no virtual time, wait for it in real time
+            return super().select(None)
+        if timeout is None:
+            # nothing scheduled at all, only real I/O can wake us up
+            return super().select(timeout)
+        events = super().select(0)
+        if not events and timeout > 0:
+            self.now += timeout
+        return events
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """asyncio event loop running on virtual time (jumps to the next scheduled timer)"""
+    def __init__(self):
+        self._virtual_selector = _VirtualClockSelector()
+        super().__init__(self._virtual_selector)
+
+    def time(self):
+        return self._virtual_selector.now
+
+    def run_in_executor(self, executor, func, *args):
+        self._virtual_selector.pending_executor_jobs += 1
+        future = super().run_in_executor(executor, func, *args)
+        future.add_done_callback(self._executor_job_done)
+        return future
+
+    def _executor_job_done(self, future):
+        self._virtual_selector.pending_executor_jobs -= 1
+
+
+class BeamModel:
+    """Statistical description of beam, DUT and DAQ used by the simulation"""
+    def __init__(
+            self,
+            hit_rate=25.0,              # mean hit rate with open shutter (hits/s, Poisson)
+            latch_up_probability=0.0,   # probability of a latch-up per hit
+            ack_delay=0.05,             # mean time the main TCP client needs for its readout (s)
+            ack_jitter=0.01,            # standard deviation of the ack delay (s)
+            nack_probability=0.0,       # probability of a failing ack (e.g. SEU found), pipelined acks only
+            dac_latency=0.001,          # time for one X/Y DAC update incl. settling (s)
+            latch_samples=17000,        # samples per latch-up waveform sent through the FIFO
+        ):
+        self.hit_rate = hit_rate
+        self.latch_up_probability = latch_up_probability
+        self.ack_delay = ack_delay
+        self.ack_jitter = ack_jitter
+        self.nack_probability = nack_probability
+        self.dac_latency = dac_latency
+        self.latch_samples = latch_samples
+
+
+class MicrobeamInterfaceSim(MicrobeamInterfaceRpi):
+    """Simulated interface with Poisson distributed hits, DAC latency and latch-up injection"""
+    def __init__(self, logger, beam_model, seed=None):
+        super().__init__(logger, simulate=True)
+        self.beam_model = beam_model
+        self._rng = np.random.default_rng(seed)
+        self._latch_queue = []
+        self.dac_write_times = []
+
+    async def init_hw(self, pigpio_host=None):
+        self.init_time = asyncio.get_running_loop().time()
+
+    async def simulate_hit(self):
+        if self.beam_model.hit_rate <= 0:
+            return
+        await asyncio.sleep(self._rng.exponential(1.0 / self.beam_model.hit_rate))
+        if self.shutter_closed is False:
+            if self._rng.random() < self.beam_model.latch_up_probability:
+                # random walk, same shape as latch-up_testing/latch-up_simulator.py
+                waveform = np.cumsum(self._rng.normal(0, 0.1, self.beam_model.latch_samples))
+                self._latch_queue.append(waveform.tobytes())
+            tick = (asyncio.get_running_loop().time() - self.init_time) * 1e6
+            await self._trigger_cb(self.trigger, tick)
+
+    def read_latch_data(self):
+        if self._latch_queue:
+            return self._latch_queue.pop(0)
+        return None
+
+    async def write_dac(self, x, y):
+        await asyncio.sleep(self.beam_model.dac_latency)
+        self.dac_write_times.append(asyncio.get_running_loop().time())
+        await super().write_dac(x, y)
+
+
+class VirtualSubscriberSocket(MicrobeamSubscriberSocket):
+    """Stands in for the TCP subscribers: counts pushed bytes and acknowledges after a random delay
+
+    For pipelined acks, the main client reads out one finished step after the other.
+    """
+    def __init__(self, beam_model, connected=False, seed=None):
+        super().__init__(tcp_server_port=None)
+        self.beam_model = beam_model
+        self._rng = np.random.default_rng(seed)
+        self.bytes_pushed = 0
+        self._acks = asyncio.Queue()
+        self._readout_done = 0.0
+        if connected:
+            self._read_clients.append(None)
+
+    async def push_msg(self, msg):
+        self.bytes_pushed += len(msg) + 1
+        if msg.startswith("done "):
+            # readout starts once the step is done and the previous readout finished
+            now = asyncio.get_running_loop().time()
+            delay = max(0.0, self._rng.normal(self.beam_model.ack_delay, self.beam_model.ack_jitter))
+            self._readout_done = max(now, self._readout_done) + delay
+            self._acks.put_nowait((self._readout_done, int(msg.split()[1])))
+
+    async def read_ack(self):
+        await asyncio.sleep(max(0.0, self._rng.normal(self.beam_model.ack_delay, self.beam_model.ack_jitter)))
+        return True
+
+    async def read_ack_msg(self):
+        t_done, seq = await self._acks.get()
+        await asyncio.sleep(max(0.0, t_done - asyncio.get_running_loop().time()))
+        return self._rng.random() >= self.beam_model.nack_probability, seq
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {}
+    return {
+        "min": float(np.min(values)),
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+async def _simulate(logger, run_dir, scan_params, beam_model, wait_for_client_ack, ack_pipeline_depth, seed):
+    iface = MicrobeamInterfaceSim(logger, beam_model, seed=seed)
+    run_ctrl = MicrobeamRunController(logger, iface, wait_for_client_ack=wait_for_client_ack, run_dir=run_dir,
+                                      ack_pipeline_depth=ack_pipeline_depth)
+    run_ctrl.subscriber_socket = VirtualSubscriberSocket(beam_model, connected=wait_for_client_ack, seed=seed)
+
+    await iface.init_hw()
+    await run_ctrl.start(serve_subscribers=False)
+
+    loop = asyncio.get_running_loop()
+    t_start = loop.time()
+    await run_ctrl.start_run(**scan_params)
+    assert run_ctrl._scan_task is not None, "Run not started, see the error logged above"
+    await run_ctrl._scan_task
+    t_stop = loop.time()  # the scan task ends with _finish_run(), the run files are closed
+
+    run_ctrl._read_task.cancel()
+    await iface.close_hw()
+
+    # last DAC write parks the beam and closes the final step
+    step_times = np.diff(iface.dac_write_times)
+
+    run_path = os.path.join(run_dir, f"run_{run_ctrl.run_id:03d}")
+    data_volume = {name: os.path.getsize(os.path.join(run_path, name)) for name in sorted(os.listdir(run_path))}
+    data_volume["tcp_subscribers"] = run_ctrl.subscriber_socket.bytes_pushed
+
+    return {
+        "predicted_duration_s": t_stop - t_start,
+        "scan_points": run_ctrl.scan_points,
+        "scan_points_done": run_ctrl.scan_points_done,
+        "hit_count": run_ctrl.hit_count,
+        "timeouts": run_ctrl.timeout_counter,
+        "latch_ups": run_ctrl.latch_counter,
+        "step_time_s": _percentiles(step_times),
+        "data_volume_bytes": data_volume,
+        "step_times": step_times.tolist(),
+    }
+
+
+def simulate_scan(scan_params, beam_model=None, wait_for_client_ack=False, run_dir=None, seed=None, logger=None, ack_pipeline_depth=0):
+    """Simulates a complete run in virtual time, returns predicted duration, step timing and data volume
+
+    scan_params holds the keyword arguments of MicrobeamRunController.start_run().
+    Run files are written to a temporary directory unless run_dir is given.
+    """
+    if beam_model is None:
+        beam_model = BeamModel()
+    assert scan_params["step_timeout"] > 0 or beam_model.hit_rate > 0, "Simulation would never end (no hits, no step timeout)"
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    with tempfile.TemporaryDirectory(prefix="microbeam_sim_") as tmp_dir:
+        if run_dir is None:
+            run_dir = tmp_dir
+            # calibration is needed for scans in micrometer units
+            if os.path.exists(os.path.join(os.getcwd(), "cal.json")):
+                shutil.copy(os.path.join(os.getcwd(), "cal.json"), run_dir)
+
+        loop = VirtualClockEventLoop()
+        t_wall = time.perf_counter()
+        try:
+            result = loop.run_until_complete(_simulate(logger, run_dir, scan_params, beam_model, wait_for_client_ack, ack_pipeline_depth, seed))
+        finally:
+            loop.close()
+        result["wall_time_s"] = time.perf_counter() - t_wall
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict duration, step timing and data volume of a scan in virtual time")
+    parser.add_argument("--units", default="lsb", choices=["lsb", "um", "volt"], help="scan units (default: lsb)")
+    parser.add_argument("--start-x", type=float, default=-1000)
+    parser.add_argument("--stop-x", type=float, default=1000)
+    parser.add_argument("--points-x", type=int, default=10)
+    parser.add_argument("--start-y", type=float, default=-1000)
+    parser.add_argument("--stop-y", type=float, default=1000)
+    parser.add_argument("--points-y", type=int, default=10)
+    parser.add_argument("--hits-per-step", type=int, default=10)
+    parser.add_argument("--step-timeout", type=float, default=0, help="seconds, 0 for none")
+    parser.add_argument("--repeat-count", type=int, default=1)
+    parser.add_argument("--scan-order", default="raster", choices=SCAN_ORDERS)
+    parser.add_argument("--max-refine-level", type=int, default=0, help="adaptive refinement levels, 0 for none")
+    parser.add_argument("--points-file", type=str, default=None, help="ROI point list (CSV: x,y in scan units), replaces the grid")
+    parser.add_argument("--mask-file", type=str, default=None, help="ROI mask (0/1 text, one line per y point) applied to the grid")
+    parser.add_argument("--adaptive-timeout", type=float, default=0, help="step timeout as multiple of the expected step time, 0 for off")
+    parser.add_argument("--time-budget", type=float, default=0, help="max. scan duration (s), 0 for none")
+    parser.add_argument("--hit-rate", type=float, default=25.0, help="beam hit rate with open shutter (hits/s)")
+    parser.add_argument("--latch-up-probability", type=float, default=0.0, help="probability of a latch-up per hit")
+    parser.add_argument("--ack-delay", type=float, default=None,
+                        help="mean client ack delay (s), default: twice the mean time for the step's hits for legacy acks, "
+                             "0.05 s readout per step for pipelined acks")
+    parser.add_argument("--ack-jitter", type=float, default=0.01, help="standard deviation of the client ack delay (s)")
+    parser.add_argument("--dac-latency", type=float, default=0.001, help="DAC update and settling time (s)")
+    parser.add_argument("--wait-for-client-ack", action="store_true", help="simulate a main TCP client gating each step")
+    parser.add_argument("--ack-depth", type=int, default=0, help="pipelined acks: max. steps in flight, 0 for legacy acks")
+    parser.add_argument("--nack-probability", type=float, default=0.0, help="probability of a failing pipelined ack")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible predictions")
+    parser.add_argument("-o", "--output", type=str, default=None, help="write full result incl. all step times as JSON")
+    args = parser.parse_args()
+    legacy_ack = args.wait_for_client_ack and args.ack_depth == 0
+    # a legacy ack before half of the step's hits aborts the scan, the default leaves room for slow (Poisson) steps
+    half_step_time = args.hits_per_step / 2 / args.hit_rate if args.hit_rate > 0 else 0.0
+    if legacy_ack and args.hit_rate <= 0:
+        parser.error("--wait-for-client-ack without --ack-depth needs a --hit-rate above 0, the scan would abort at the first step")
+    if args.ack_delay is None:
+        args.ack_delay = 4 * half_step_time if legacy_ack else 0.05
+    elif legacy_ack and args.ack_delay - 3 * args.ack_jitter < half_step_time:
+        parser.error(f"--ack-delay {args.ack_delay:g} s (jitter {args.ack_jitter:g} s) acks legacy steps before half of "
+                     f"the hits ({half_step_time:g} s at {args.hit_rate:g} hits/s), the scan would abort at the first step")
+
+    # the run log is still written, but keep the console quiet
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+
+    result = simulate_scan(
+        scan_params={
+            "start_x": args.start_x,
+            "start_y": args.start_y,
+            "stop_x": args.stop_x,
+            "stop_y": args.stop_y,
+            "points_x": args.points_x,
+            "points_y": args.points_y,
+            "hits_per_step": args.hits_per_step,
+            "step_timeout": args.step_timeout,
+            "repeat_count": args.repeat_count,
+            "units": args.units,
+            "scan_order": args.scan_order,
+            "max_refine_level": args.max_refine_level,
+            "time_budget": args.time_budget,
+            "adaptive_timeout": args.adaptive_timeout,
+            "points": load_points(args.points_file) if args.points_file is not None else None,
+            "mask": load_mask(args.mask_file) if args.mask_file is not None else None,
+        },
+        beam_model=BeamModel(
+            hit_rate=args.hit_rate,
+            latch_up_probability=args.latch_up_probability,
+            ack_delay=args.ack_delay,
+            ack_jitter=args.ack_jitter,
+            nack_probability=args.nack_probability,
+            dac_latency=args.dac_latency,
+        ),
+        wait_for_client_ack=args.wait_for_client_ack,
+        ack_pipeline_depth=args.ack_depth,
+        seed=args.seed,
+        logger=logger,
+    )
+
+    duration = result["predicted_duration_s"]
+    print(f"Predicted scan duration: {time.strftime('%H:%M:%S', time.gmtime(duration))} ({duration:.1f} s), "
+          f"simulated in {result['wall_time_s']:.2f} s")
+    print(f"Points: {result['scan_points_done']} / {result['scan_points']}, hits: {result['hit_count']}, "
+          f"timeouts: {result['timeouts']}, latch-ups: {result['latch_ups']}")
+    print("Step time (s): " + ", ".join(f"{k}={v:.3f}" for k, v in result["step_time_s"].items()))
+    print("Data volume (bytes): " + ", ".join(f"{k}={v}" for k, v in result["data_volume_bytes"].items()))
+
+    if args.output is not None:
+        with open(args.output, "w") as fd:
+            json.dump(result, fd, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Latch-up waveforms: lazy access to latch_data.pkl, min/max decimation and vectorized event features
+
+pandas is imported where DataFrames are used, the run controller only needs the FIFO and decimation helpers.
+"""
+import os
+import re
+import struct
+
+import numpy as np
+
+# column keys are f"{hit_count}_{x}_{y}", possibly with suffixes (e.g. duplicates or channel numbers)
+_KEY_PATTERN = re.compile(r"^(-?\d+)_(-?\d+)_(-?\d+)")
+_CHANNEL_PATTERN = re.compile(r"_ch(\d+)")
+
+# latch-up FIFO messages of multi-channel checkers: magic, channel, number of float64 samples, samples
+LATCH_MAGIC = b"LTCH"
+LATCH_HEADER = struct.Struct("<4sIQ")
+
+
+def pack_latch_message(channel, waveform):
+    waveform = np.ascontiguousarray(waveform, dtype=np.float64)
+    return LATCH_HEADER.pack(LATCH_MAGIC, channel, len(waveform)) + waveform.tobytes()
+
+
+def parse_latch_messages(data):
+    """(channel, waveform) of each complete latch-up message in the FIFO data and the incomplete rest
+
+    A message split across FIFO reads stays in the rest, prepend it to the next read.
+    Raw float64 data (single channel checkers) is one waveform of channel 0, without rest.
+    """
+    if len(data) < len(LATCH_MAGIC) and LATCH_MAGIC.startswith(data):
+        return [], data
+    if not data.startswith(LATCH_MAGIC):
+        return [(0, np.frombuffer(data[:len(data) // 8 * 8]))], b""
+    messages = []
+    offset = 0
+    while offset + LATCH_HEADER.size <= len(data) and data.startswith(LATCH_MAGIC, offset):
+        _, channel, n_samples = LATCH_HEADER.unpack_from(data, offset)
+        if offset + LATCH_HEADER.size + 8 * n_samples > len(data):
+            break
+        messages.append((channel, np.frombuffer(data, count=n_samples, offset=offset + LATCH_HEADER.size)))
+        offset += LATCH_HEADER.size + 8 * n_samples
+    rest = data[offset:]
+    if not rest.startswith(LATCH_MAGIC[:len(rest)]):
+        rest = b""  # no message start, dropped
+    return messages, rest
+
+
+def parse_event_key(key):
+    """(hit_count, x_lsb, y_lsb) of a latch-up column key, None for unknown formats"""
+    match = _KEY_PATTERN.match(str(key))
+    if match is None:
+        return None
+    return tuple(int(v) for v in match.groups())
+
+
+def event_channel(key):
+    """Checker channel of a latch-up column key (f"..._ch{channel}", single channel checkers: 0)"""
+    match = _CHANNEL_PATTERN.search(str(key))
+    return 0 if match is None else int(match.group(1))
+
+
+def minmax_decimate(y, n_bins):
+    """Min/max envelope of y in n_bins bins, keeps spikes visible in overview plots
+
+    Returns (x, y_decimated) with 2 points per bin (sample index of the bin start, min then max).
+    2D input (events × samples) is decimated along the last axis. Short inputs are returned as is.
+    """
+    y = np.asarray(y, dtype=float)
+    n_samples = y.shape[-1]
+    if n_samples <= 2 * n_bins:
+        return np.arange(n_samples), y
+    bin_size = int(np.ceil(n_samples / n_bins))
+    pad = bin_size * n_bins - n_samples
+    padded = np.concatenate([y, np.full(y.shape[:-1] + (pad,), np.nan)], axis=-1) if pad else y
+    binned = padded.reshape(y.shape[:-1] + (n_bins, bin_size))
+    # all-NaN bins (padding) stay NaN without warnings
+    with np.errstate(invalid="ignore"):
+        lo = np.fmin.reduce(binned, axis=-1)
+        hi = np.fmax.reduce(binned, axis=-1)
+    x = np.repeat(np.arange(n_bins) * bin_size, 2)
+    y_decimated = np.stack([lo, hi], axis=-1).reshape(y.shape[:-1] + (2 * n_bins,))
+    return x, y_decimated
+
+
+def waveform_features(waveforms, lengths=None, sample_rate=20000.0, edge_samples=100):
+    """Summary features of many events at once
+
+    waveforms: events × samples array, shorter events padded with NaN (lengths gives the valid samples).
+    baseline: mean of the first edge samples, step height: mean of the last edge samples (settled level)
+    minus baseline, with edge = min(edge_samples, samples // 4) so short events keep their step,
+    rise time: 10 % to 90 % of the step from baseline to settled level (s, NaN without a step).
+    """
+    import pandas as pd
+    waveforms = np.asarray(waveforms, dtype=float)
+    n_events, n_samples = waveforms.shape
+    if lengths is None:
+        lengths = np.full(n_events, n_samples)
+    lengths = np.asarray(lengths)
+    edge = np.minimum(edge_samples, np.maximum(lengths // 4, 1))[:, None]
+    offsets = np.arange(edge_samples)[None, :]
+    valid = offsets < edge
+
+    head = np.where(valid, waveforms[:, :edge_samples] if n_samples >= edge_samples else
+                    np.pad(waveforms, ((0, 0), (0, edge_samples - n_samples)), constant_values=np.nan), np.nan)
+    tail_index = np.clip(lengths[:, None] - edge + offsets, 0, n_samples - 1)
+    tail = np.where(valid, np.take_along_axis(waveforms, tail_index, axis=1), np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        baseline = np.nanmean(head, axis=1)
+        final = np.nanmean(tail, axis=1)
+        peak_index = np.nanargmax(np.where(np.isnan(waveforms), -np.inf, waveforms), axis=1)
+        peak = waveforms[np.arange(n_events), peak_index]
+
+        # fraction of the step, rising towards 1 for steps of either sign (overshoots do not matter)
+        rise = (waveforms - baseline[:, None]) / (final - baseline)[:, None]
+        above10 = rise >= 0.1
+        above90 = rise >= 0.9
+        t10 = np.argmax(above10, axis=1)
+        t90 = np.argmax(above90, axis=1)
+        rise_time = np.where(above10.any(axis=1) & above90.any(axis=1) & (final != baseline), (t90 - t10) / sample_rate, np.nan)
+
+    return pd.DataFrame({
+        "samples": lengths,
+        "baseline": baseline,
+        "peak": peak,
+        "peak_time_s": peak_index / sample_rate,
+        "step_height": final - baseline,
+        "rise_time_s": rise_time,
+    })
+
+
+class LatchWaveformStore:
+    """Lazy access to the latch-up waveforms of a run
+
+    latch_data.pkl (one column per event) is converted once into latch_data.npz next to it,
+    afterwards single events are read without unpickling the whole DataFrame.
+    """
+    def __init__(self, path):
+        import pandas as pd
+        self.path = path
+        self.cache_path = os.path.splitext(path)[0] + ".npz"
+        if not os.path.exists(self.cache_path) or os.path.getmtime(self.cache_path) < os.path.getmtime(path):
+            self._build_cache()
+        self._npz = np.load(self.cache_path)
+
+        keys = self._npz["keys"]
+        parsed = [parse_event_key(key) or (-1, 0, 0) for key in keys]
+        self.index = pd.DataFrame({
+            "key": keys,
+            "hit_count": [p[0] for p in parsed],
+            "x_lsb": [p[1] for p in parsed],
+            "y_lsb": [p[2] for p in parsed],
+            "channel": [event_channel(key) for key in keys],
+            "samples": self._npz["lengths"],
+        })
+
+    def _build_cache(self):
+        import pandas as pd
+        df = pd.read_pickle(self.path)
+        arrays = {}
+        lengths = []
+        for i in range(df.shape[1]):
+            # columns are NaN-padded to the longest event
+            waveform = df.iloc[:, i].to_numpy(dtype=float)
+            valid = np.flatnonzero(~np.isnan(waveform))
+            waveform = waveform[:valid[-1] + 1] if len(valid) else waveform[:0]
+            arrays[f"event_{i}"] = waveform
+            lengths.append(len(waveform))
+        tmp_path = self.cache_path + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array([str(c) for c in df.columns]), lengths=np.array(lengths, dtype=np.int64), **arrays)
+        os.replace(tmp_path, self.cache_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def waveform(self, event):
+        """Samples of one event (by index)"""
+        return self._npz[f"event_{event}"]
+
+    def at_position(self, x, y, tolerance=0):
+        """Indices of all events within tolerance (LSB) of the DAC position"""
+        near = ((self.index["x_lsb"] - x).abs() <= tolerance) & ((self.index["y_lsb"] - y).abs() <= tolerance)
+        return np.flatnonzero(near.to_numpy())
+
+    def padded(self, events):
+        """events × samples array of the given events, NaN-padded, and their lengths"""
+        lengths = self.index["samples"].to_numpy()[events]
+        waveforms = np.full((len(events), max(lengths.max(initial=0), 1)), np.nan)
+        for row, event in enumerate(events):
+            waveforms[row, :lengths[row]] = self.waveform(event)
+        return waveforms, lengths
+
+    def features(self, sample_rate=20000.0, block_size=256):
+        """Feature table of all events (computed in blocks to bound memory)"""
+        import pandas as pd
+        blocks = []
+        for start in range(0, len(self), block_size):
+            events = np.arange(start, min(start + block_size, len(self)))
+            waveforms, lengths = self.padded(events)
+            blocks.append(waveform_features(waveforms, lengths, sample_rate=sample_rate))
+        features = pd.concat(blocks, ignore_index=True) if blocks else waveform_features(np.zeros((0, 1)))
+        return pd.concat([self.index.drop(columns="samples"), features], axis=1)
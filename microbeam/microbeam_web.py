@@ -7,10 +7,29 @@ import os
 import json
 import socket
 
+import numpy as np
+
+from .microbeam_run_controller import RunState
+
+
+def _list_run_files(run_path):
+    """Sizes of the files in a run directory, None if there is no such run"""
+    if not os.path.isdir(run_path):
+        return None
+    files = {}
+    for entry in os.scandir(run_path):
+        if entry.is_file():
+            files[entry.name] = entry.stat().st_size
+    return files
+
+
 class MicrobeamWebInterface:
     def __init__(self, logger, run_ctrl):
         self._logger = logger
         self._run_ctrl = run_ctrl
+        self.port = 8088
+        self.export_chunk_size = 64 * 1024    # bytes per chunk of run file downloads
+        self.export_follow_interval = 0.5     # s between polls of a followed file
 
     def _assemble_html_response(self, content_file):
         html_page = ""
@@ -38,6 +57,127 @@ class MicrobeamWebInterface:
             index_html = self._assemble_html_response("run_control.html")
             return aiohttp.web.Response(text=index_html, content_type="text/html")
 
+    async def serve_latch_ups(self, request):
+            index_html = self._assemble_html_response("latch_ups.html")
+            return aiohttp.web.Response(text=index_html, content_type="text/html")
+
+    async def serve_metrics(self, request):
+        """Prometheus-style metrics: run counters and per-step phase timing histograms"""
+        lines = []
+        for name, help_text, value in [
+            ("run_active", "1 if a run is in progress", int(self._run_ctrl.state.name == "RUN_ACTIVE")),
+            ("run_id", "ID of the current or last run", self._run_ctrl.run_id),
+            ("scan_points", "Scan points of the current run", self._run_ctrl.scan_points),
+            ("scan_points_done", "Scan points done in the current run", self._run_ctrl.scan_points_done),
+            ("hit_count", "Hits logged in the current run", self._run_ctrl.hit_count),
+            ("timeouts", "Step timeouts in the current run", self._run_ctrl.timeout_counter),
+            ("latch_ups", "Latch-ups in the current run", self._run_ctrl.latch_counter),
+            ("metrics_enabled", "1 if step phase timing is recorded", int(self._run_ctrl.metrics.enabled)),
+        ]:
+            lines.append(f"# HELP microbeam_{name} {help_text}")
+            lines.append(f"# TYPE microbeam_{name} gauge")
+            lines.append(f"microbeam_{name} {value}")
+        lines.extend(self._run_ctrl.metrics.prometheus_lines())
+        lines.extend(self._run_ctrl.loop_lag.prometheus_lines())
+        return aiohttp.web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+    async def serve_runs(self, request):
+        """Run catalog query, e.g. /runs?latch_counter_min=1&hits_per_step=10&order_by=-run_id&limit=20"""
+        filters = dict(request.query)
+        order_by = filters.pop("order_by", "run_id")
+        limit = filters.pop("limit", None)
+        try:
+            runs = await self._run_ctrl.query_catalog(filters, order_by=order_by, limit=limit)
+        except AssertionError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
+        return aiohttp.web.json_response(runs)
+
+    async def serve_sensitivity(self, request):
+        """Live latch-up cross-section per position, e.g. /sensitivity?confidence=0.9&max_cross_section=0.001&min_cross_section=0"""
+        try:
+            confidence = float(request.query.get("confidence", 0.95))
+            max_cross_section = float(request.query.get("max_cross_section", 0.01))
+            min_cross_section = float(request.query.get("min_cross_section", 0.0))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text="confidence, max_cross_section and min_cross_section must be numbers")
+        if not 0 < confidence < 1:
+            raise aiohttp.web.HTTPBadRequest(text="confidence must be between 0 and 1 (exclusive)")
+        if not (0 <= min_cross_section <= 1 and 0 <= max_cross_section <= 1):
+            raise aiohttp.web.HTTPBadRequest(text="cross-sections must be between 0 and 1")
+        table = self._run_ctrl.sensitivity.table(confidence)
+        return aiohttp.web.json_response({
+            "run_id": self._run_ctrl.run_id,
+            "confidence": confidence,
+            "summary": self._run_ctrl.sensitivity.summary(confidence, max_cross_section, min_cross_section),
+            # NaN (positions without hits) is not valid JSON
+            "points": table.astype(object).where(table.notna(), None).to_dict(orient="records"),
+        })
+
+    async def _run_file_path(self, request):
+        """Path of a file in a run directory and its size, only names listed in the directory are served"""
+        run_path = os.path.join(self._run_ctrl.run_dir, f"run_{int(request.match_info['run_id']):03d}")
+        # file system access off the event loop, run directories may be on slow storage
+        files = await asyncio.get_running_loop().run_in_executor(None, _list_run_files, run_path)
+        if files is None:
+            raise aiohttp.web.HTTPNotFound(text="Unknown run")
+        name = request.match_info.get("name")
+        if name is None:
+            return run_path, files
+        if name not in files:
+            raise aiohttp.web.HTTPNotFound(text="Unknown file")
+        return os.path.join(run_path, name), files[name]
+
+    async def serve_run_files(self, request):
+        """Files of a run and their sizes, e.g. /runs/42/files"""
+        _, files = await self._run_file_path(request)
+        return aiohttp.web.json_response(dict(sorted(files.items())))
+
+    async def serve_run_file(self, request):
+        """Run file download in chunks
+
+        /runs/42/files/hit_log.csv                      whole file, HTTP range requests supported
+        /runs/42/files/hit_log.csv?compress=1           gzip/deflate compressed on the fly (no ranges)
+        /runs/42/files/hit_log.csv?offset=1024&follow=1 from byte 1024 on, of the active run until it ends
+        """
+        path, size = await self._run_file_path(request)
+        try:
+            offset = int(request.query.get("offset", 0))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(text="offset must be an integer")
+        if not 0 <= offset <= size:
+            raise aiohttp.web.HTTPBadRequest(text=f"offset must be within 0 and the file size ({size} bytes)")
+        follow = request.query.get("follow", "0") == "1"
+        compress = request.query.get("compress", "0") == "1"
+        if not (follow or compress or offset):
+            # sendfile in chunks, handles Range / If-Range headers
+            return aiohttp.web.FileResponse(path, chunk_size=self.export_chunk_size)
+
+        def active():
+            return (follow and self._run_ctrl.state == RunState.RUN_ACTIVE
+                    and int(request.match_info["run_id"]) == self._run_ctrl.run_id)
+
+        response = aiohttp.web.StreamResponse(headers={"Content-Type": "application/octet-stream"})
+        if compress:
+            response.enable_compression()
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as fd:
+            fd.seek(offset)
+            while True:
+                # checked before reading: the run's files are closed once it is no longer active,
+                # the last read after that gets everything written until the end of the run
+                following = active()
+                # file access off the event loop, the scan loop must not wait for slow clients or SD cards
+                chunk = await loop.run_in_executor(None, fd.read, self.export_chunk_size)
+                if chunk:
+                    await response.write(chunk)
+                elif following:
+                    await asyncio.sleep(self.export_follow_interval)
+                else:
+                    break
+        await response.write_eof()
+        return response
+
     async def serve_ws(self, request):
         sock = aiohttp.web.WebSocketResponse()
         await sock.prepare(request)
@@ -79,14 +219,41 @@ class MicrobeamWebInterface:
                         step_timeout=float(msg_dict["step_timeout"]),
                         repeat_count=int(msg_dict["repeat_count"]),
                         units=msg_dict["scan_units"],
+                        scan_order=msg_dict.get("scan_order", "raster"),
+                        max_refine_level=int(msg_dict.get("max_refine_level", 0)),
+                        refine_gradient=float(msg_dict.get("refine_gradient", 0.5)),
+                        refine_significance=float(msg_dict.get("refine_significance", 3.0)),
+                        time_budget=float(msg_dict.get("time_budget", 0)),
+                        points=msg_dict.get("points"),
+                        mask=msg_dict.get("mask"),
+                        adaptive_timeout=float(msg_dict.get("adaptive_timeout", 0)),
                     )
                 if msg_dict["action"] == "stop_run":
                     await self._run_ctrl.stop_run()
+                if msg_dict["action"] == "resume_run":
+                    assert "run_id" in msg_dict, "Run id to resume not provided"
+                    await self._run_ctrl.resume_run(int(msg_dict["run_id"]))
+                if msg_dict["action"] == "latch_events":
+                    # decimated previews of latch-ups newer than "since", full waveforms on request only
+                    since = int(msg_dict.get("since", 0))
+                    events = [
+                        {k: v for k, v in event.items() if k != "waveform"}
+                        for event in self._run_ctrl.latch_events if event["id"] > since
+                    ]
+                    await sock.send_str(json.dumps({"type": "latch_events", "events": events}))
+                if msg_dict["action"] == "latch_waveform":
+                    assert "id" in msg_dict, "Latch-up id not provided"
+                    waveform = await self._run_ctrl.latch_waveform(int(msg_dict["id"]))
+                    await sock.send_str(json.dumps({
+                        "type": "latch_waveform",
+                        "id": int(msg_dict["id"]),
+                        "waveform": None if waveform is None else np.nan_to_num(waveform).tolist(),
+                    }))
                 if msg_dict["action"] == "poll":
                     if last_hit_id < self._run_ctrl.hit_count:
                         new_hits = [{'x': hit['x'], 'y': hit['y']} for hit in self._run_ctrl.hits[last_hit_id:self._run_ctrl.hit_count]]
                         last_hit_id = self._run_ctrl.hit_count
-                        self._logger.info(f"Posted {len(new_hits)} hits to GUI.")
+                        self._logger.info("Posted %d hits to GUI.", len(new_hits))
                     else:
                         new_hits = []
 
@@ -98,6 +265,12 @@ class MicrobeamWebInterface:
                             "dac_y": self._run_ctrl.dac_y,
                             "scan_points": self._run_ctrl.scan_points,
                             "scan_points_done": self._run_ctrl.scan_points_done,
+                            "hit_rate": self._run_ctrl.hit_rate.rate,
+                            "eta_s": self._run_ctrl.hit_rate.eta(
+                                self._run_ctrl.scan_points - self._run_ctrl.scan_points_done, self._run_ctrl.hits_per_step
+                            ) if self._run_ctrl.state == RunState.RUN_ACTIVE else 0,
+                            "step_timeout_s": self._run_ctrl.current_step_timeout,
+                            "latch_counter": self._run_ctrl.latch_counter,
                             "new_hits": new_hits
                         }
                     )
@@ -114,19 +287,25 @@ class MicrobeamWebInterface:
             aiohttp.web.get("/dac_control.html",    self.serve_dac),
             aiohttp.web.get("/hit_map.html",        self.serve_hit_map),
             aiohttp.web.get("/run_control.html",    self.serve_run_control),
+            aiohttp.web.get("/latch_ups.html",      self.serve_latch_ups),
             aiohttp.web.get("/ws",  self.serve_ws),
+            aiohttp.web.get("/metrics",             self.serve_metrics),
+            aiohttp.web.get("/runs",                self.serve_runs),
+            aiohttp.web.get("/sensitivity",         self.serve_sensitivity),
+            aiohttp.web.get(r"/runs/{run_id:\d+}/files",        self.serve_run_files),
+            aiohttp.web.get(r"/runs/{run_id:\d+}/files/{name}", self.serve_run_file),
             aiohttp.web.static("/static", os.path.join(os.path.dirname(__file__), "frontend", "static")),
         ])
 
         runner = aiohttp.web.AppRunner(app,
             access_log_format='%a(%{X-Forwarded-For}i) "%r" %s "%{Referer}i"')
         await runner.setup()
-        site = aiohttp.web.TCPSite(runner, "0.0.0.0", "8088")
+        site = aiohttp.web.TCPSite(runner, "0.0.0.0", self.port)
         await site.start()
-        self._logger.info(f"Web server started. Try: http://{socket.gethostname()}.local:8088/")
+        self._logger.info("Web server started. Try: http://%s.local:%d/", socket.gethostname(), self.port)
         try:
             await asyncio.Future()
         except:
             await runner.cleanup()
-            self._logger.info(f"Web server stopped. Shutting down hardware interface.")
+            self._logger.info("Web server stopped. Shutting down hardware interface.")
         
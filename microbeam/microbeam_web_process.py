@@ -0,0 +1,391 @@
+"""Web GUI in its own process, away from the event loop running the scan
+
+The run controller process publishes a state snapshot and the hits of the current run to shared
+memory (WebStatePublisher). The web process (python -m microbeam.microbeam_web_process, launched
+by start_web_process()) serves MicrobeamWebInterface with a RunControllerProxy reading them.
+Commands (DAC writes, start/stop/resume run) and rare requests (latch-up events, single latch-up
+waveforms, sensitivity counts) go through a local connection and are executed on the controller's
+loop, their replies are serialized and sent from threads.
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import os
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import picologging as logging
+
+from .microbeam_metrics import LoopLagMonitor
+from .microbeam_run_catalog import RunCatalog, CATALOG_FILE
+from .microbeam_run_controller import RunState
+from .microbeam_sensitivity import SensitivityMap
+from .microbeam_shm_ring import ShmRing, ShmSnapshot
+
+# run controller attributes copied into every snapshot
+SNAPSHOT_FIELDS = ("run_id", "dac_x", "dac_y", "scan_points", "scan_points_done", "hit_count",
+                   "timeout_counter", "latch_counter", "hits_per_step", "current_step_timeout")
+AUTHKEY_ENV = "MICROBEAM_WEB_AUTHKEY"
+_HIT_X, _HIT_Y = 0, 1
+
+
+def _plain(value):
+    """numpy scalars (e.g. clipped DAC values) as Python numbers for JSON"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class WebStatePublisher:
+    """Controller side: publishes state and hits for the web process and executes its commands
+
+    Runs as a task on the controller's loop (run()), the commands arrive in a thread,
+    replies are sent from reply_threads threads once their command finished.
+    """
+    def __init__(self, logger, run_ctrl, name, address, authkey, interval=0.1, hits_capacity=1 << 20, reply_threads=4):
+        self._logger = logger
+        self._run_ctrl = run_ctrl
+        self.interval = interval
+        self.snapshot = ShmSnapshot.create(f"{name}_state")
+        self.hits_ring = ShmRing.create(f"{name}_hits", 1, hits_capacity, 0.0, fields=2)
+        self._listener = Listener(address, authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._reply_executor = concurrent.futures.ThreadPoolExecutor(max_workers=reply_threads, thread_name_prefix="web_reply")
+        self._hits_list = None  # run_ctrl.hits, replaced by every new or resumed run
+        self._hits_published = 0
+        self._hits_base = 0  # ring sequence number of the first hit of the run
+        self._snapshot_too_big = False
+        self._commands = {
+            "write_dac_units": run_ctrl.write_dac_units,
+            "start_run": run_ctrl.start_run,
+            "stop_run": run_ctrl.stop_run,
+            "resume_run": run_ctrl.resume_run,
+            "latch_events": self._latch_events,
+            "latch_waveform": run_ctrl.latch_waveform,
+            "sensitivity_counts": self._sensitivity_counts,
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._command_thread, args=(loop,), name="web_commands", daemon=True).start()
+        while True:
+            self.publish()
+            await asyncio.sleep(self.interval)
+
+    def publish(self):
+        rc = self._run_ctrl
+        if rc.hits is not self._hits_list:
+            self._hits_list = rc.hits
+            self._hits_published = 0
+            self._hits_base = self.hits_ring.sequence
+        if len(rc.hits) > self._hits_published:
+            new_hits = rc.hits[self._hits_published:]
+            self.hits_ring.push(np.array([(hit["x"], hit["y"]) for hit in new_hits], dtype=float).reshape(-1, 1, 2))
+            self._hits_published += len(new_hits)
+
+        state = {field: _plain(getattr(rc, field)) for field in SNAPSHOT_FIELDS}
+        state.update(
+            state=rc.state.name,
+            hits_base=self._hits_base,
+            hit_rate=_plain(rc.hit_rate.rate),
+            eta_s=_plain(rc.hit_rate.eta(rc.scan_points - rc.scan_points_done, rc.hits_per_step))
+            if rc.state == RunState.RUN_ACTIVE else 0,
+            metrics_enabled=rc.metrics.enabled,
+            metrics_lines=rc.metrics.prometheus_lines(),
+            loop_lag=rc.loop_lag.summary(),
+        )
+        if not self.snapshot.write(state) and not self._snapshot_too_big:
+            self._snapshot_too_big = True
+            self._logger.warning("Web state snapshot larger than %d bytes, not updated.", self.snapshot.size)
+
+    def _command_thread(self, loop):
+        while True:
+            try:
+                conn = self._listener.accept()  # the web process, again after a restart
+            except AuthenticationError:
+                self._logger.warning("Web command connection with wrong key refused.")
+                continue
+            except OSError:
+                return  # listener closed
+            self._logger.info("Web process connected.")
+            try:
+                while True:
+                    request_id, command, kwargs = conn.recv()
+                    future = asyncio.run_coroutine_threadsafe(self._execute(command, kwargs), loop)
+                    self._reply_executor.submit(self._reply, conn, request_id, command, future)
+            except (EOFError, OSError):
+                self._logger.info("Web process disconnected.")
+            conn.close()
+
+    async def _execute(self, command, kwargs):
+        assert command in self._commands, f"unknown web command {command}"
+        return await self._commands[command](**kwargs)
+
+    def _reply(self, conn, request_id, command, future):
+        """Waits for the command in a reply thread, pickling and sending the result stay off the loop"""
+        result = error = None
+        try:
+            result = future.result()
+        except Exception as e:
+            self._logger.exception("Web command %s failed.", command)
+            error = repr(e)
+        with self._send_lock:
+            try:
+                conn.send((request_id, result, error))
+            except OSError:
+                pass
+
+    async def _latch_events(self, since=0):
+        """Recent latch-ups without their full waveforms (latch_waveform fetches one)"""
+        return [{k: v for k, v in event.items() if k != "waveform"} for event in self._run_ctrl.latch_events if event["id"] > since]
+
+    async def _sensitivity_counts(self):
+        return self._run_ctrl.sensitivity.counts()
+
+    def close(self):
+        address = self._listener.address
+        self._listener.close()
+        self._reply_executor.shutdown(wait=False)
+        shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+        self.hits_ring.close()
+        self.snapshot.close()
+
+
+class _HitRateView:
+    def __init__(self):
+        self.rate = None
+        self.eta_s = 0
+
+    def eta(self, remaining_points, hits_per_step):
+        return self.eta_s
+
+
+class _MetricsView:
+    def __init__(self):
+        self.enabled = False
+        self.lines = []
+
+    def prometheus_lines(self):
+        return self.lines
+
+
+class _LoopLagView:
+    def __init__(self):
+        self.summary = {"p50": 0.0, "p99": 0.0, "recent_max": 0.0, "max": 0.0}
+
+    def prometheus_lines(self):
+        return LoopLagMonitor.summary_prometheus_lines(self.summary)
+
+
+class _HitsView:
+    """Hits of the current run by index (slices only), as far as the ring still holds them"""
+    def __init__(self, ring):
+        self._ring = ring
+        self.base = 0
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(1 << 62)
+        sequence, frames = self._ring.read(self.base + start)
+        frames = frames[:max(0, self.base + stop - (sequence - len(frames)))]
+        return [{"x": x, "y": y} for x, y in frames[:, 0, [_HIT_X, _HIT_Y]].tolist()]
+
+
+class RunControllerProxy:
+    """Web side: has the run controller attributes and methods MicrobeamWebInterface uses
+
+    State is refreshed from the snapshot every interval s (run()), latch-up events when the
+    latch-up counter changes, the sensitivity map at most every sensitivity_interval s.
+    """
+    def __init__(self, logger, run_dir, name, address, authkey, interval=0.1, sensitivity_interval=1.0):
+        self._logger = logger
+        self.run_dir = run_dir
+        self.interval = interval
+        self.sensitivity_interval = sensitivity_interval
+        self._snapshot = ShmSnapshot.attach(f"{name}_state")
+        self._hits_ring = ShmRing.attach(f"{name}_hits")
+        self._conn = Client(address, authkey=authkey)
+        self._pending = {}
+        self._next_request = 0
+        self._query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog_query")
+        self.catalog = RunCatalog(os.path.join(run_dir, CATALOG_FILE))
+
+        self.state = RunState.IDLE
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, 0)
+        self.hits = _HitsView(self._hits_ring)
+        self.hit_rate = _HitRateView()
+        self.metrics = _MetricsView()
+        self.loop_lag = _LoopLagView()
+        self.latch_events = collections.deque(maxlen=50)
+        self.sensitivity = SensitivityMap()
+        self._version = None
+
+    async def run(self):
+        """Follows the controller state, returns when the controller process is gone"""
+        loop = asyncio.get_running_loop()
+        closed = loop.create_future()
+        threading.Thread(target=self._reply_thread, args=(loop, closed), name="web_replies", daemon=True).start()
+        t_sensitivity = -np.inf
+        sensitivity_key = None
+        while not closed.done():
+            version, snapshot = self._snapshot.read()
+            if snapshot is not None and version != self._version:
+                self._version = version
+                run_id = self.run_id
+                self._update(snapshot)
+                try:
+                    await self._refresh_latch_events(new_run=run_id != self.run_id)
+                    key = (self.run_id, self.scan_points_done, self.latch_counter)
+                    if key != sensitivity_key and loop.time() - t_sensitivity >= self.sensitivity_interval:
+                        sensitivity_key, t_sensitivity = key, loop.time()
+                        await self._refresh_sensitivity()
+                except (RuntimeError, OSError) as e:
+                    self._logger.warning("Web state refresh failed: %s", e)
+            await asyncio.wait([closed], timeout=self.interval)
+        self._logger.info("Run controller process gone.")
+
+    def _update(self, snapshot):
+        for field in SNAPSHOT_FIELDS:
+            setattr(self, field, snapshot[field])
+        self.state = RunState[snapshot["state"]]
+        self.hits.base = snapshot["hits_base"]
+        self.hit_rate.rate = snapshot["hit_rate"]
+        self.hit_rate.eta_s = snapshot["eta_s"]
+        self.metrics.enabled = snapshot["metrics_enabled"]
+        self.metrics.lines = snapshot["metrics_lines"]
+        self.loop_lag.summary = snapshot["loop_lag"]
+
+    async def _refresh_latch_events(self, new_run):
+        last_id = self.latch_events[-1]["id"] if self.latch_events else 0
+        if new_run or self.latch_counter < last_id:
+            self.latch_events.clear()
+            last_id = 0
+        if self.latch_counter > last_id:
+            self.latch_events.extend(await self._call("latch_events", since=last_id))
+
+    async def _refresh_sensitivity(self):
+        sensitivity = SensitivityMap()
+        for x, y, hits, latch_ups in await self._call("sensitivity_counts"):
+            sensitivity.add(x, y, hits, latch_ups)
+        self.sensitivity = sensitivity
+
+    def _reply_thread(self, loop, closed):
+        try:
+            while True:
+                reply = self._conn.recv()
+                loop.call_soon_threadsafe(self._resolve, *reply)
+        except (EOFError, OSError):
+            loop.call_soon_threadsafe(lambda: closed.done() or closed.set_result(None))
+
+    def _resolve(self, request_id, result, error):
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(RuntimeError(f"run controller: {error}"))
+
+    async def _call(self, command, **kwargs):
+        self._next_request += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_request] = future
+        self._conn.send((self._next_request, command, kwargs))
+        return await future
+
+    async def query_catalog(self, filters, order_by="run_id", limit=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._query_executor, functools.partial(self.catalog.query, filters, order_by=order_by, limit=limit))
+
+    async def write_dac_units(self, **kwargs):
+        return await self._call("write_dac_units", **kwargs)
+
+    async def start_run(self, **kwargs):
+        return await self._call("start_run", **kwargs)
+
+    async def stop_run(self):
+        return await self._call("stop_run")
+
+    async def resume_run(self, run_id):
+        return await self._call("resume_run", run_id=run_id)
+
+    async def latch_waveform(self, event_id):
+        return await self._call("latch_waveform", event_id=event_id)
+
+    def close(self):
+        self._conn.close()
+        self._query_executor.shutdown()
+        self._hits_ring.close()
+        self._snapshot.close()
+
+
+def start_web_process(logger, run_ctrl, port, log_file=None):
+    """Launches the web process, returns it and the publisher (run publisher.run() as a task on the controller's loop)"""
+    name = f"microbeam_web_{os.getpid()}"
+    address = os.path.join(tempfile.mkdtemp(prefix="microbeam_web_"), "commands")
+    authkey = secrets.token_bytes(32)
+    publisher = WebStatePublisher(logger, run_ctrl, name, address, authkey)
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [repo, env.get("PYTHONPATH")]))
+    command = [sys.executable, "-m", "microbeam.microbeam_web_process", "--name", name, "--address", address,
+               "--run-dir", os.path.abspath(run_ctrl.run_dir), "--port", str(port)]
+    if log_file is not None:
+        command += ["--log-file", log_file]
+    process = subprocess.Popen(command, env=env)
+    logger.info("Web process started (pid %d).", process.pid)
+    return process, publisher
+
+
+async def _serve(args, logger):
+    from .microbeam_web import MicrobeamWebInterface
+    proxy = RunControllerProxy(logger, args.run_dir, args.name, args.address, bytes.fromhex(os.environ[AUTHKEY_ENV]))
+    web_if = MicrobeamWebInterface(logger, proxy)
+    web_if.port = args.port
+    tasks = [asyncio.create_task(proxy.run()), asyncio.create_task(web_if.serve())]
+    # the controller process terminates this one
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: [task.cancel() for task in tasks])
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        proxy.close()
+
+
+def main():
+    from .microbeam_logging import setup_queue_logging
+    parser = argparse.ArgumentParser(description="Web GUI process of beam_control.py (started with --web-process)")
+    parser.add_argument("--name", required=True, help="shared memory name prefix of the controller")
+    parser.add_argument("--address", required=True, help="command socket of the controller")
+    parser.add_argument("--run-dir", required=True, help="run directory of the controller")
+    parser.add_argument("--port", type=int, default=8088, help="web GUI port (default: 8088)")
+    parser.add_argument("--log-file", default=None, help="log file (appended to)")
+    args = parser.parse_args()
+
+    # Ctrl-C in the terminal reaches both processes, the controller shuts this one down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = setup_queue_logging(level=logging.INFO, log_file=args.log_file,
+                                       log_format="%(created)f [%(levelname)s]  web: %(message)s")
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    try:
+        asyncio.run(_serve(args, logging.getLogger(__name__)))
+    finally:
+        log_listener.stop()
+
+
+if __name__ == "__main__":
+    main()
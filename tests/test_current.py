@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import picologging as logging
+
+from microbeam.microbeam_current import StepCurrentMonitor
+from microbeam.microbeam_shm_ring import ShmRing
+
+
+def test_monitor_follows_ring_of_restarted_checker():
+    name = f"test_ring_{os.getpid()}"
+    killed = ShmRing.create(name, 2, 100, 1000.0)
+    monitor = StepCurrentMonitor(logging.getLogger(__name__), ring_name=name)
+    monitor.stall_timeout = 0
+    try:
+        monitor.start_step()
+        killed.push(np.ones((5, 2, 4)))
+        monitor.poll()
+        # the checker dies without closing its ring, a new one replaces the segment
+        restarted = ShmRing.create(name, 2, 100, 1000.0)
+        monitor.poll()  # no new frames: stalled, finds the new ring
+        restarted.push(np.full((3, 2, 4), 2.0))
+        rows = monitor.finish_step()
+        assert monitor.ring.created == restarted.created
+        assert [row[1] for row in rows] == [3, 3]
+        assert [row[2] for row in rows] == [2.0, 2.0]
+    finally:
+        monitor.close()
+        killed._shm.close()
+        restarted.close()
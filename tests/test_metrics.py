@@ -0,0 +1,39 @@
+import numpy as np
+
+from microbeam.microbeam_metrics import HitRateEstimator
+
+
+def _adaptive_timeout(estimator, hits_per_step, multiple=3.0, minimum=1.0):
+    # as in MicrobeamRunController._scan(), without the run's upper limit
+    return max(minimum, multiple * estimator.expected_step_time(hits_per_step))
+
+
+def _run_steps(estimator, rng, rate, n_steps, hits_per_step):
+    for _ in range(n_steps):
+        timeout = _adaptive_timeout(estimator, hits_per_step)
+        arrivals = np.cumsum(rng.exponential(1.0 / rate, hits_per_step))
+        hits = int(np.searchsorted(arrivals, timeout, side="right"))
+        shutter_time = arrivals[-1] if hits == hits_per_step else timeout
+        estimator.add_step(hits, shutter_time=shutter_time, step_duration=shutter_time + 0.05)
+
+
+def test_adaptive_timeout_recovers_after_intensity_drop():
+    rng = np.random.default_rng(1)
+    estimator = HitRateEstimator()
+    hits_per_step = 10
+
+    _run_steps(estimator, rng, 50.0, 50, hits_per_step)
+    assert abs(estimator.rate - 50.0) < 15.0
+    assert _adaptive_timeout(estimator, hits_per_step) == 1.0  # pinned at the floor
+
+    # beam drops to a tenth, timed-out steps pull the estimate down
+    _run_steps(estimator, rng, 5.0, 50, hits_per_step)
+    assert abs(estimator.rate - 5.0) < 2.0
+    assert _adaptive_timeout(estimator, hits_per_step) > 4.0  # 3 x 2 s expected step time
+
+
+def test_latch_up_steps_are_ignored():
+    estimator = HitRateEstimator()
+    estimator.add_step(10, shutter_time=1.0, step_duration=1.0)
+    estimator.add_step(0, shutter_time=5.0, step_duration=5.0, usable=False)
+    assert estimator.rate == 10.0
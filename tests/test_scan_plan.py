@@ -0,0 +1,26 @@
+import numpy as np
+
+from microbeam.microbeam_scan_plan import make_grid_plan, refine_plan
+
+
+def _refine(counts, duration=1.0):
+    # 5 x 5 grid, pitch 100 LSB, one (hits, duration, latch_ups, flagged) row per step
+    vals = np.arange(5) * 100
+    plan = make_grid_plan(vals, vals, 1)
+    hits = np.array([counts[(x, y)] for x, y in plan[:, :2]], dtype=float)
+    step_results = np.column_stack([hits, np.full(len(plan), duration), np.zeros(len(plan)), np.zeros(len(plan))])
+    return refine_plan(plan, step_results, 0, 100, 100, (0, 400, 0, 400))
+
+
+def test_poisson_noise_is_not_refined():
+    rng = np.random.default_rng(2)
+    # uniform beam at 3 hits per step: relative neighbour differences of 100 % are common
+    counts = {(x, y): rng.poisson(3) for x in range(0, 500, 100) for y in range(0, 500, 100)}
+    assert len(_refine(counts)) == 0
+
+
+def test_significant_edge_is_refined():
+    counts = {(x, y): 100 if x < 200 else 10 for x in range(0, 500, 100) for y in range(0, 500, 100)}
+    new_rows = _refine(counts)
+    assert len(new_rows) > 0
+    assert set(new_rows[:, 0]) <= {50, 100, 150, 200, 250}
@@ -0,0 +1,23 @@
+from microbeam.microbeam_sensitivity import SensitivityMap
+
+
+def test_summary_sensitive_against_run_wide_rate():
+    sensitivity = SensitivityMap()
+    # uniform sensitivity: latch-ups everywhere, no position stands out
+    for x in range(4):
+        sensitivity.add(x, 0, hits=1000, latch_ups=5)
+    summary = sensitivity.summary(max_cross_section=0.001)
+    assert summary["sensitive_points"] == 0
+    assert summary["undecided_points"] == 4
+
+    # one hot spot among quiet positions
+    sensitivity.clear()
+    for x in range(4):
+        sensitivity.add(x, 0, hits=1000, latch_ups=20 if x == 2 else 0)
+    summary = sensitivity.summary(max_cross_section=0.01)
+    assert summary["run_cross_section"] == 20 / 4000
+    assert summary["sensitive_points"] == 1
+    assert summary["cleared_points"] == 3
+    assert summary["undecided_points"] == 0
+    # a floor above the hot spot's lower bound flags nothing
+    assert sensitivity.summary(max_cross_section=0.01, min_cross_section=0.05)["sensitive_points"] == 0
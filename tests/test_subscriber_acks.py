@@ -0,0 +1,48 @@
+import asyncio
+
+from microbeam.microbeam_run_controller import MicrobeamSubscriberSocket
+
+
+def _socket_with_clients(n_clients):
+    socket = MicrobeamSubscriberSocket(tcp_server_port=None, ack_clients=0)
+    readers = [asyncio.StreamReader() for _ in range(n_clients)]
+    for reader in readers:
+        socket._read_clients.append(reader)
+        socket._write_clients.append(None)
+    return socket, readers
+
+
+def test_pipelined_quorum_counts_distinct_clients():
+    async def run():
+        socket, (a, b) = _socket_with_clients(2)
+        for seq in (0, 1):
+            socket.expect_ack(seq)
+        # a repeated ack of one client does not reach the quorum of two
+        a.feed_data(b"ack 0\n")
+        await asyncio.sleep(0)
+        a.feed_data(b"ack 0\n")
+        try:
+            await asyncio.wait_for(socket.read_ack_msg(), 0.05)
+            assert False, "step decided by a single client"
+        except asyncio.TimeoutError:
+            pass
+        # plain acks refer to the oldest step the client has not acknowledged
+        b.feed_data(b"ack\n")
+        assert await asyncio.wait_for(socket.read_ack_msg(), 1) == (True, 0)
+        a.feed_data(b"ack\n")
+        b.feed_data(b"ack 1\n")
+        assert await asyncio.wait_for(socket.read_ack_msg(), 1) == (True, 1)
+
+    asyncio.run(run())
+
+
+def test_pipelined_nack_without_seq_flags_oldest_step():
+    async def run():
+        socket, (a,) = _socket_with_clients(1)
+        for seq in (3, 4):
+            socket.expect_ack(seq)
+        socket.cancel_ack(3)  # ack timeout, decided by the run controller
+        a.feed_data(b"nack\n")
+        assert await asyncio.wait_for(socket.read_ack_msg(), 1) == (False, 4)
+
+    asyncio.run(run())
@@ -0,0 +1,34 @@
+import numpy as np
+
+from microbeam.microbeam_waveforms import pack_latch_message, parse_latch_messages, waveform_features
+
+
+def test_latch_message_split_across_reads():
+    data = pack_latch_message(1, np.arange(100.0)) + pack_latch_message(3, np.ones(50))
+    for split in (2, 10, 400, len(data) - 8):
+        messages, rest = parse_latch_messages(data[:split])
+        more, rest = parse_latch_messages(rest + data[split:])
+        messages += more
+        assert rest == b""
+        assert [channel for channel, _ in messages] == [1, 3]
+        assert np.array_equal(messages[0][1], np.arange(100.0))
+        assert np.array_equal(messages[1][1], np.ones(50))
+
+
+def test_raw_waveform_is_one_message():
+    messages, rest = parse_latch_messages(np.arange(10.0).tobytes())
+    assert rest == b"" and len(messages) == 1 and messages[0][0] == 0
+
+
+def test_rise_time_against_settled_level():
+    # baseline 0, linear rise over 100 samples to 1, overshoot spike, settled at 1
+    waveform = np.concatenate([np.zeros(200), np.linspace(0, 1, 101)[1:], np.ones(700)])
+    waveform[350] = 3.0
+    short = np.full(1000, np.nan)
+    short[:40] = np.concatenate([np.zeros(20), np.ones(20)])
+    features = waveform_features(np.stack([waveform, short]), lengths=[1000, 40], sample_rate=1000.0)
+    assert features["peak"][0] == 3.0
+    assert np.isclose(features["step_height"][0], 1.0)
+    assert np.isclose(features["rise_time_s"][0], 0.080)
+    # edges of a quarter of the event: the step of a short event is kept
+    assert features["baseline"][1] == 0.0 and features["step_height"][1] == 1.0